@@ -1,6 +1,5 @@
 from django.contrib.auth.models import User
 from django.utils.decorators import method_decorator
-from ratelimit.decorators import ratelimit
 from rest_framework import status
 from rest_framework import viewsets
 from rest_framework import permissions
@@ -21,6 +20,7 @@ from django.contrib.auth import (
 
 from accounts.models import UserProfile
 from utils.permissions import IsObjectOwner
+from utils.ratelimit import ratelimit
 
 
 class UserViewSet(viewsets.ReadOnlyModelViewSet):
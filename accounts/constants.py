@@ -0,0 +1,7 @@
+from utils.time_constants import ONE_DAY, ONE_MINUTE
+
+# 同一个进程里，同一个 user 的活跃时间最多每隔多久写一次 redis
+USER_ACTIVITY_UPDATE_INTERVAL = ONE_MINUTE
+
+# 超过这个时间没有活跃过的 user 被视为不活跃 (dormant)，fanout 时会被跳过
+USER_ACTIVE_WINDOW = 30 * ONE_DAY
@@ -0,0 +1,43 @@
+import time
+
+from accounts.constants import USER_ACTIVE_WINDOW, USER_ACTIVITY_UPDATE_INTERVAL
+from accounts.services import UserService
+
+
+class UserActivityMiddleware:
+    """
+    记录登录用户最近一次活跃的时间
+    不活跃的用户重新活跃时，触发 newsfeeds 的重建
+    """
+    # 进程内记录每个 user 上一次写 redis 的时间，避免每个 request 都写一次
+    max_tracked_users = 100000
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.last_marked_at = {}
+
+    def __call__(self, request):
+        response = self.get_response(request)
+
+        # DRF 的认证发生在 view 里，认证之后会把 user 写回 django 的 request 上
+        # 所以在 response 阶段才能拿到 token / force_authenticate 等方式认证的 user
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            self._mark_active(user.id)
+        return response
+
+    def _mark_active(self, user_id):
+        now = time.time()
+        if now - self.last_marked_at.get(user_id, 0) < USER_ACTIVITY_UPDATE_INTERVAL:
+            return
+
+        if len(self.last_marked_at) >= self.max_tracked_users:
+            self.last_marked_at.clear()
+        self.last_marked_at[user_id] = now
+
+        last_active_at = UserService.mark_active(user_id)
+        # 没有活跃记录的 user 一直被当作活跃的用户 fanout，不需要重建
+        if last_active_at is not None and last_active_at < now - USER_ACTIVE_WINDOW:
+            # import 写在里面避免循环依赖
+            from newsfeeds.services import NewsFeedService
+            NewsFeedService.rebuild_newsfeeds_for_dormant_user(user_id, last_active_at)
@@ -1,10 +1,14 @@
+import time
+
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import caches
 
+from accounts.constants import USER_ACTIVE_WINDOW
 from accounts.models import UserProfile
-from twitter.cache import USER_PROFILE_PATTERN
+from twitter.cache import USER_LAST_ACTIVE_KEY, USER_PROFILE_PATTERN
 from utils.memcached_helper import MemcachedHelper
+from utils.redis_client import RedisClient
 
 cache = caches['testing'] if settings.TESTING else caches['default']
 
@@ -33,7 +37,92 @@ class UserService:
         cache.set(key, profile)
         return profile
 
+    @classmethod
+    def get_profiles_through_cache(cls, user_ids):
+        """
+        批量版本的 get_profile_through_cache，返回 {user_id: profile}
+        """
+        user_ids = set(user_id for user_id in user_ids if user_id is not None)
+        if not user_ids:
+            return {}
+
+        keys = {USER_PROFILE_PATTERN.format(user_id=user_id): user_id for user_id in user_ids}
+        cached = cache.get_many(list(keys.keys()))
+        profiles = {keys[key]: profile for key, profile in cached.items() if profile is not None}
+
+        missing_ids = [user_id for user_id in user_ids if user_id not in profiles]
+        if not missing_ids:
+            return profiles
+
+        # cache miss, read from db
+        for profile in UserProfile.objects.filter(user_id__in=missing_ids):
+            profiles[profile.user_id] = profile
+        # 因为历史原因，可能有一些历史数据没有 profile
+        for user_id in missing_ids:
+            if user_id not in profiles:
+                profiles[user_id], _ = UserProfile.objects.get_or_create(user_id=user_id)
+        cache.set_many({
+            USER_PROFILE_PATTERN.format(user_id=user_id): profiles[user_id]
+            for user_id in missing_ids
+        })
+        return profiles
+
+    @classmethod
+    def get_users_with_profiles_through_cache(cls, user_ids):
+        """
+        批量取出 users 以及对应的 profiles，返回 {user_id: user}
+        profile 会被放进 user 的 instance level cache 里 (见 accounts.models.get_profile)
+        这样之后的 user.profile 不会再访问 cache 或者 db
+        """
+        users = MemcachedHelper.get_objects_through_cache(User, user_ids)
+        profiles = cls.get_profiles_through_cache(users.keys())
+        for user_id, user in users.items():
+            setattr(user, '_cached_user_profile', profiles[user_id])
+        return users
+
     @classmethod
     def invalidate_profile(cls, user_id):
         key = USER_PROFILE_PATTERN.format(user_id=user_id)
         cache.delete(key)
+
+    @classmethod
+    def mark_active(cls, user_id):
+        """
+        在 redis 的 sorted set 里记录 user 最近一次活跃的时间 (unix seconds)
+        返回 user 上一次活跃的时间，没有记录则返回 None
+        """
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline()
+        pipe.zscore(USER_LAST_ACTIVE_KEY, user_id)
+        pipe.zadd(USER_LAST_ACTIVE_KEY, {user_id: time.time()})
+        last_active_at, _ = pipe.execute()
+        return last_active_at
+
+    @classmethod
+    def get_last_active_at(cls, user_id):
+        conn = RedisClient.get_connection()
+        return conn.zscore(USER_LAST_ACTIVE_KEY, user_id)
+
+    @classmethod
+    def filter_active_user_ids(cls, user_ids, window=USER_ACTIVE_WINDOW):
+        """
+        返回 user_ids 中在 window 秒内活跃过的 user ids，保持原有顺序
+        用 pipeline 一次 round trip 查询所有 users
+        没有活跃记录的 user 当作活跃的：打开 switch 之前的用户都还没有被记录过，
+        不能在他们下一次访问之前全部跳过 fanout，只有记录过并且超过 window 没有活跃的才算不活跃
+        """
+        if not user_ids:
+            return []
+
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline()
+        for user_id in user_ids:
+            pipe.zscore(USER_LAST_ACTIVE_KEY, user_id)
+        last_active_ats = pipe.execute()
+
+        active_since = time.time() - window
+        return [
+            user_id
+            for user_id, last_active_at in zip(user_ids, last_active_ats)
+            if last_active_at is None or last_active_at >= active_since
+        ]
@@ -1,12 +1,54 @@
+from django.db import models
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from accounts.api.serializers import UserSerializerForComment
+from accounts.services import UserService
 from comments.models import Comment
 from likes.services import LikeService
 from tweets.models import Tweet
 
 
+class CommentListSerializer(serializers.ListSerializer):
+    """
+    many=True 时使用的 serializer
+    在逐条 serialize 之前，批量 load 每个 comment 需要的 user, profile, likes_count 和 has_liked，
+    把每条 comment 3~4 次的 db / cache 访问变成整页一共 4 次
+    """
+
+    def to_representation(self, data):
+        comments = data.all() if isinstance(data, models.Manager) else data
+        comments = list(comments)
+        self._preload(comments)
+        return super(CommentListSerializer, self).to_representation(comments)
+
+    def _preload(self, comments):
+        if not comments:
+            return
+
+        comment_ids = [comment.id for comment in comments]
+        users = UserService.get_users_with_profiles_through_cache(
+            [comment.user_id for comment in comments],
+        )
+        likes_count_map = LikeService.get_likes_count_map(Comment, comment_ids)
+        request = self.context.get('request')
+        if request is not None:
+            liked_comment_ids = LikeService.get_liked_object_ids(
+                request.user,
+                Comment,
+                comment_ids,
+            )
+        else:
+            liked_comment_ids = set()
+
+        # 存在 instance level 的 cache 里，CommentSerializer 会优先使用
+        for comment in comments:
+            if comment.user_id in users:
+                setattr(comment, '_cached_user', users[comment.user_id])
+            setattr(comment, '_likes_count', likes_count_map.get(comment.id, 0))
+            setattr(comment, '_has_liked', comment.id in liked_comment_ids)
+
+
 class CommentSerializer(serializers.ModelSerializer):
     user = UserSerializerForComment(source='cached_user')  # 若不加这行，下面 fields 中的 user 会以 id 的形式显示
     likes_count = serializers.SerializerMethodField()
@@ -14,6 +56,7 @@ class CommentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Comment
+        list_serializer_class = CommentListSerializer
         fields = (
             'id',
             'tweet_id',
@@ -28,12 +71,16 @@ class CommentSerializer(serializers.ModelSerializer):
         """
         查看有多少人点赞了当前 object (comment)
         """
+        if hasattr(obj, '_likes_count'):
+            return obj._likes_count
         return obj.like_set.count()  # like_set为自定义的 Comment 的 property
 
     def get_has_liked(self, obj):
         """
         查看当前登录的用户是否赞过这个 object (comment)
         """
+        if hasattr(obj, '_has_liked'):
+            return obj._has_liked
         return LikeService.has_liked(user=self.context['request'].user, target=obj)
 
 class CommentSerializerForCreate(serializers.ModelSerializer):
@@ -4,6 +4,7 @@ from rest_framework import status
 from comments.models import Comment
 from testing.testcases import TestCase
 from rest_framework.test import APIClient
+from utils.paginations import EndlessPagination
 
 COMMENT_URL = '/api/comments/'
 COMMENT_DETAIL_URL = '/api/comments/{}/'
@@ -124,7 +125,7 @@ class CommentApiTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data['comments']), 0)
 
-        # 验证评论按照时间顺序排序
+        # 验证评论按照时间倒序排序
         self.create_comment(self.lisa, self.tweet, '1')
         self.create_comment(self.emma, self.tweet, '2')
         self.create_comment(self.emma, self.create_tweet(self.emma), '3')
@@ -132,8 +133,9 @@ class CommentApiTests(TestCase):
             'tweet_id': self.tweet.id,
         })
         self.assertEqual(len(response.data['comments']), 2)
-        self.assertEqual(response.data['comments'][0]['content'], '1')
-        self.assertEqual(response.data['comments'][1]['content'], '2')
+        self.assertEqual(response.data['comments'][0]['content'], '2')
+        self.assertEqual(response.data['comments'][1]['content'], '1')
+        self.assertEqual(response.data['has_next_page'], False)
 
         # 验证同时提供 user_id 和 tweet_id 只有 tweet_id 会在 filter 中生效
         response = self.anonymous_client.get(COMMENT_URL, {
@@ -200,3 +202,39 @@ class CommentApiTests(TestCase):
         self.assertEqual(response.data['comments_count'], 2)
         self.tweet.refresh_from_db()
         self.assertEqual(self.tweet.comments_count, 2)
+
+    def test_list_pagination(self):
+        page_size = EndlessPagination.page_size
+        comments = [
+            self.create_comment(self.emma, self.tweet, 'comment{}'.format(i))
+            for i in range(page_size * 2)
+        ]
+        comments = comments[::-1]
+
+        # pull the first page
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(len(response.data['comments']), page_size)
+        self.assertEqual(response.data['comments'][0]['id'], comments[0].id)
+        self.assertEqual(response.data['comments'][page_size - 1]['id'], comments[page_size - 1].id)
+
+        # pull the second page
+        response = self.anonymous_client.get(COMMENT_URL, {
+            'tweet_id': self.tweet.id,
+            'created_at__lt': comments[page_size - 1].created_at,
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(len(response.data['comments']), page_size)
+        self.assertEqual(response.data['comments'][0]['id'], comments[page_size].id)
+        self.assertEqual(response.data['comments'][page_size - 1]['id'], comments[-1].id)
+
+        # deleted comment is removed from the cached list
+        response = self.emma_client.delete(COMMENT_DETAIL_URL.format(comments[0].id))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.data['comments'][0]['id'], comments[1].id)
+
+        # updated comment is reflected in the list
+        self.emma_client.put(COMMENT_DETAIL_URL.format(comments[1].id), {'content': 'updated'})
+        response = self.anonymous_client.get(COMMENT_URL, {'tweet_id': self.tweet.id})
+        self.assertEqual(response.data['comments'][0]['content'], 'updated')
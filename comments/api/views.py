@@ -1,5 +1,4 @@
 from django.utils.decorators import method_decorator
-from ratelimit.decorators import ratelimit
 from rest_framework import viewsets, status
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.request import Request
@@ -12,8 +11,11 @@ from comments.api.serializers import (
     CommentSerializer,
 )
 from comments.models import Comment
+from comments.services import CommentService
 from inbox.services import NotificationService
 from utils.decorators import required_params
+from utils.paginations import EndlessPagination
+from utils.ratelimit import ratelimit
 
 
 class CommentViewSet(viewsets.GenericViewSet):
@@ -24,6 +26,7 @@ class CommentViewSet(viewsets.GenericViewSet):
     serializer_class = CommentSerializerForCreate
     queryset = Comment.objects.all()
     filterset_fields = ('tweet_id',)  # 用 filterset_fields去filter queryset
+    pagination_class = EndlessPagination
 
     def get_permissions(self):
         # 注意要加用 AllowAny() / IsAuthenticated() 实例化出对象
@@ -39,24 +42,39 @@ class CommentViewSet(viewsets.GenericViewSet):
     def list(self, request: Request):
         """
         重载 list 方法，不列出所有 comments，
-        必须要求指定 tweet_id 作为筛选条件，列出某 tweet 下的所有 comments
+        必须要求指定 tweet_id 作为筛选条件，按照 created_at 倒序分页列出某 tweet 下的 comments
         GET /api/comments/?tweet_id=xxx
+        GET /api/comments/?tweet_id=xxx&created_at__lt=xxx
         """
-        # tweet_id = request.query_params['tweet_id']
-        # comments = Comment.objects.filter(tweet_id=tweet_id).order_by('created_at')
+        tweet_id = request.query_params['tweet_id']
+        if not tweet_id.isdigit():
+            return Response({
+                'message': 'Please check input',
+                'errors': {'tweet_id': 'tweet_id should be an integer'},
+            }, status=status.HTTP_400_BAD_REQUEST)
 
-        # 使用 django-filter
+        # 热门 tweet 可能有上万条 comments，不能一次性全部取出
+        # 先从 redis 里的 comments list 中翻页，翻出 cache 的范围之后再去数据库里查询剩下的部分
+        cached_comments = CommentService.get_cached_comments(int(tweet_id))
+        paginator = self.paginator
+        # 使用 django-filter，queryset 是 lazy 的，只有翻出 cache 的范围才会真正查询
         queryset = self.get_queryset()  # 取到被 filter 后的 queryset
-        comments = self.filter_queryset(queryset=queryset)\
-            .prefetch_related('user')\
-            .order_by('created_at')
+        queryset = self.filter_queryset(queryset=queryset)
+        page = paginator.paginate_cached_list(
+            cached_comments,
+            request,
+            paginator.queryset_loader(queryset),
+        )
+
         serializer = CommentSerializer(
-            instance=comments,
+            instance=page,
             context={'request': request},
             many=True,
         )
 
         return Response({
+            'has_next_page': paginator.has_next_page,
+            'next_cursor': paginator.next_cursor,
             'comments': serializer.data,
         }, status=status.HTTP_200_OK)
 
@@ -25,3 +25,20 @@ def decr_comments_count(sender, instance, **kwargs):
     Tweet.objects.filter(id=instance.tweet_id)\
         .update(comments_count=F('comments_count') - 1)
     RedisHelper.decr_count(instance.tweet, 'comments_count')
+
+
+def push_comment_to_cache(sender, instance, created, **kwargs):
+    from comments.services import CommentService
+
+    if created:
+        CommentService.push_comment_to_cache(instance)
+        return
+
+    # comment 被修改过，cache 里的内容已经过期了
+    # 修改是低频操作，直接失效 key，下次访问时重新 load
+    CommentService.invalidate_cached_comments(instance.tweet_id)
+
+
+def remove_comment_from_cache(sender, instance, **kwargs):
+    from comments.services import CommentService
+    CommentService.remove_comment_from_cache(instance)
@@ -1,11 +1,16 @@
 from django.contrib.auth.models import User
-from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.db.models.signals import post_save, pre_delete
 
-from comments.listeners import incr_comments_count, decr_comments_count
+from comments.listeners import (
+    decr_comments_count,
+    incr_comments_count,
+    push_comment_to_cache,
+    remove_comment_from_cache,
+)
 from likes.models import Like
 from tweets.models import Tweet
+from utils.content_type_helper import ContentTypeHelper
 from utils.memcached_helper import MemcachedHelper
 
 
@@ -35,14 +40,19 @@ class Comment(models.Model):
     @property
     def like_set(self):
         return Like.objects.filter(
-            content_type=ContentType.objects.get_for_model(Comment),
+            content_type_id=ContentTypeHelper.get_content_type_id(Comment),
             object_id=self.id,
-        ).order_by('-created_at')
+        ).order_by('-created_at', '-id')
 
     @property
     def cached_user(self):
+        # 批量 load 过的 user 会放在 instance level 的 cache 里
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
 
 post_save.connect(incr_comments_count, sender=Comment)
 pre_delete.connect(decr_comments_count, sender=Comment)
+post_save.connect(push_comment_to_cache, sender=Comment)
+pre_delete.connect(remove_comment_from_cache, sender=Comment)
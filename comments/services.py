@@ -0,0 +1,42 @@
+from comments.models import Comment
+from twitter.cache import TWEET_COMMENTS_PATTERN
+from utils.redis_helper import RedisHelper
+
+
+def lazy_load_comments(tweet_id):
+    def _lazy_load(limit):
+        # 会用到 tweet 和 created_at 的联合索引
+        return Comment.objects.filter(tweet_id=tweet_id).order_by('-created_at', '-id')[:limit]
+    return _lazy_load
+
+
+class CommentService:
+
+    @classmethod
+    def get_cached_comments(cls, tweet_id, limit=None):
+        # cache 里按照 created_at 倒序存储，与 EndlessPagination 的翻页顺序一致
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id)
+        return RedisHelper.load_objects(
+            key=key,
+            lazy_load_func=lazy_load_comments(tweet_id),
+            limit=limit,
+        )
+
+    @classmethod
+    def push_comment_to_cache(cls, comment):
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=comment.tweet_id)
+        RedisHelper.push_object(
+            key=key,
+            obj=comment,
+            lazy_load_func=lazy_load_comments(comment.tweet_id),
+        )
+
+    @classmethod
+    def remove_comment_from_cache(cls, comment):
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=comment.tweet_id)
+        RedisHelper.remove_object(key=key, obj=comment)
+
+    @classmethod
+    def invalidate_cached_comments(cls, tweet_id):
+        key = TWEET_COMMENTS_PATTERN.format(tweet_id=tweet_id)
+        RedisHelper.invalidate_objects(key)
@@ -1,3 +1,4 @@
+from comments.services import CommentService
 from testing.testcases import TestCase
 
 
@@ -26,3 +27,35 @@ class CommentModelTests(TestCase):
         emma = self.create_user('emma')
         self.create_like(user=emma, target=self.comment)
         self.assertEqual(self.comment.like_set.count(), 2)
+
+
+class CommentServiceTests(TestCase):
+
+    def setUp(self):
+        super(CommentServiceTests, self).setUp()
+        self.lisa = self.create_user('lisa')
+        self.tweet = self.create_tweet(user=self.lisa)
+
+    def test_get_cached_comments(self):
+        comments = [self.create_comment(self.lisa, self.tweet, str(i)) for i in range(3)]
+
+        # cache miss
+        cached_comments = CommentService.get_cached_comments(self.tweet.id)
+        self.assertEqual([c.id for c in cached_comments], [c.id for c in comments[::-1]])
+
+        # cache hit
+        cached_comments = CommentService.get_cached_comments(self.tweet.id)
+        self.assertEqual([c.id for c in cached_comments], [c.id for c in comments[::-1]])
+
+        # cache updated
+        new_comment = self.create_comment(self.lisa, self.tweet, 'new')
+        cached_comments = CommentService.get_cached_comments(self.tweet.id)
+        self.assertEqual(cached_comments[0].id, new_comment.id)
+
+        # removed from cache when deleted
+        comments[1].delete()
+        cached_comments = CommentService.get_cached_comments(self.tweet.id)
+        self.assertEqual(
+            [c.id for c in cached_comments],
+            [new_comment.id, comments[2].id, comments[0].id],
+        )
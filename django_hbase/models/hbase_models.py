@@ -220,6 +220,15 @@ class HBaseModel:
         table = cls.get_table()
         return table.delete(row_key)
 
+    @classmethod
+    def batch_delete(cls, batch_data):
+        # batch_data 是 row key 的 dict 的列表，所有的删除在一次 batch 里发送
+        table = cls.get_table()
+        batch = table.batch()
+        for data in batch_data:
+            batch.delete(cls.serialize_row_key(data))
+        batch.send()
+
     @classmethod
     def create_table(cls):
         if not settings.TESTING:
@@ -1,22 +1,20 @@
-from rest_framework.pagination import PageNumberPagination
-from rest_framework.response import Response
+from utils.paginations import EndlessPagination
 
 
-class FriendshipPagination(PageNumberPagination):
-    # 默认的 page size，也就是 url 参数列表中没有 page 参数里的时候
-    page_size = 20
-    # 默认的 page_size_query_param 是 None 表示不允许客户端指定每一页的大小
-    # 如果加上这个配置，就表示客户端可以通过 size=10 来指定一个特定的大小用于不同的场景
-    # 比如手机端和web端访问同一个API但是需要的 size 大小是不同的。
-    page_size_query_param = 'size'
-    # 允许客户端指定的最大 page_size 是多少，避免出现指定出 1000 这样的数字
-    max_page_size = 20
+class FriendshipPagination(EndlessPagination):
+    """
+    粉丝 / 关注列表的翻页
+    明星用户的粉丝很多，PageNumberPagination 每一页都要 COUNT(*) 一次，并且 OFFSET 越翻越慢
+    这里沿用 EndlessPagination 的 cursor (created_at, id) 翻页，
+    mysql 里走 (to_user, created_at) / (from_user, created_at) 的联合索引，不需要 OFFSET
+    total_results 由 view 从 redis 的计数里取出来设置，不需要每一页都 count
+    """
+
+    def __init__(self):
+        super(FriendshipPagination, self).__init__()
+        self.total_results = None
 
     def get_paginated_response(self, data):
-        return Response({
-            'total_results': self.page.paginator.count,
-            'total_pages': self.page.paginator.num_pages,
-            'page_number': self.page.number,
-            'has_next_page': self.page.has_next(),
-            'results': data,
-        })
+        response = super(FriendshipPagination, self).get_paginated_response(data)
+        response.data['total_results'] = self.total_results
+        return response
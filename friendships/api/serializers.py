@@ -8,6 +8,25 @@ from friendships.models import Friendship
 from friendships.services import FriendshipService
 
 
+class FriendshipListSerializer(serializers.ListSerializer):
+    """
+    many=True 时使用的 serializer
+    在逐条 serialize 之前，用一次 SMISMEMBER 批量查出当前登录用户关注了这一页里的哪些用户
+    """
+
+    def to_representation(self, data):
+        friendships = list(data)
+        request = self.context.get('request')
+        if request is not None and request.user.is_authenticated:
+            user_ids = [self.child.get_user_id(friendship) for friendship in friendships]
+            self.child._followed_user_ids = set(
+                FriendshipService.get_followed_user_ids(request.user.id, user_ids),
+            )
+        else:
+            self.child._followed_user_ids = set()
+        return super(FriendshipListSerializer, self).to_representation(friendships)
+
+
 class BaseFriendshipSerializer(serializers.Serializer):
     user = serializers.SerializerMethodField()
     created_at = serializers.SerializerMethodField()
@@ -22,26 +41,17 @@ class BaseFriendshipSerializer(serializers.Serializer):
     def get_user_id(self, obj):
         raise NotImplementedError
 
-    def _get_following_user_id_set(self):
-        """
-        通过一次的 cache 访问将当前登录用户的 following user id 存进 object level 的内存中，
-        甚至都无需访问 memcached 的 cache
-
-        object level cache: 存在进程的内存中
-        当一个 HTTP request 的请求结束后，该空间会被释放掉
-        """
-        if self.context['request'].user.is_anonymous:
-            return {}
-        if hasattr(self, '_cached_following_user_id_set'):
-            return self._cached_following_user_id_set
-        user_id_set = FriendshipService.get_following_user_id_set(
-            self.context['request'].user.id,
-        )
-        setattr(self, '_cached_following_user_id_set', user_id_set)
-        return user_id_set
+    class Meta:
+        list_serializer_class = FriendshipListSerializer
 
     def get_has_followed(self, obj):
-        return self.get_user_id(obj) in self._get_following_user_id_set()
+        # many=True 的时候已经由 FriendshipListSerializer 批量查好了
+        if hasattr(self, '_followed_user_ids'):
+            return self.get_user_id(obj) in self._followed_user_ids
+        request = self.context['request']
+        if request.user.is_anonymous:
+            return False
+        return FriendshipService.has_followed(request.user.id, self.get_user_id(obj))
 
     def get_user(self, obj):
         user = UserService.get_user_by_id(self.get_user_id(obj))
@@ -210,6 +210,7 @@ class FriendshipApiTests(TestCase):
         # 默认的第一页
         response = self.anonymous_client.get(url)
         results.extend(response.data['results'])
+        self.assertEqual(response.data['total_results'], len(friendships))
 
         pages += 1
         while response.data['has_next_page']:
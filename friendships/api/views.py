@@ -1,12 +1,12 @@
 from django.contrib.auth.models import User
 from django.utils.decorators import method_decorator
-from ratelimit.decorators import ratelimit
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.request import Request
 from rest_framework.response import Response
 
+from friendships.api.paginations import FriendshipPagination
 from friendships.api.serializers import (
     FollowerSerializer,
     FollowingSerializer, FriendshipSerializerForCreate,
@@ -15,7 +15,7 @@ from friendships.models.hbase_friendship import HBaseFollower, HBaseFollowing
 from friendships.models import Friendship
 from friendships.services import FriendshipService
 from gatekeeper.models import GateKeeper
-from utils.paginations import EndlessPagination
+from utils.ratelimit import ratelimit
 
 
 class FriendshipViewSet(viewsets.GenericViewSet):
@@ -23,7 +23,7 @@ class FriendshipViewSet(viewsets.GenericViewSet):
     queryset = User.objects.all()
     serializer_class = FriendshipSerializerForCreate
     # 一般来说，不同的 views 所需要的 pagination 规则肯定是不同的，因此一般都需要自定义
-    pagination_class = EndlessPagination
+    pagination_class = FriendshipPagination
 
     @action(methods=['GET'], detail=True, permission_classes=[AllowAny])
     @method_decorator(ratelimit(key='user_or_ip', rate='3/s', method='GET', block=True))
@@ -37,8 +37,9 @@ class FriendshipViewSet(viewsets.GenericViewSet):
             page = paginator.paginate_hbase(HBaseFollower, (pk,), request)
         else:
             friendships = Friendship.objects.filter(to_user_id=pk)\
-                .order_by('-created_at')
+                .order_by('-created_at', '-id')
             page = paginator.paginate_queryset(queryset=friendships, request=request)
+        paginator.total_results = FriendshipService.get_cached_follower_count(pk)
 
         serializer = FollowerSerializer(
             instance=page,
@@ -59,8 +60,10 @@ class FriendshipViewSet(viewsets.GenericViewSet):
             page = paginator.paginate_hbase(HBaseFollowing, (pk,), request)
         else:
             friendships = Friendship.objects.filter(from_user_id=pk)\
-                .order_by('-created_at')
+                .order_by('-created_at', '-id')
             page = paginator.paginate_queryset(queryset=friendships, request=request)
+        # followings 缓存在 redis 的 set 里，SCARD 就是总数
+        paginator.total_results = FriendshipService.get_following_count(pk)
 
         serializer = FollowingSerializer(
             instance=page,
@@ -0,0 +1,9 @@
+from utils.time_constants import ONE_HOUR
+
+# redis 里的粉丝数最多缓存这么久，过期之后重新 count 一次，修正可能累积的误差
+FOLLOWERS_COUNT_RECONCILE_INTERVAL = ONE_HOUR
+
+# 没有缓存的粉丝数时，只有拿到锁的 request 去 count，其他的 request 等待结果
+# 明星用户的 hbase scan 比较慢，锁的过期时间需要覆盖一次 count
+FOLLOWERS_COUNT_LOCK_TIMEOUT = 30
+FOLLOWERS_COUNT_LOCK_POLL_INTERVAL = 0.05
@@ -1,4 +1,15 @@
-def friendship_changed(sender, instance, **kwargs):
+def push_following_to_cache(sender, instance, created, **kwargs):
+    if not created:
+        return
+
     # import 写在函数里面避免循环依赖
     from friendships.services import FriendshipService
-    FriendshipService.invalidate_following_cache(instance.from_user_id)
+    FriendshipService.add_following_to_cache(instance.from_user_id, instance.to_user_id)
+    FriendshipService.incr_follower_count(instance.to_user_id, 1)
+
+
+def remove_following_from_cache(sender, instance, **kwargs):
+    # import 写在函数里面避免循环依赖
+    from friendships.services import FriendshipService
+    FriendshipService.remove_following_from_cache(instance.from_user_id, instance.to_user_id)
+    FriendshipService.incr_follower_count(instance.to_user_id, -1)
@@ -0,0 +1,100 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from friendships.models import Friendship, HBaseFollower, HBaseFollowing
+from utils.hbase_backfill import HBaseBackfill
+from utils.time_helpers import datetime_to_timestamp
+
+
+def friendship_to_rows(row):
+    _, from_user_id, to_user_id, created_at = row
+    # user 被删除之后外键会被 SET_NULL，这样的 friendship 不需要复制
+    if from_user_id is None or to_user_id is None:
+        return []
+
+    data = {
+        'from_user_id': from_user_id,
+        'to_user_id': to_user_id,
+        'created_at': datetime_to_timestamp(created_at),
+    }
+    return [(HBaseFollower, data), (HBaseFollowing, data)]
+
+
+class Command(BaseCommand):
+    """
+    把 mysql 里的 friendships 复制到 hbase 的 followers 和 followings 两张表里
+        python manage.py backfill_friendships_to_hbase --workers=8 --rows-per-second=20000
+    中断之后重新执行会从 checkpoint 继续，--restart 从头开始
+    复制完成之后用 --verify 按照 user 区间比较 mysql 和 hbase 里的行数，
+    确认一致之后再打开 switch_friendship_to_hbase
+    """
+    help = 'Backfill friendships from MySQL to HBase followers / followings tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--rows-per-second', type=int, default=None)
+        parser.add_argument('--restart', action='store_true')
+        parser.add_argument('--verify', action='store_true')
+        parser.add_argument('--verify-only', action='store_true')
+        # 全量比较太慢的时候，只随机抽查一部分 users，比如 0.01
+        parser.add_argument('--verify-sample-rate', type=float, default=None)
+
+    def handle(self, *args, **options):
+        backfill = HBaseBackfill(
+            name='friendships',
+            queryset=Friendship.objects.all(),
+            fields=('from_user_id', 'to_user_id', 'created_at'),
+            to_rows=friendship_to_rows,
+            page_size=options['page_size'],
+            workers=options['workers'],
+            rows_per_second=options['rows_per_second'],
+            log=self.stdout.write,
+        )
+        if not options['verify_only']:
+            if options['restart']:
+                backfill.reset_checkpoints()
+            backfill.run()
+
+        if options['verify'] or options['verify_only']:
+            self._verify(backfill, options['verify_sample_rate'])
+
+    def _verify(self, backfill, sample_rate):
+        mismatches = backfill.verify_counts(
+            User.objects.order_by('id').values_list('id', flat=True).iterator(),
+            get_mysql_counts=lambda ids: self._get_mysql_counts('from_user_id', ids),
+            get_hbase_count=lambda conn, user_id: backfill.count_hbase_rows(
+                conn,
+                HBaseFollowing,
+                (user_id, None),
+            ),
+            sample_rate=sample_rate,
+        )
+        mismatches += backfill.verify_counts(
+            User.objects.order_by('id').values_list('id', flat=True).iterator(),
+            get_mysql_counts=lambda ids: self._get_mysql_counts('to_user_id', ids),
+            get_hbase_count=lambda conn, user_id: backfill.count_hbase_rows(
+                conn,
+                HBaseFollower,
+                (user_id, None),
+            ),
+            sample_rate=sample_rate,
+        )
+        for user_id, mysql_count, hbase_count in mismatches:
+            self.stdout.write('user {}: mysql {} rows, hbase {} rows'.format(
+                user_id,
+                mysql_count,
+                hbase_count,
+            ))
+        self.stdout.write('{} mismatches found'.format(len(mismatches)))
+
+    def _get_mysql_counts(self, user_field, user_ids):
+        counts = Friendship.objects.filter(
+            **{'{}__in'.format(user_field): user_ids},
+        ).exclude(
+            from_user_id=None,
+        ).exclude(
+            to_user_id=None,
+        ).values(user_field).annotate(count=Count('id'))
+        return {item[user_field]: item['count'] for item in counts}
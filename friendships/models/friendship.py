@@ -3,7 +3,7 @@ from django.db import models
 
 from django.db.models.signals import pre_delete, post_save
 
-from friendships.listeners import friendship_changed
+from friendships.listeners import push_following_to_cache, remove_following_from_cache
 from utils.memcached_helper import MemcachedHelper
 
 
@@ -44,6 +44,6 @@ class Friendship(models.Model):
         return MemcachedHelper.get_object_through_cache(User, self.to_user_id)
 
 
-# hook up with listeners to invalidate cache
-pre_delete.connect(friendship_changed, sender=Friendship)
-post_save.connect(friendship_changed, sender=Friendship)
+# hook up with listeners to update cache
+pre_delete.connect(remove_following_from_cache, sender=Friendship)
+post_save.connect(push_following_to_cache, sender=Friendship)
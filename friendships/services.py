@@ -1,13 +1,35 @@
 import time
 
 from django.conf import settings
-from django.core.cache import caches
 
+from friendships.constants import (
+    FOLLOWERS_COUNT_LOCK_POLL_INTERVAL,
+    FOLLOWERS_COUNT_LOCK_TIMEOUT,
+    FOLLOWERS_COUNT_RECONCILE_INTERVAL,
+)
 from friendships.models import Friendship, HBaseFollower, HBaseFollowing
+from friendships.tasks import reconcile_follower_count_task
 from gatekeeper.models import GateKeeper
-from twitter.cache import FOLLOWINGS_PATTERN
+from twitter.cache import (
+    USER_FOLLOWERS_COUNT_FRESH_PATTERN,
+    USER_FOLLOWERS_COUNT_LOCK_PATTERN,
+    USER_FOLLOWERS_COUNT_PATTERN,
+    USER_FOLLOWINGS_PATTERN,
+)
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+from utils.time_constants import MAX_TIMESTAMP
 
-cache = caches['testing'] if settings.TESTING else caches['default']
+
+def lazy_load_following_ids(from_user_id):
+    def _lazy_load():
+        if GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            friendships = HBaseFollowing.filter(prefix=(from_user_id, None))
+            return [friendship.to_user_id for friendship in friendships]
+        return Friendship.objects.filter(
+            from_user_id=from_user_id,
+        ).values_list('to_user_id', flat=True)
+    return _lazy_load
 
 
 class FriendshipService:
@@ -33,26 +55,166 @@ class FriendshipService:
         return [friendship.from_user_id for friendship in friendships]
 
     @classmethod
-    def get_following_user_id_set(cls, from_user_id):
-        # TODO: cache in redis set
+    def iterate_follower_id_pages(cls, to_user_id, page_size, cursor=None):
+        """
+        按照 page_size 分页地扫描 follower ids，每次 yield 一页
+        内存里最多只有一页的数据，调用方拿到第一页就可以开始处理，不用等全部扫描完
+        """
+        pages = cls.iterate_follower_id_pages_with_cursor(to_user_id, page_size, cursor)
+        for follower_ids, _ in pages:
+            yield follower_ids
+
+    @classmethod
+    def iterate_follower_id_pages_with_cursor(cls, to_user_id, page_size, cursor=None):
+        """
+        yield (follower_ids, cursor)，cursor 是这一页最后一行的 keyset，
+        mysql 里是 friendship 的 id，hbase 里是 created_at
+        把 cursor 传回来可以从这一页之后继续扫描，中间有 follow / unfollow 也不会跳过或者重复
+        """
         if GateKeeper.is_switch_on('switch_friendship_to_hbase'):
-            friendships = HBaseFollowing.filter(prefix=(from_user_id, None))
-        else:
-            friendships = Friendship.objects.filter(from_user_id=from_user_id)
+            return cls._iterate_hbase_follower_id_pages(to_user_id, page_size, cursor)
+        return cls._iterate_mysql_follower_id_pages(to_user_id, page_size, cursor)
+
+    @classmethod
+    def _iterate_hbase_follower_id_pages(cls, to_user_id, page_size, cursor=None):
+        # row key 是 to_user_id + created_at，同一个 to_user_id 下的 created_at 不会重复
+        # 下一页从上一页最后一个 created_at + 1 开始 scan
+        start = (to_user_id, None if cursor is None else cursor + 1)
+        stop = (to_user_id, MAX_TIMESTAMP)
+        while True:
+            followers = HBaseFollower.filter(start=start, stop=stop, limit=page_size)
+            if followers:
+                yield [follower.from_user_id for follower in followers], followers[-1].created_at
+            if len(followers) < page_size:
+                return
+            start = (to_user_id, followers[-1].created_at + 1)
+
+    @classmethod
+    def _iterate_mysql_follower_id_pages(cls, to_user_id, page_size, cursor=None):
+        # keyset pagination: 用 id > last_id 代替 offset，每一页的查询代价都一样
+        last_id = cursor or 0
+        while True:
+            rows = list(
+                Friendship.objects.filter(to_user_id=to_user_id, id__gt=last_id)
+                .order_by('id')
+                .values_list('id', 'from_user_id')[:page_size]
+            )
+            if rows:
+                yield [from_user_id for _, from_user_id in rows], rows[-1][0]
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1][0]
 
-        user_id_set = set([
-            friendship.to_user_id
-            for friendship in friendships
-        ])
-        return user_id_set
+    @classmethod
+    def get_follower_count(cls, to_user_id, limit=None):
+        """
+        limit: 只需要知道粉丝数是否达到 limit 的时候，数到 limit 就停下
+        """
+        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
+            friendships = Friendship.objects.filter(to_user_id=to_user_id)
+            if limit is not None:
+                friendships = friendships[:limit]
+            return friendships.count()
+
+        count = 0
+        for page, _ in cls._iterate_hbase_follower_id_pages(to_user_id, page_size=1000):
+            count += len(page)
+            if limit is not None and count >= limit:
+                return limit
+        return count
+
+    @classmethod
+    def get_cached_follower_count(cls, to_user_id):
+        """
+        粉丝列表上显示的总数，明星用户的粉丝数很多，不能每次都 COUNT(*) 或者 scan 一遍
+        redis 里没有的时候 count 一次，follow / unfollow 的时候增量更新
+        - 每 FOLLOWERS_COUNT_RECONCILE_INTERVAL 在后台重新 count 一次，修正误差，这期间先用旧的值
+        - 完全没有 cache 的时候，只有拿到锁的 request 去 count，避免热门用户的 cache 失效时大量并发 count
+        """
+        key = USER_FOLLOWERS_COUNT_PATTERN.format(user_id=to_user_id)
+        fresh_key = USER_FOLLOWERS_COUNT_FRESH_PATTERN.format(user_id=to_user_id)
+        conn = RedisClient.get_connection()
+        pipeline = conn.pipeline(transaction=False)
+        pipeline.get(key)
+        # fresh 标记过期之后只有第一个 request 能设置成功，由它安排后台的 reconcile
+        pipeline.set(fresh_key, 1, nx=True, ex=FOLLOWERS_COUNT_RECONCILE_INTERVAL)
+        count, needs_reconcile = pipeline.execute()
+        if count is not None:
+            if needs_reconcile:
+                reconcile_follower_count_task.delay(to_user_id)
+            return int(count)
+
+        lock_key = USER_FOLLOWERS_COUNT_LOCK_PATTERN.format(user_id=to_user_id)
+        if not conn.set(lock_key, 1, nx=True, ex=FOLLOWERS_COUNT_LOCK_TIMEOUT):
+            # 别的 request 正在 count，等它写入 cache
+            deadline = time.time() + FOLLOWERS_COUNT_LOCK_TIMEOUT
+            while time.time() < deadline:
+                time.sleep(FOLLOWERS_COUNT_LOCK_POLL_INTERVAL)
+                count = conn.get(key)
+                if count is not None:
+                    return int(count)
+        try:
+            return cls.reconcile_follower_count(to_user_id)
+        finally:
+            conn.delete(lock_key)
+
+    @classmethod
+    def reconcile_follower_count(cls, to_user_id):
+        # 计数本身的过期时间和其他的 cache 一样，reconcile 由 fresh 标记控制
+        count = cls.get_follower_count(to_user_id)
+        conn = RedisClient.get_connection()
+        conn.set(USER_FOLLOWERS_COUNT_PATTERN.format(user_id=to_user_id), count, ex=settings.REDIS_KEY_EXPIRE_TIME)
+        return count
+
+    @classmethod
+    def incr_follower_count(cls, to_user_id, amount):
+        # cache 里没有的时候不需要修改，下次读取时会重新 count
+        key = USER_FOLLOWERS_COUNT_PATTERN.format(user_id=to_user_id)
+        RedisHelper.incr_if_exists(key, amount)
+
+    @classmethod
+    def get_following_user_id_set(cls, from_user_id):
+        # followings 存在 redis 的 set 里，follow / unfollow 的时候增量更新，没有 cache 的时候再重建
+        key = USER_FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        return RedisHelper.load_set_members(key, lazy_load_following_ids(from_user_id))
+
+    @classmethod
+    def get_followed_user_ids(cls, from_user_id, to_user_ids):
+        """
+        返回 to_user_ids 里 from_user_id 关注了的那些，用于一页里批量判断 has_followed
+        """
+        key = USER_FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        return RedisHelper.filter_set_members(
+            key,
+            to_user_ids,
+            lazy_load_following_ids(from_user_id),
+        )
+
+    @classmethod
+    def get_followed_user_ids_in_set(cls, from_user_id, set_key):
+        """
+        返回 redis 的 set_key 里 from_user_id 关注了的那些 user ids，交集在 redis 里计算
+        """
+        key = USER_FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        return RedisHelper.intersect_set_members(key, set_key, lazy_load_following_ids(from_user_id))
+
+    @classmethod
+    def add_following_to_cache(cls, from_user_id, to_user_id):
+        key = USER_FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        RedisHelper.add_set_member(key, to_user_id)
+
+    @classmethod
+    def remove_following_from_cache(cls, from_user_id, to_user_id):
+        key = USER_FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        RedisHelper.remove_set_member(key, to_user_id)
 
     @classmethod
     def invalidate_following_cache(cls, from_user_id):
         """
         若数据库出现更新，为了防止并发导致的不一致性，一般直接失效 key
         """
-        key = FOLLOWINGS_PATTERN.format(user_id=from_user_id)
-        cache.delete(key)
+        key = USER_FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        RedisHelper.invalidate_objects(key)
 
     @classmethod
     def get_follow_instance(cls, from_user_id, to_user_id):
@@ -66,16 +228,7 @@ class FriendshipService:
     def has_followed(cls, from_user_id, to_user_id):
         if from_user_id == to_user_id:
             return False
-
-        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
-            # MySQL
-            return Friendship.objects.filter(
-                from_user_id=from_user_id,
-                to_user_id=to_user_id,
-            ).exists()
-
-        instance = cls.get_follow_instance(from_user_id, to_user_id)
-        return instance is not None
+        return bool(cls.get_followed_user_ids(from_user_id, [to_user_id]))
 
     @classmethod
     def follow(cls, from_user_id, to_user_id):
@@ -84,23 +237,31 @@ class FriendshipService:
 
         if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
             # create data in mysql
-            return Friendship.objects.create(
+            friendship = Friendship.objects.create(
+                from_user_id=from_user_id,
+                to_user_id=to_user_id,
+            )
+        else:
+            # create data in hbase
+            now = int(time.time() * 1000000)
+            HBaseFollower.create(
                 from_user_id=from_user_id,
                 to_user_id=to_user_id,
+                created_at=now,
             )
+            friendship = HBaseFollowing.create(
+                from_user_id=from_user_id,
+                to_user_id=to_user_id,
+                created_at=now,
+            )
+            # mysql 的 cache 由 listener 更新，hbase 没有 listener 需要手动更新
+            cls.add_following_to_cache(from_user_id, to_user_id)
+            cls.incr_follower_count(to_user_id, 1)
 
-        # create data in hbase
-        now = int(time.time() * 1000000)
-        HBaseFollower.create(
-            from_user_id=from_user_id,
-            to_user_id=to_user_id,
-            created_at=now,
-        )
-        return HBaseFollowing.create(
-            from_user_id=from_user_id,
-            to_user_id=to_user_id,
-            created_at=now,
-        )
+        # import 写在里面避免循环依赖
+        from newsfeeds.services import NewsFeedService
+        NewsFeedService.repair_newsfeeds_after_follow(from_user_id, to_user_id)
+        return friendship
 
     @classmethod
     def unfollow(cls, from_user_id, to_user_id):
@@ -120,22 +281,26 @@ class FriendshipService:
                 from_user_id=from_user_id,
                 to_user_id=to_user_id,
             ).delete()
-            return deleted
+        else:
+            # HBase
+            instance = cls.get_follow_instance(from_user_id, to_user_id)
+            if instance is None:
+                return 0
 
-        # HBase
-        instance = cls.get_follow_instance(from_user_id, to_user_id)
-        if instance is None:
-            return 0
+            HBaseFollowing.delete(from_user_id=from_user_id, created_at=instance.created_at)
+            HBaseFollower.delete(to_user_id=to_user_id, created_at=instance.created_at)
+            cls.remove_following_from_cache(from_user_id, to_user_id)
+            cls.incr_follower_count(to_user_id, -1)
+            deleted = 1
 
-        HBaseFollowing.delete(from_user_id=from_user_id, created_at=instance.created_at)
-        HBaseFollower.delete(to_user_id=to_user_id, created_at=instance.created_at)
-        return 1
+        if deleted:
+            # import 写在里面避免循环依赖
+            from newsfeeds.services import NewsFeedService
+            NewsFeedService.repair_newsfeeds_after_unfollow(from_user_id, to_user_id)
+        return deleted
 
     @classmethod
     def get_following_count(cls, from_user_id):
-        if not GateKeeper.is_switch_on('switch_friendship_to_hbase'):
-            # MySQL
-            return Friendship.objects.filter(from_user_id=from_user_id).count()
-        # HBase
-        followings = HBaseFollowing.filter(prefix=(from_user_id, None))
-        return len(followings)
+        # 直接用 SCARD 拿 cache 里 set 的大小，不需要 COUNT 或者 scan
+        key = USER_FOLLOWINGS_PATTERN.format(user_id=from_user_id)
+        return RedisHelper.get_set_size(key, lazy_load_following_ids(from_user_id))
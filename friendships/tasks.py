@@ -0,0 +1,12 @@
+from celery import shared_task
+
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def reconcile_follower_count_task(to_user_id):
+    # import 写在里面避免循环依赖
+    from friendships.services import FriendshipService
+
+    count = FriendshipService.reconcile_follower_count(to_user_id)
+    return 'follower count of user {} reconciled to {}'.format(to_user_id, count)
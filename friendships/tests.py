@@ -4,6 +4,8 @@ from django_hbase.models import BadRowKeyError, EmptyColumnError
 from friendships.models import HBaseFollowing, HBaseFollower
 from friendships.services import FriendshipService
 from testing.testcases import TestCase
+from twitter.cache import USER_FOLLOWERS_COUNT_FRESH_PATTERN, USER_FOLLOWERS_COUNT_PATTERN
+from utils.redis_client import RedisClient
 
 
 # Create your tests here.
@@ -32,6 +34,92 @@ class FriendshipServiceTests(TestCase):
         user_id_set = FriendshipService.get_following_user_id_set(self.lisa.id)
         self.assertSetEqual(user_id_set, {user1.id, user2.id})
 
+    def test_followings_cache(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        user_ids = [user.id for user in users]
+        self.assertEqual(FriendshipService.get_following_count(self.lisa.id), 0)
+        self.assertEqual(FriendshipService.get_followed_user_ids(self.lisa.id, user_ids), [])
+
+        # cache 已经存在，follow / unfollow 的时候增量更新
+        for user in users[:2]:
+            self.create_friendship(from_user=self.lisa, to_user=user)
+        self.assertEqual(FriendshipService.get_following_count(self.lisa.id), 2)
+        self.assertEqual(
+            FriendshipService.get_followed_user_ids(self.lisa.id, user_ids),
+            user_ids[:2],
+        )
+        self.assertEqual(FriendshipService.has_followed(self.lisa.id, users[0].id), True)
+
+        FriendshipService.unfollow(self.lisa.id, users[0].id)
+        self.assertEqual(FriendshipService.get_following_count(self.lisa.id), 1)
+        self.assertEqual(FriendshipService.has_followed(self.lisa.id, users[0].id), False)
+
+        # cache 失效之后重建
+        FriendshipService.invalidate_following_cache(self.lisa.id)
+        self.assertEqual(
+            FriendshipService.get_followed_user_ids(self.lisa.id, user_ids),
+            [users[1].id],
+        )
+        self.assertEqual(FriendshipService.get_following_user_id_set(self.lisa.id), {users[1].id})
+        self.assertEqual(FriendshipService.get_following_count(self.lisa.id), 1)
+
+    def test_cached_follower_count(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+        self.create_friendship(from_user=users[0], to_user=self.lisa)
+        self.assertEqual(FriendshipService.get_cached_follower_count(self.lisa.id), 1)
+
+        # cache 已经存在，follow / unfollow 的时候增量更新，不需要重新 count
+        for user in users[1:]:
+            self.create_friendship(from_user=user, to_user=self.lisa)
+        FriendshipService.unfollow(users[0].id, self.lisa.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(FriendshipService.get_cached_follower_count(self.lisa.id), 2)
+
+        # 没有 cache 的用户，follow 的时候不会创建 cache
+        self.create_friendship(from_user=self.lisa, to_user=self.emma)
+        self.assertEqual(FriendshipService.get_cached_follower_count(self.emma.id), 1)
+
+        # reconcile 的时间到了之后先返回旧的值，在后台重新 count
+        conn = RedisClient.get_connection()
+        conn.set(USER_FOLLOWERS_COUNT_PATTERN.format(user_id=self.lisa.id), 5)
+        conn.delete(USER_FOLLOWERS_COUNT_FRESH_PATTERN.format(user_id=self.lisa.id))
+        self.assertEqual(FriendshipService.get_cached_follower_count(self.lisa.id), 5)
+        self.assertEqual(FriendshipService.get_cached_follower_count(self.lisa.id), 2)
+
+    def test_iterate_follower_id_pages(self):
+        follower_ids = []
+        for i in range(5):
+            user = self.create_user('follower{}'.format(i))
+            self.create_friendship(from_user=user, to_user=self.lisa)
+            follower_ids.append(user.id)
+        self.create_friendship(from_user=self.lisa, to_user=self.emma)
+
+        pages = list(FriendshipService.iterate_follower_id_pages(self.lisa.id, page_size=2))
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(sorted(sum(pages, [])), sorted(follower_ids))
+
+        # 正好整页的时候最后会多一次空的查询，但不会 yield 空页
+        pages = list(FriendshipService.iterate_follower_id_pages(self.lisa.id, page_size=5))
+        self.assertEqual([len(page) for page in pages], [5])
+        pages = list(FriendshipService.iterate_follower_id_pages(self.emma.id, page_size=2))
+        self.assertEqual(pages, [[self.lisa.id]])
+
+        # 从上一页的 cursor 继续，中间新增的 follower 也能扫描到
+        first_page, cursor = next(FriendshipService.iterate_follower_id_pages_with_cursor(
+            self.lisa.id,
+            page_size=2,
+        ))
+        new_follower = self.create_user('new_follower')
+        self.create_friendship(from_user=new_follower, to_user=self.lisa)
+        pages = list(FriendshipService.iterate_follower_id_pages(self.lisa.id, 2, cursor))
+        self.assertEqual(
+            sorted(first_page + sum(pages, [])),
+            sorted(follower_ids + [new_follower.id]),
+        )
+
+        self.assertEqual(FriendshipService.get_follower_count(self.lisa.id), 6)
+        self.assertEqual(FriendshipService.get_follower_count(self.lisa.id, limit=3), 3)
+
 
 class HBaseTests(TestCase):
 
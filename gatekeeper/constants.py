@@ -0,0 +1,3 @@
+# 每个进程在内存里缓存 gatekeeper 的时间，过期之后一次 pipeline 重新 load 所有用到过的 gatekeeper
+# 也就是说 set_kv 修改之后，其他进程最多在这么多秒之后生效
+GATEKEEPER_LOCAL_CACHE_TTL = 5
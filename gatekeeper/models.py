@@ -1,29 +1,100 @@
+import hashlib
+import threading
+import time
+
+from gatekeeper.constants import GATEKEEPER_LOCAL_CACHE_TTL
 from utils.redis_client import RedisClient
 
 
 class GateKeeper:
+    """
+    is_switch_on 在一次 request 里会被调用很多次，fanout 的每个 batch 也会调用
+    所以每个进程在内存里缓存所有用到过的 gatekeeper，大部分时候只是 dict 的读取
+    - 缓存过期之后，由一个后台线程用一次 pipeline 把所有用到过的 gatekeeper 一起重新 load
+      request 不等待 redis，在新的结果替换进来之前继续读旧的缓存
+    - 本进程里 set_kv 之后马上生效，其他进程最多 GATEKEEPER_LOCAL_CACHE_TTL 秒之后生效
+    """
+    local_cache = {}
+    local_cache_loaded_at = 0
+    # set_kv 和 clear_local_cache 时加一，后台线程 load 期间本地有修改的话就丢掉 load 的结果
+    local_cache_version = 0
+    refresh_lock = threading.Lock()
+    refresh_thread = None
 
     @classmethod
-    def get(cls, gk_name):
+    def get_name(cls, gk_name):
+        return f'gatekeeper:{gk_name}'
+
+    @classmethod
+    def load(cls, gk_names):
         conn = RedisClient.get_connection()
-        name = f'gatekeeper:{gk_name}'
-        if not conn.exists(name):
-            return {
-                'percent': 0,
-                'description': '',
-            }
+        pipeline = conn.pipeline(transaction=False)
+        for gk_name in gk_names:
+            pipeline.hgetall(cls.get_name(gk_name))  # 得到所有 (key, value)，key 不存在时是空的 dict
 
-        redis_hash = conn.hgetall(name)  # 得到所有 (key, value)
         return {
-            'percent': int(redis_hash.get(b'percent', 0)),
-            'description': str(redis_hash.get(b'description', '')),
+            gk_name: {
+                'percent': int(redis_hash.get(b'percent', 0)),
+                'description': str(redis_hash.get(b'description', '')),
+                # 不同的 gatekeeper 用不同的 salt，同样的百分比也会放进不同的用户
+                # 需要重新打散用户的时候可以 set_kv 一个新的 salt
+                'salt': redis_hash.get(b'salt', gk_name.encode('utf-8')).decode('utf-8'),
+            }
+            for gk_name, redis_hash in zip(gk_names, pipeline.execute())
         }
 
+    @classmethod
+    def clear_local_cache(cls):
+        # 比如测试时 flush 了 redis，需要同时清空进程里的缓存
+        # 空的缓存里没有过期的值，之后用到的 gatekeeper 都会同步 load
+        cls.local_cache = {}
+        cls.local_cache_loaded_at = time.monotonic()
+        cls.local_cache_version += 1
+
+    @classmethod
+    def refresh_local_cache(cls):
+        version = cls.local_cache_version
+        loaded_at = time.monotonic()
+        local_cache = cls.load(list(cls.local_cache.keys()))
+        if version != cls.local_cache_version:
+            return
+        # 整个 dict 一起替换，其他线程读到的要么是旧的 dict 要么是新的 dict
+        # load 期间第一次用到、同步 load 进来的 gatekeeper 保留下来
+        cls.local_cache = {**cls.local_cache, **local_cache}
+        cls.local_cache_loaded_at = loaded_at
+
+    @classmethod
+    def refresh_local_cache_in_background(cls):
+        # 同一时间只有一个线程去 refresh，其他 request 直接读旧的缓存
+        if not cls.refresh_lock.acquire(blocking=False):
+            return
+
+        def refresh():
+            try:
+                cls.refresh_local_cache()
+            finally:
+                cls.refresh_lock.release()
+
+        cls.refresh_thread = threading.Thread(target=refresh, daemon=True)
+        cls.refresh_thread.start()
+
+    @classmethod
+    def get(cls, gk_name):
+        if time.monotonic() - cls.local_cache_loaded_at > GATEKEEPER_LOCAL_CACHE_TTL:
+            cls.refresh_local_cache_in_background()
+
+        # 第一次用到的 gatekeeper 没有旧的值可以用，只能同步 load
+        if gk_name not in cls.local_cache:
+            cls.local_cache[gk_name] = cls.load([gk_name])[gk_name]
+        return dict(cls.local_cache[gk_name])
+
     @classmethod
     def set_kv(cls, gk_name, key, value):
         conn = RedisClient.get_connection()
-        name = f'gatekeeper:{gk_name}'
+        name = cls.get_name(gk_name)
         conn.hset(name, key, value)  # 为哈希表中的字段赋值
+        cls.local_cache.pop(gk_name, None)
+        cls.local_cache_version += 1
 
     @classmethod
     def is_switch_on(cls, gk_name):
@@ -33,7 +104,36 @@ class GateKeeper:
     def turn_on(cls, gk_name):
         cls.set_kv(gk_name, 'percent', 100)
 
+    @classmethod
+    def get_bucket(cls, salt, user_id):
+        # 用 md5 而不是 hash()，保证在所有进程里、每次重启之后同一个用户都落在同一个 bucket
+        digest = hashlib.md5(f'{salt}:{user_id}'.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % 100
+
     @classmethod
     def in_gk(cls, gk_name, user_id):
         # 开放的用户数的百分比
-        return user_id % 100 < cls.get(gk_name)['percent']
+        gk = cls.get(gk_name)
+        if gk['percent'] <= 0:
+            return False
+        if gk['percent'] >= 100:
+            return True
+        return cls.get_bucket(gk['salt'], user_id) < gk['percent']
+
+    @classmethod
+    def in_gk_many(cls, gk_name, user_ids):
+        """
+        返回 user_ids 里被放进 gatekeeper 的 user_ids，保持原来的顺序
+        只读取一次 gatekeeper，适合 fanout 的时候对成千上万个 followers 做判断
+        """
+        gk = cls.get(gk_name)
+        if gk['percent'] <= 0:
+            return []
+        if gk['percent'] >= 100:
+            return list(user_ids)
+        salt, percent = gk['salt'], gk['percent']
+        return [
+            user_id
+            for user_id in user_ids
+            if cls.get_bucket(salt, user_id) < percent
+        ]
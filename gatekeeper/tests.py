@@ -1,5 +1,8 @@
+from unittest import mock
+
 from gatekeeper.models import GateKeeper
 from testing.testcases import TestCase
+from utils.redis_client import RedisClient
 
 
 class GateKeeperTests(TestCase):
@@ -9,14 +12,86 @@ class GateKeeperTests(TestCase):
 
     def test_gatekeeper(self):
         gk = GateKeeper.get('gk_name')
-        self.assertEqual(gk, {'percent': 0, 'description': ''})
+        self.assertEqual(gk, {'percent': 0, 'description': '', 'salt': 'gk_name'})
         self.assertEqual(GateKeeper.is_switch_on('gk_name'), False)
         self.assertEqual(GateKeeper.in_gk('gk_name', 1), False)
 
+        # 找一个落在前 20 个 bucket 里的用户
+        user_id = next(
+            user_id
+            for user_id in range(1000)
+            if GateKeeper.get_bucket('gk_name', user_id) < 20
+        )
         GateKeeper.set_kv('gk_name', 'percent', 20)
         self.assertEqual(GateKeeper.is_switch_on('gk_name'), False)
-        self.assertEqual(GateKeeper.in_gk('gk_name', 1), True)
+        self.assertEqual(GateKeeper.in_gk('gk_name', user_id), True)
 
         GateKeeper.set_kv('gk_name', 'percent', 100)
         self.assertEqual(GateKeeper.is_switch_on('gk_name'), True)
         self.assertEqual(GateKeeper.in_gk('gk_name', 1), True)
+        self.assertEqual(GateKeeper.in_gk('gk_name', user_id), True)
+
+    def test_local_cache(self):
+        GateKeeper.turn_on('gk_name')
+        self.assertEqual(GateKeeper.is_switch_on('gk_name'), True)
+
+        # 缓存过期之前不会访问 redis
+        conn = RedisClient.get_connection()
+        conn.hset(GateKeeper.get_name('gk_name'), 'percent', 0)
+        self.assertEqual(GateKeeper.is_switch_on('gk_name'), True)
+
+        # 缓存过期之后先返回旧的值，由后台线程重新 load
+        GateKeeper.local_cache_loaded_at = 0
+        self.assertEqual(GateKeeper.is_switch_on('gk_name'), True)
+        GateKeeper.refresh_thread.join()
+        self.assertEqual(GateKeeper.is_switch_on('gk_name'), False)
+
+        # 本进程里 set_kv 马上生效
+        GateKeeper.set_kv('gk_name', 'percent', 100)
+        self.assertEqual(GateKeeper.is_switch_on('gk_name'), True)
+
+    def test_refresh_local_cache_after_set_kv(self):
+        GateKeeper.turn_on('gk_name')
+        self.assertEqual(GateKeeper.is_switch_on('gk_name'), True)
+
+        # 后台线程 load 的过程中本进程 set_kv 了，load 到的旧值不能覆盖掉新值
+        load = GateKeeper.load
+
+        def load_then_set_kv(gk_names):
+            result = load(gk_names)
+            GateKeeper.set_kv('gk_name', 'percent', 0)
+            return result
+
+        with mock.patch.object(GateKeeper, 'load', side_effect=load_then_set_kv):
+            GateKeeper.refresh_local_cache()
+        self.assertEqual(GateKeeper.is_switch_on('gk_name'), False)
+
+    def test_in_gk_many(self):
+        user_ids = list(range(1, 1001))
+        self.assertEqual(GateKeeper.in_gk_many('gk1', user_ids), [])
+
+        GateKeeper.set_kv('gk1', 'percent', 20)
+        GateKeeper.set_kv('gk2', 'percent', 20)
+        gk1_user_ids = GateKeeper.in_gk_many('gk1', user_ids)
+        gk2_user_ids = GateKeeper.in_gk_many('gk2', user_ids)
+        self.assertEqual(
+            gk1_user_ids,
+            [user_id for user_id in user_ids if GateKeeper.in_gk('gk1', user_id)],
+        )
+        # 大约 20% 的用户，并且不是 user_id % 100 < 20 的那些用户
+        self.assertTrue(150 < len(gk1_user_ids) < 250)
+        self.assertNotEqual(gk1_user_ids, [user_id for user_id in user_ids if user_id % 100 < 20])
+        # 不同的 gatekeeper 用不同的 salt，放进来的用户不一样
+        self.assertNotEqual(gk1_user_ids, gk2_user_ids)
+
+        # 扩大百分比的时候，已经放进来的用户仍然在里面
+        GateKeeper.set_kv('gk1', 'percent', 50)
+        self.assertTrue(set(gk1_user_ids) < set(GateKeeper.in_gk_many('gk1', user_ids)))
+
+        # 换一个 salt 会重新打散用户
+        GateKeeper.set_kv('gk1', 'percent', 20)
+        GateKeeper.set_kv('gk1', 'salt', 'another salt')
+        self.assertNotEqual(GateKeeper.in_gk_many('gk1', user_ids), gk1_user_ids)
+
+        GateKeeper.set_kv('gk1', 'percent', 100)
+        self.assertEqual(GateKeeper.in_gk_many('gk1', user_ids), user_ids)
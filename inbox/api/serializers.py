@@ -1,6 +1,8 @@
 from notifications.models import Notification
 from rest_framework import serializers
 
+from inbox.services import NotificationService
+
 
 class NotificationSerializer(serializers.ModelSerializer):
 
@@ -30,6 +32,5 @@ class NotificationSerializerForUpdate(serializers.ModelSerializer):
         fields = ('unread',)
 
     def update(self, instance, validated_data):
-        instance.unread = validated_data['unread']
-        instance.save()
-        return instance
+        # 同时维护 redis 里的未读数
+        return NotificationService.mark_as_unread(instance, validated_data['unread'])
@@ -1,7 +1,9 @@
 from notifications.models import Notification
 from rest_framework import status
 
+from inbox.services import NotificationService
 from testing.testcases import TestCase
+from utils.paginations import EndlessPagination
 
 COMMENT_URL = '/api/comments/'
 LIKE_URL = '/api/likes/'
@@ -117,23 +119,23 @@ class NotificationApiTests(TestCase):
         # emma 看不到任何 notifications
         response = self.emma_client.get(NOTIFICATION_URL)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data['count'], 0)
+        self.assertEqual(len(response.data['results']), 0)
 
         # lisa 看到两个 notifications
         response = self.lisa_client.get(NOTIFICATION_URL)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
 
         # 验证标记之后只看到一个未读
         notification = self.lisa.notifications.first()
         notification.unread = False
         notification.save()
         response = self.lisa_client.get(NOTIFICATION_URL)
-        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 2)
         response = self.lisa_client.get(NOTIFICATION_URL, {'unread': True}) # 针对 filterset_fields 筛选
-        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(len(response.data['results']), 1)
         response = self.lisa_client.get(NOTIFICATION_URL, {'unread': False})
-        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(len(response.data['results']), 1)
 
     def test_update(self):
         self.emma_client.post(LIKE_URL, {
@@ -180,3 +182,47 @@ class NotificationApiTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         notification.refresh_from_db()  # 重新载入，确保变量 notification 存的是 database 的信息
         self.assertNotEqual(notification.verb, 'newverb')
+
+    def test_list_pagination_and_cache(self):
+        page_size = EndlessPagination.page_size
+        tweets = [self.create_tweet(self.lisa) for _ in range(page_size * 2)]
+        for tweet in tweets:
+            self.emma_client.post(LIKE_URL, {
+                'content_type': 'tweet',
+                'object_id': tweet.id,
+            })
+
+        # 第一页从数据库里读取之后放进 cache
+        response = self.lisa_client.get(NOTIFICATION_URL)
+        self.assertEqual(len(response.data['results']), page_size)
+        self.assertEqual(response.data['has_next_page'], True)
+        with self.assertNumQueries(0):
+            cached_response = self.lisa_client.get(NOTIFICATION_URL)
+        self.assertEqual(cached_response.data, response.data)
+
+        # 用 next_cursor 翻页，按照时间倒序，不重复也不遗漏
+        results = response.data['results']
+        while response.data['has_next_page']:
+            response = self.lisa_client.get(NOTIFICATION_URL, {
+                'cursor': response.data['next_cursor'],
+            })
+            results.extend(response.data['results'])
+        self.assertEqual(
+            [int(result['target_object_id']) for result in results],
+            [tweet.id for tweet in reversed(tweets)],
+        )
+
+        # 标记已读之后 cache 失效
+        self.lisa_client.post(NOTIFICATION_MARK_ALL_AS_READ_URL)
+        self.assertIsNone(NotificationService.get_cached_first_page(self.lisa.id))
+        response = self.lisa_client.get(NOTIFICATION_URL)
+        self.assertEqual(response.data['results'][0]['unread'], False)
+
+        # 有新的 notification 之后 cache 失效
+        self.emma_client.post(LIKE_URL, {
+            'content_type': 'tweet',
+            'object_id': self.create_tweet(self.lisa).id,
+        })
+        self.assertIsNone(NotificationService.get_cached_first_page(self.lisa.id))
+        response = self.lisa_client.get(NOTIFICATION_URL)
+        self.assertEqual(response.data['results'][0]['unread'], True)
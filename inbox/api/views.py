@@ -1,6 +1,4 @@
 from django.utils.decorators import method_decorator
-from notifications.models import Notification
-from ratelimit.decorators import ratelimit
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
@@ -8,23 +6,46 @@ from rest_framework.request import Request
 from rest_framework.response import Response
 
 from inbox.api.serializers import NotificationSerializer, NotificationSerializerForUpdate
+from inbox.services import NotificationService
 from utils.decorators import required_params
+from utils.paginations import EndlessPagination
+from utils.ratelimit import ratelimit
 
 
-class NotificationViewSet(viewsets.GenericViewSet,
-                          viewsets.mixins.ListModelMixin):
+class NotificationViewSet(viewsets.GenericViewSet):
     serializer_class = NotificationSerializer
     permission_classes = [IsAuthenticated]
+    # 用 keyset 翻页，不需要 PageNumberPagination 的 COUNT(*) 和 OFFSET
+    pagination_class = EndlessPagination
 
-    # viewsets.mixins.ListModelMixin 中会self.filter_queryset()
-    # list 时会以此筛选
+    # list 时会用 self.filter_queryset() 以此筛选
     # GET /api/notifications/?unread=True
     # GET /api/notifications/?unread=False
     filterset_fields = ('unread',)
 
     def get_queryset(self):
         # return self.request.user.notification.all()
-        return Notification.objects.filter(recipient=self.request.user).all()
+        return NotificationService.get_notifications_queryset(self.request.user.id)
+
+    def list(self, request: Request):
+        """
+        GET /api/notifications/
+        不带任何参数的第一页（打开 inbox）直接从 redis 里读取
+        """
+        is_first_page = not request.query_params
+        if is_first_page:
+            data = NotificationService.get_cached_first_page(request.user.id)
+            if data is not None:
+                return Response(data, status=status.HTTP_200_OK)
+            version = NotificationService.get_first_page_version(request.user.id)
+
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        serializer = NotificationSerializer(page, many=True)
+        response = self.get_paginated_response(serializer.data)
+        if is_first_page:
+            NotificationService.set_cached_first_page(request.user.id, response.data, version)
+        return response
 
     @action(methods=['GET'], detail=False, url_path='unread-count')
     @method_decorator(ratelimit(key='user', rate='3/s', method='GET', block=True))
@@ -32,7 +53,7 @@ class NotificationViewSet(viewsets.GenericViewSet,
         """
         GET /api/notifications/unread-count/
         """
-        count = self.get_queryset().filter(unread=True).count()
+        count = NotificationService.get_unread_count(request.user.id)
         return Response({
             'unread_count': count
         }, status=status.HTTP_200_OK)
@@ -43,7 +64,7 @@ class NotificationViewSet(viewsets.GenericViewSet,
         """
         POST /api/notifications/mark-all-as-read/
         """
-        updated_count = self.get_queryset().filter(unread=True).update(unread=False)  # mark as read
+        updated_count = NotificationService.mark_all_as_read(request.user.id)
         return Response({
             'marked_count': updated_count
         }, status=status.HTTP_200_OK)
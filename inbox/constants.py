@@ -0,0 +1,25 @@
+from utils.time_constants import ONE_HOUR, ONE_MINUTE
+
+# redis 里的未读数最多缓存这么久，过期之后从数据库重新 count 一次，修正可能累积的误差
+UNREAD_COUNT_RECONCILE_INTERVAL = ONE_HOUR
+
+# 同一个 target 上的同一种 notification，在这个时间窗口 (秒) 内会被合并成一条
+# 比如 "lisa and 37 others liked your tweet"
+NOTIFICATION_COALESCE_WINDOW = 10
+
+# flush 的时候每次从 redis 里取出多少个待发送的 notification 一起处理
+NOTIFICATION_FLUSH_BATCH_SIZE = 1000
+
+# 同一时间只有一个 flush 在处理队列，锁的过期时间也是 flush task 的 time limit，
+# worker 崩溃的时候锁过期之后下一次 flush 可以接着处理
+NOTIFICATION_FLUSH_LOCK_TIMEOUT = 10 * ONE_MINUTE
+
+# 写入数据库失败的时候 flush task 的最大重试次数，失败的 batch 留在 redis 里不会丢失
+NOTIFICATION_FLUSH_MAX_RETRIES = 5
+
+# 同一个 batch 最多尝试写入这么多次，之后移到 dead letter list 里，等人工处理
+NOTIFICATION_FLUSH_MAX_ATTEMPTS = 3
+
+# 第一页的 notifications 缓存在 redis 里，有新的 notification 或者已读状态改变时失效
+# 失效和写入 cache 之间的并发由每个用户的 version 处理，过期时间只是兜底
+NOTIFICATIONS_FIRST_PAGE_EXPIRE_TIME = ONE_HOUR
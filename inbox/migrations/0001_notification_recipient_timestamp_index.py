@@ -0,0 +1,27 @@
+from django.db import migrations, models
+
+# notifications 是第三方的 app，不能直接修改它的 model 和 migrations
+# 按照 recipient 查询并按照 timestamp 倒序做 keyset 翻页，需要 (recipient, timestamp) 的联合索引
+# innodb 的二级索引里本身就带着主键，(timestamp, id) 的排序也可以用上这个索引
+INDEX = models.Index(fields=['recipient', 'timestamp'], name='notification_recipient_ts_idx')
+
+
+def add_index(apps, schema_editor):
+    Notification = apps.get_model('notifications', 'Notification')
+    schema_editor.add_index(Notification, INDEX)
+
+
+def remove_index(apps, schema_editor):
+    Notification = apps.get_model('notifications', 'Notification')
+    schema_editor.remove_index(Notification, INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '__latest__'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_index, remove_index),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.1.3 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inbox', '0001_notification_recipient_timestamp_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationFlushBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch_id', models.CharField(max_length=64, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
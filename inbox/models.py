@@ -1,3 +1,13 @@
 from django.db import models
 
-# Create your models here.
+
+class NotificationFlushBatch(models.Model):
+    """
+    flush 写入数据库的 batch 的去重记录，和 notifications 在同一个 transaction 里创建
+    batch 从 redis 的 processing list 里删除之后，这条记录也会被删掉
+    """
+    batch_id = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return 'notification batch {}'.format(self.batch_id)
@@ -1,48 +1,407 @@
-from django.contrib.contenttypes.models import ContentType
-from notifications.signals import notify
+import json
+import logging
+import uuid
+from collections import Counter, OrderedDict
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from notifications.models import Notification
+from redis.exceptions import LockNotOwnedError
 
 from comments.models import Comment
+from inbox.constants import (
+    NOTIFICATION_COALESCE_WINDOW,
+    NOTIFICATION_FLUSH_BATCH_SIZE,
+    NOTIFICATION_FLUSH_LOCK_TIMEOUT,
+    NOTIFICATION_FLUSH_MAX_ATTEMPTS,
+    NOTIFICATIONS_FIRST_PAGE_EXPIRE_TIME,
+    UNREAD_COUNT_RECONCILE_INTERVAL,
+)
+from inbox.models import NotificationFlushBatch
+from inbox.tasks import flush_pending_notifications_task
 from likes.models import Like
 from tweets.models import Tweet
+from twitter.cache import (
+    PENDING_NOTIFICATIONS_DEAD_LETTER_KEY,
+    PENDING_NOTIFICATIONS_FLUSH_KEY,
+    PENDING_NOTIFICATIONS_FLUSH_LOCK_KEY,
+    PENDING_NOTIFICATIONS_KEY,
+    PENDING_NOTIFICATIONS_PROCESSING_KEY,
+    PENDING_NOTIFICATIONS_PROCESSING_META_KEY,
+    USER_NOTIFICATIONS_FIRST_PAGE_PATTERN,
+    USER_NOTIFICATIONS_VERSION_PATTERN,
+    USER_UNREAD_NOTIFICATIONS_COUNT_PATTERN,
+)
+from utils.content_type_helper import ContentTypeHelper
+from utils.json_encoder import JSONEncoder
+from utils.redis_client import RedisClient
+from utils.redis_helper import RedisHelper
+
+logger = logging.getLogger(__name__)
+
+# 把一个 batch 从待发送队列原子地移到 processing list 里，写入数据库成功之后才删除
+# processing list 不为空说明上一次 flush 失败了，先重新处理留下来的 batch
+# meta 里记录 batch 的 id 和已经尝试过的次数，返回 {batch_id, attempts, events}，队列为空时返回 nil
+CLAIM_PENDING_NOTIFICATIONS_SCRIPT = """
+if redis.call('LLEN', KEYS[2]) == 0 then
+    local events = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+    if #events == 0 then
+        return nil
+    end
+    redis.call('LTRIM', KEYS[1], #events, -1)
+    redis.call('RPUSH', KEYS[2], unpack(events))
+    redis.call('DEL', KEYS[3])
+end
+redis.call('HSETNX', KEYS[3], 'batch_id', ARGV[2])
+local attempts = redis.call('HINCRBY', KEYS[3], 'attempts', 1)
+return {redis.call('HGET', KEYS[3], 'batch_id'), attempts, redis.call('LRANGE', KEYS[2], 0, -1)}
+"""
+
+# 只有 version 没有变过的时候才写入 cache，读数据库期间发生过失效的话，这一页可能已经过时了
+SET_FIRST_PAGE_IF_VERSION_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
 
 
 class NotificationService:
+    """
+    notification 不在 like / comment 的 request 里同步创建:
+    - request 里只把 ids 放进 redis 的待发送队列，不查询 target 和 recipient
+    - 每个 NOTIFICATION_COALESCE_WINDOW 里最多安排一次异步的 flush
+    - flush 的时候批量查询 targets 的 owner，把同一个 target 上的同一种 notification 合并成一条，
+      然后用一次 bulk_create 写入数据库
+    """
 
     @classmethod
     def send_like_notification(cls, like: Like):
-        target = like.content_object
-
-        # 点赞的人与点赞的对象相同
-        if like.user == target.user:
+        # 点赞了一条 tweet
+        if like.content_type_id == ContentTypeHelper.get_content_type_id(Tweet):
+            verb = 'liked your tweet'
+        # 点赞了一个 comment
+        elif like.content_type_id == ContentTypeHelper.get_content_type_id(Comment):
+            verb = 'liked your comment'
+        else:
             return
 
-        # 点赞了一条 tweet
-        if like.content_type == ContentType.objects.get_for_model(Tweet):
-            notify.send(
-                sender=like.user,
-                recipient=target.user,
-                verb='liked your tweet',
-                target=target,
-            )
+        # 比较 user_id 而不是 user，避免额外的 FK 查询
+        # 点赞的人与点赞的对象的作者相同的情况，在 flush 的时候查到 owner 之后再过滤
+        cls.enqueue(
+            actor_id=like.user_id,
+            verb=verb,
+            target_content_type_id=like.content_type_id,
+            target_id=like.object_id,
+        )
 
-        # 点赞了一个 comment
-        if like.content_type == ContentType.objects.get_for_model(Comment):
-            notify.send(
-                sender=like.user,
-                recipient=target.user,
-                verb='liked your comment',
-                target=target,
+    @classmethod
+    def send_comment_notification(cls, comment: Comment):
+        # 评论的人与被评论的 tweet 的发起人相同的情况，在 flush 的时候过滤
+        cls.enqueue(
+            actor_id=comment.user_id,
+            verb='commented on your tweet',
+            target_content_type_id=ContentTypeHelper.get_content_type_id(Tweet),
+            target_id=comment.tweet_id,
+        )
+
+    @classmethod
+    def enqueue(cls, actor_id, verb, target_content_type_id, target_id):
+        conn = RedisClient.get_connection()
+        conn.rpush(PENDING_NOTIFICATIONS_KEY, json.dumps({
+            'actor_id': actor_id,
+            'verb': verb,
+            'target_content_type_id': target_content_type_id,
+            'target_id': target_id,
+        }))
+        # 一个窗口里只安排一次 flush，窗口里的 notifications 会在一起合并和写入
+        # 过期时间留出余量，flush 的 task 丢失的时候之后的 notification 可以重新安排
+        scheduled = conn.set(
+            PENDING_NOTIFICATIONS_FLUSH_KEY,
+            1,
+            nx=True,
+            ex=NOTIFICATION_COALESCE_WINDOW * 6,
+        )
+        if scheduled:
+            flush_pending_notifications_task.apply_async(countdown=NOTIFICATION_COALESCE_WINDOW)
+
+    @classmethod
+    def flush_pending_notifications(cls):
+        conn = RedisClient.get_connection()
+        # 先删掉标记，flush 开始之后新来的 notification 会安排下一次 flush
+        conn.delete(PENDING_NOTIFICATIONS_FLUSH_KEY)
+
+        lock = conn.lock(PENDING_NOTIFICATIONS_FLUSH_LOCK_KEY, timeout=NOTIFICATION_FLUSH_LOCK_TIMEOUT)
+        if not lock.acquire(blocking=False):
+            # 另一个 flush 正在处理，它可能已经检查过队列是空的，稍后再 flush 一次
+            flush_pending_notifications_task.apply_async(countdown=NOTIFICATION_COALESCE_WINDOW)
+            return 0
+
+        created_count = 0
+        try:
+            claim_script = conn.register_script(CLAIM_PENDING_NOTIFICATIONS_SCRIPT)
+            while True:
+                claimed = claim_script(
+                    keys=[
+                        PENDING_NOTIFICATIONS_KEY,
+                        PENDING_NOTIFICATIONS_PROCESSING_KEY,
+                        PENDING_NOTIFICATIONS_PROCESSING_META_KEY,
+                    ],
+                    args=[NOTIFICATION_FLUSH_BATCH_SIZE, uuid.uuid4().hex],
+                )
+                if claimed is None:
+                    break
+                batch_id, attempts, serialized_events = claimed
+                batch_id = batch_id.decode('utf-8')
+                if attempts < NOTIFICATION_FLUSH_MAX_ATTEMPTS:
+                    events = [json.loads(serialized_event) for serialized_event in serialized_events]
+                    created_count += cls.create_notifications(events, batch_id=batch_id)
+                else:
+                    # 一直失败的 batch 不能挡住之后的 notifications
+                    # 最后一次逐条写入，只把出错的 events 移到 dead letter list 里
+                    created_count += cls.create_notifications_one_by_one(batch_id, serialized_events)
+                # 出错的时候 batch 留在 processing list 里等 task 重试
+                cls.finish_processing_batch(batch_id)
+        finally:
+            try:
+                lock.release()
+            except LockNotOwnedError:
+                # flush 超过了锁的过期时间，batch 的写入是幂等的，别的 flush 同时处理也不会重复
+                logger.warning('notification flush lock expired before release')
+        return created_count
+
+    @classmethod
+    def create_notifications_one_by_one(cls, batch_id, serialized_events):
+        created_count, failed_events = 0, []
+        for index, serialized_event in enumerate(serialized_events):
+            try:
+                created_count += cls.create_notifications(
+                    [json.loads(serialized_event)],
+                    batch_id='{}:{}'.format(batch_id, index),
+                )
+            except Exception:
+                logger.exception('failed to create notification from %s', serialized_event)
+                failed_events.append(serialized_event)
+
+        if failed_events:
+            logger.error(
+                'notification batch %s failed %s times, moved %s events to dead letter',
+                batch_id,
+                NOTIFICATION_FLUSH_MAX_ATTEMPTS,
+                len(failed_events),
             )
+            conn = RedisClient.get_connection()
+            conn.rpush(PENDING_NOTIFICATIONS_DEAD_LETTER_KEY, *failed_events)
+        return created_count
 
     @classmethod
-    def send_comment_notification(cls, comment: Comment):
-        # 评论的人与被评论的 tweet 的发起人相同
-        if comment.user == comment.tweet.user:
-            return
+    def finish_processing_batch(cls, batch_id):
+        conn = RedisClient.get_connection()
+        conn.delete(PENDING_NOTIFICATIONS_PROCESSING_KEY, PENDING_NOTIFICATIONS_PROCESSING_META_KEY)
+        # processing list 删掉之后这个 batch 不会再被重试，不再需要去重的记录
+        # 逐条写入时每个 event 的记录是 batch_id:index
+        NotificationFlushBatch.objects.filter(batch_id__startswith=batch_id).delete()
 
-        notify.send(
-            sender=comment.user,
-            recipient=comment.tweet.user,
-            verb='commented on your tweet',
-            target=comment.tweet,
+    @classmethod
+    def get_target_owner_ids(cls, events):
+        """
+        返回 {(target_content_type_id, target_id): owner_id}，每种 target 只需要一次查询
+        """
+        target_ids_by_content_type = {}
+        for event in events:
+            target_ids_by_content_type.setdefault(
+                event['target_content_type_id'],
+                set(),
+            ).add(event['target_id'])
+
+        owner_ids = {}
+        for content_type_id, target_ids in target_ids_by_content_type.items():
+            model_class = ContentTypeHelper.get_model_class(content_type_id)
+            for target_id, owner_id in model_class.objects.filter(
+                id__in=target_ids,
+            ).values_list('id', 'user_id'):
+                owner_ids[(content_type_id, target_id)] = owner_id
+        return owner_ids
+
+    @classmethod
+    def create_notifications(cls, events, batch_id=None):
+        """
+        batch_id 不为空的时候，和 notifications 在同一个 transaction 里写入一条 batch 的记录
+        写入数据库之后、删除 processing list 之前出错的话，重试时不会重复创建 notifications
+        """
+        owner_ids = cls.get_target_owner_ids(events)
+
+        # 同一个 recipient 在同一个 target 上的同一种 notification 合并成一条
+        # actor 去重，保持先后顺序，最后一个是最新的 actor
+        actor_ids_by_group = OrderedDict()
+        for event in events:
+            target = (event['target_content_type_id'], event['target_id'])
+            recipient_id = owner_ids.get(target)
+            # target 已经被删除，或者是自己给自己的 notification
+            if recipient_id is None or recipient_id == event['actor_id']:
+                continue
+            group = (recipient_id, event['verb'], *target)
+            actor_ids = actor_ids_by_group.setdefault(group, OrderedDict())
+            actor_ids.pop(event['actor_id'], None)
+            actor_ids[event['actor_id']] = True
+
+        if not actor_ids_by_group:
+            return 0
+
+        # 被合并的 notification 需要在 description 里显示最新的 actor 的 username
+        coalesced_actor_ids = [
+            next(reversed(actor_ids))
+            for actor_ids in actor_ids_by_group.values()
+            if len(actor_ids) > 1
+        ]
+        usernames = dict(
+            User.objects.filter(id__in=coalesced_actor_ids).values_list('id', 'username')
         )
+
+        user_content_type_id = ContentTypeHelper.get_content_type_id(User)
+        notifications = []
+        for (recipient_id, verb, target_content_type_id, target_id), actor_ids in actor_ids_by_group.items():
+            actor_id = next(reversed(actor_ids))
+            description = None
+            if len(actor_ids) > 1:
+                description = '{} and {} others {}'.format(
+                    usernames.get(actor_id, ''),
+                    len(actor_ids) - 1,
+                    verb,
+                )
+            notifications.append(Notification(
+                recipient_id=recipient_id,
+                actor_content_type_id=user_content_type_id,
+                actor_object_id=str(actor_id),
+                verb=verb,
+                description=description,
+                target_content_type_id=target_content_type_id,
+                target_object_id=str(target_id),
+            ))
+        with transaction.atomic():
+            if batch_id is not None:
+                _, created = NotificationFlushBatch.objects.get_or_create(batch_id=batch_id)
+                if not created:
+                    return 0
+            Notification.objects.bulk_create(notifications)
+
+        for recipient_id, count in Counter(
+            notification.recipient_id for notification in notifications
+        ).items():
+            cls.incr_unread_count(recipient_id, count)
+            cls.invalidate_cached_first_page(recipient_id)
+        return len(notifications)
+
+    @classmethod
+    def get_unread_count_key(cls, user_id):
+        return USER_UNREAD_NOTIFICATIONS_COUNT_PATTERN.format(user_id=user_id)
+
+    @classmethod
+    def get_unread_count(cls, user_id):
+        """
+        客户端会不停地轮询未读数，只读 redis，不需要每次都去数据库里 count
+        """
+        conn = RedisClient.get_connection()
+        count = conn.get(cls.get_unread_count_key(user_id))
+        if count is not None:
+            return int(count)
+        return cls.reconcile_unread_count(user_id)
+
+    @classmethod
+    def reconcile_unread_count(cls, user_id):
+        # 从数据库重新 count 一次，设置过期时间，保证计数的误差最多存在 UNREAD_COUNT_RECONCILE_INTERVAL
+        # incr 不会重置过期时间，所以即使一直有新的 notification，也会定期和数据库对齐
+        count = Notification.objects.filter(recipient_id=user_id, unread=True).count()
+        conn = RedisClient.get_connection()
+        conn.set(cls.get_unread_count_key(user_id), count, ex=UNREAD_COUNT_RECONCILE_INTERVAL)
+        return count
+
+    @classmethod
+    def incr_unread_count(cls, user_id, amount=1):
+        if amount == 0:
+            return
+        # cache 里没有的时候不需要修改，下次读取时会从数据库 load
+        RedisHelper.incr_if_exists(cls.get_unread_count_key(user_id), amount)
+
+    @classmethod
+    def mark_as_unread(cls, notification: Notification, unread):
+        """
+        只有状态真的改变了才修改未读数，带上原来的状态作为 update 的条件，并发的重复标记只会生效一次
+        """
+        updated = Notification.objects.filter(
+            id=notification.id,
+            unread=not unread,
+        ).update(unread=unread)
+        notification.unread = unread
+        if updated:
+            cls.incr_unread_count(notification.recipient_id, 1 if unread else -1)
+            cls.invalidate_cached_first_page(notification.recipient_id)
+        return notification
+
+    @classmethod
+    def mark_all_as_read(cls, user_id):
+        updated_count = Notification.objects.filter(
+            recipient_id=user_id,
+            unread=True,
+        ).update(unread=False)
+        if updated_count:
+            cls.incr_unread_count(user_id, -updated_count)
+            cls.invalidate_cached_first_page(user_id)
+        return updated_count
+
+    @classmethod
+    def get_notifications_queryset(cls, user_id):
+        # notification 的时间字段是 timestamp，起一个 created_at 的别名给 EndlessPagination 用
+        return Notification.objects.filter(
+            recipient_id=user_id,
+        ).annotate(created_at=F('timestamp'))
+
+    @classmethod
+    def get_first_page_key(cls, user_id):
+        return USER_NOTIFICATIONS_FIRST_PAGE_PATTERN.format(user_id=user_id)
+
+    @classmethod
+    def get_cached_first_page(cls, user_id):
+        """
+        打开 inbox 的时候只需要读 redis，不管 inbox 里有多少 notifications
+        缓存的是序列化之后的 response data，不需要再 deserialize 成 model
+        """
+        conn = RedisClient.get_connection()
+        data = conn.get(cls.get_first_page_key(user_id))
+        if data is None:
+            return None
+        return json.loads(data)
+
+    @classmethod
+    def get_first_page_version_key(cls, user_id):
+        return USER_NOTIFICATIONS_VERSION_PATTERN.format(user_id=user_id)
+
+    @classmethod
+    def get_first_page_version(cls, user_id):
+        """
+        cache miss 的时候在查询数据库之前读取，写入 cache 的时候用来检查期间有没有发生失效
+        """
+        conn = RedisClient.get_connection()
+        return conn.get(cls.get_first_page_version_key(user_id)) or b'0'
+
+    @classmethod
+    def set_cached_first_page(cls, user_id, data, version):
+        conn = RedisClient.get_connection()
+        return bool(conn.register_script(SET_FIRST_PAGE_IF_VERSION_SCRIPT)(
+            keys=[cls.get_first_page_key(user_id), cls.get_first_page_version_key(user_id)],
+            args=[version, json.dumps(data, cls=JSONEncoder), NOTIFICATIONS_FIRST_PAGE_EXPIRE_TIME],
+        ))
+
+    @classmethod
+    def invalidate_cached_first_page(cls, user_id):
+        # 先增加 version 再删除 cache，正在读数据库的 request 不会再写回旧的第一页
+        # version 的过期时间随着每次失效刷新，比一次 request 的时间长得多
+        conn = RedisClient.get_connection()
+        version_key = cls.get_first_page_version_key(user_id)
+        pipeline = conn.pipeline()
+        pipeline.incr(version_key)
+        pipeline.expire(version_key, NOTIFICATIONS_FIRST_PAGE_EXPIRE_TIME)
+        pipeline.delete(cls.get_first_page_key(user_id))
+        pipeline.execute()
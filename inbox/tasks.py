@@ -0,0 +1,18 @@
+from celery import shared_task
+
+from inbox.constants import NOTIFICATION_FLUSH_LOCK_TIMEOUT, NOTIFICATION_FLUSH_MAX_RETRIES
+
+
+@shared_task(
+    routing_key='default',
+    time_limit=NOTIFICATION_FLUSH_LOCK_TIMEOUT,
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    max_retries=NOTIFICATION_FLUSH_MAX_RETRIES,
+)
+def flush_pending_notifications_task():
+    # import 写在里面避免循环依赖
+    from inbox.services import NotificationService
+
+    created_count = NotificationService.flush_pending_notifications()
+    return '{} notifications created.'.format(created_count)
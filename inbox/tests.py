@@ -1,7 +1,25 @@
+import json
+
+from django.apps import apps
+from django.db import connection
 from notifications.models import Notification
 
+from inbox.constants import NOTIFICATION_FLUSH_MAX_ATTEMPTS
+from inbox.models import NotificationFlushBatch
 from inbox.services import NotificationService
+from inbox.tasks import flush_pending_notifications_task
 from testing.testcases import TestCase
+from tweets.models import Tweet
+from twitter.cache import (
+    PENDING_NOTIFICATIONS_DEAD_LETTER_KEY,
+    PENDING_NOTIFICATIONS_FLUSH_KEY,
+    PENDING_NOTIFICATIONS_KEY,
+    PENDING_NOTIFICATIONS_PROCESSING_KEY,
+    PENDING_NOTIFICATIONS_PROCESSING_META_KEY,
+)
+from twitter.celery import app
+from utils.content_type_helper import ContentTypeHelper
+from utils.redis_client import RedisClient
 
 
 # Create your tests here.
@@ -46,3 +64,138 @@ class NotificationServiceTest(TestCase):
         like = self.create_like(self.lisa, emma_comment)
         NotificationService.send_like_notification(like)
         self.assertEqual(Notification.objects.count(), 2)
+
+    def test_unread_count(self):
+        self.assertEqual(NotificationService.get_unread_count(self.lisa.id), 0)
+
+        # 已经在 cache 里的未读数在发送 notification 时直接 +1
+        NotificationService.send_comment_notification(self.create_comment(self.emma, self.lisa_tweet))
+        NotificationService.send_comment_notification(self.create_comment(self.emma, self.lisa_tweet))
+        with self.assertNumQueries(0):
+            self.assertEqual(NotificationService.get_unread_count(self.lisa.id), 2)
+
+        # 重复标记只会修改一次未读数
+        notification = self.lisa.notifications.first()
+        NotificationService.mark_as_unread(notification, False)
+        NotificationService.mark_as_unread(notification, False)
+        self.assertEqual(NotificationService.get_unread_count(self.lisa.id), 1)
+        NotificationService.mark_as_unread(notification, True)
+        self.assertEqual(NotificationService.get_unread_count(self.lisa.id), 2)
+
+        self.assertEqual(NotificationService.mark_all_as_read(self.lisa.id), 2)
+        self.assertEqual(NotificationService.get_unread_count(self.lisa.id), 0)
+
+        # cache 过期或者和数据库不一致的时候，从数据库重新 count
+        Notification.objects.filter(recipient=self.lisa).update(unread=True)
+        conn = RedisClient.get_connection()
+        conn.delete(NotificationService.get_unread_count_key(self.lisa.id))
+        self.assertEqual(NotificationService.get_unread_count(self.lisa.id), 2)
+
+    def test_coalesce_notifications(self):
+        users = [self.create_user('user{}'.format(i)) for i in range(3)]
+
+        # 模拟同一个窗口里已经安排过 flush，notifications 先留在队列里
+        conn = RedisClient.get_connection()
+        conn.set(PENDING_NOTIFICATIONS_FLUSH_KEY, 1)
+        for user in users:
+            NotificationService.send_like_notification(self.create_like(user, self.lisa_tweet))
+        # 重复的 actor 只算一次
+        NotificationService.send_like_notification(self.create_like(users[0], self.lisa_tweet))
+        # 自己给自己点赞不发送
+        NotificationService.send_like_notification(self.create_like(self.lisa, self.lisa_tweet))
+        NotificationService.send_comment_notification(self.create_comment(self.emma, self.lisa_tweet))
+        self.assertEqual(Notification.objects.count(), 0)
+        self.assertEqual(NotificationService.get_unread_count(self.lisa.id), 0)
+
+        self.assertEqual(NotificationService.flush_pending_notifications(), 2)
+        like_notification = Notification.objects.get(verb='liked your tweet')
+        self.assertEqual(like_notification.recipient, self.lisa)
+        self.assertEqual(like_notification.actor, users[0])
+        self.assertEqual(like_notification.target, self.lisa_tweet)
+        self.assertEqual(like_notification.description, 'user0 and 2 others liked your tweet')
+        comment_notification = Notification.objects.get(verb='commented on your tweet')
+        self.assertEqual(comment_notification.actor, self.emma)
+        self.assertIsNone(comment_notification.description)
+        self.assertEqual(NotificationService.get_unread_count(self.lisa.id), 2)
+
+        # 队列已经清空，flush 标记也被删除，之后的 notification 会重新安排 flush
+        self.assertEqual(NotificationService.flush_pending_notifications(), 0)
+        self.assertFalse(conn.exists(PENDING_NOTIFICATIONS_FLUSH_KEY))
+
+    def test_flush_failure_keeps_pending_notifications(self):
+        conn = RedisClient.get_connection()
+        conn.set(PENDING_NOTIFICATIONS_FLUSH_KEY, 1)
+        NotificationService.send_comment_notification(self.create_comment(self.emma, self.lisa_tweet))
+        # 一个找不到 content type 的 event 让写入数据库之前的查询出错
+        bad_event = json.dumps({
+            'actor_id': self.emma.id,
+            'verb': 'liked your tweet',
+            'target_content_type_id': -1,
+            'target_id': self.lisa_tweet.id,
+        })
+        conn.rpush(PENDING_NOTIFICATIONS_KEY, bad_event)
+
+        with self.assertRaises(Exception):
+            NotificationService.flush_pending_notifications()
+        self.assertEqual(Notification.objects.count(), 0)
+        # 出错的 batch 留在 processing list 里，没有丢失
+        self.assertEqual(conn.llen(PENDING_NOTIFICATIONS_KEY), 0)
+        self.assertEqual(conn.llen(PENDING_NOTIFICATIONS_PROCESSING_KEY), 2)
+
+        # 新来的 notification 要等留下来的 batch 处理完之后才被取出
+        conn.set(PENDING_NOTIFICATIONS_FLUSH_KEY, 1)
+        NotificationService.send_like_notification(self.create_like(self.emma, self.lisa_tweet))
+        for _ in range(NOTIFICATION_FLUSH_MAX_ATTEMPTS - 2):
+            with self.assertRaises(Exception):
+                NotificationService.flush_pending_notifications()
+        self.assertEqual(Notification.objects.count(), 0)
+
+        # 最后一次逐条写入，只有出错的 event 进入 dead letter list，之后的 notifications 不会被挡住
+        self.assertEqual(NotificationService.flush_pending_notifications(), 2)
+        self.assertEqual(conn.lrange(PENDING_NOTIFICATIONS_DEAD_LETTER_KEY, 0, -1), [bad_event.encode('utf-8')])
+        self.assertFalse(conn.exists(PENDING_NOTIFICATIONS_PROCESSING_KEY))
+        self.assertFalse(conn.exists(PENDING_NOTIFICATIONS_KEY))
+        self.assertFalse(NotificationFlushBatch.objects.exists())
+
+    def test_flush_does_not_duplicate_written_batch(self):
+        # 模拟写入数据库之后、删除 processing list 之前 worker 崩溃
+        # batch 的记录和 notifications 在同一个 transaction 里写入，processing list 还留着
+        conn = RedisClient.get_connection()
+        NotificationFlushBatch.objects.create(batch_id='written')
+        conn.rpush(PENDING_NOTIFICATIONS_PROCESSING_KEY, json.dumps({
+            'actor_id': self.emma.id,
+            'verb': 'commented on your tweet',
+            'target_content_type_id': ContentTypeHelper.get_content_type_id(Tweet),
+            'target_id': self.lisa_tweet.id,
+        }))
+        conn.hset(PENDING_NOTIFICATIONS_PROCESSING_META_KEY, 'batch_id', 'written')
+
+        # 重试的时候这个 batch 已经写入过了，不会重复创建
+        self.assertEqual(NotificationService.flush_pending_notifications(), 0)
+        self.assertEqual(Notification.objects.count(), 0)
+        self.assertFalse(conn.exists(PENDING_NOTIFICATIONS_PROCESSING_KEY))
+        self.assertFalse(NotificationFlushBatch.objects.exists())
+
+    def test_stale_first_page_is_not_cached(self):
+        # 读数据库之前拿到的 version，在写入 cache 之前发生了失效
+        version = NotificationService.get_first_page_version(self.lisa.id)
+        NotificationService.invalidate_cached_first_page(self.lisa.id)
+        self.assertFalse(NotificationService.set_cached_first_page(self.lisa.id, {'results': []}, version))
+        self.assertIsNone(NotificationService.get_cached_first_page(self.lisa.id))
+
+        version = NotificationService.get_first_page_version(self.lisa.id)
+        self.assertTrue(NotificationService.set_cached_first_page(self.lisa.id, {'results': []}, version))
+        self.assertEqual(NotificationService.get_cached_first_page(self.lisa.id), {'results': []})
+
+    def test_flush_task_is_registered(self):
+        # worker 只会 autodiscover INSTALLED_APPS 里的 tasks
+        self.assertTrue(apps.is_installed('inbox'))
+        app.loader.import_default_modules()
+        self.assertIn(flush_pending_notifications_task.name, app.tasks)
+
+    def test_recipient_timestamp_index_is_migrated(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Notification._meta.db_table)
+        index = constraints.get('notification_recipient_ts_idx')
+        self.assertIsNotNone(index)
+        self.assertEqual(index['columns'], ['recipient_id', 'timestamp'])
@@ -1,13 +1,33 @@
-from django.contrib.contenttypes.models import ContentType
+from django.db import models
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 
 from accounts.api.serializers import UserSerializerForLike
+from accounts.services import UserService
 from comments.models import Comment
 from likes.models import Like
+from likes.services import LikeService
 from tweets.models import Tweet
 
 
+class LikeListSerializer(serializers.ListSerializer):
+    """
+    many=True 时使用的 serializer
+    一次性批量 load 整页 likes 的 users 和 profiles，而不是每个 like 各访问一次 cache
+    """
+
+    def to_representation(self, data):
+        likes = data.all() if isinstance(data, models.Manager) else data
+        likes = list(likes)
+        users = UserService.get_users_with_profiles_through_cache(
+            [like.user_id for like in likes],
+        )
+        for like in likes:
+            if like.user_id in users:
+                setattr(like, '_cached_user', users[like.user_id])
+        return super(LikeListSerializer, self).to_representation(likes)
+
+
 class LikeSerializer(serializers.ModelSerializer):
     # source 表示去 model 里取一个函数或属性来作为这个渲染时用的内容
     user = UserSerializerForLike(source='cached_user')
@@ -17,6 +37,7 @@ class LikeSerializer(serializers.ModelSerializer):
     class Meta:
         model = Like
         fields = ('user', 'created_at',)
+        list_serializer_class = LikeListSerializer
 
     # 法二：
     # def get_user(self, obj):
@@ -35,7 +56,7 @@ class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
         model = Like
         fields = ('content_type', 'object_id',)
 
-    def _get_model_class(self, data):
+    def get_model_class(self, data):
         if data['content_type'] == 'comment':
             return Comment
         if data['content_type'] == 'tweet':
@@ -44,7 +65,7 @@ class BaseLikeSerializerForCreateAndCancel(serializers.ModelSerializer):
 
     def validate(self, data):
         # 验证 content_type 是否合法
-        model_class = self._get_model_class(data)
+        model_class = self.get_model_class(data)
         if model_class is None:
             raise ValidationError({
                 'content_type': 'Content type does not exist'
@@ -65,14 +86,13 @@ class LikeSerializerForCreate(BaseLikeSerializerForCreateAndCancel):
 
     def get_or_create(self):
         validated_data = self.validated_data
-        model_class = self._get_model_class(validated_data)
-        # 只能创建一次，故用 get_or_create
-        instance, created = Like.objects.get_or_create(
-            content_type=ContentType.objects.get_for_model(model=model_class),
+        model_class = self.get_model_class(validated_data)
+        # 只能创建一次，由 unique 索引 + INSERT IGNORE 保证
+        return LikeService.like(
+            user_id=self.context['request'].user.id,
+            model_class=model_class,
             object_id=validated_data['object_id'],
-            user=self.context['request'].user,
         )
-        return instance, created
 
 
 class LikeSerializerForCancel(BaseLikeSerializerForCreateAndCancel):
@@ -82,12 +102,11 @@ class LikeSerializerForCancel(BaseLikeSerializerForCreateAndCancel):
         cancel 方法是一个自定义的方法，cancel 不会被 serializer.save 调用
         所以需要直接调用 serializer.cancel()
         """
-        model_class = self._get_model_class(self.validated_data)
+        model_class = self.get_model_class(self.validated_data)
         # 无论 filter 返回是否为空， delete 方法都不会报错，可以删除多项，也可以删除零项
         # 故不需要特意查看 user 是否点过这个赞
-        deleted, _ = Like.objects.filter(
-            content_type=ContentType.objects.get_for_model(model_class),
+        return LikeService.cancel_like(
+            user_id=self.context['request'].user.id,
+            model_class=model_class,
             object_id=self.validated_data['object_id'],
-            user=self.context['request'].user,
-        ).delete()
-        return deleted
+        )
@@ -1,10 +1,12 @@
 from rest_framework import status
 
 from testing.testcases import TestCase
+from utils.paginations import EndlessPagination
 
 
 LIKE_BASE_URL = '/api/likes/'
 LIKE_CANCEL_URL = '/api/likes/cancel/'
+LIKERS_URL = '/api/likes/likers/'
 COMMENT_LIST_API = '/api/comments/'
 TWEET_LIST_API = '/api/tweets/'
 TWEET_DETAIL_API = '/api/tweets/{}/'
@@ -278,3 +280,55 @@ class LikeApiTests(TestCase):
         self.assertEqual(response.data['results'][0]['tweet']['likes_count'], 3)
         response = self.emma_client.get(newsfeed_url)
         self.assertEqual(response.data['results'][0]['tweet']['likes_count'], 3)
+
+    def test_likers(self):
+        tweet = self.create_tweet(self.lisa)
+        data = {'content_type': 'tweet', 'object_id': tweet.id}
+
+        # missing params
+        response = self.anonymous_client.get(LIKERS_URL, {'content_type': 'tweet'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # wrong object_id
+        response = self.anonymous_client.get(LIKERS_URL, {
+            'content_type': 'tweet',
+            'object_id': -1,
+        })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # anonymous is allowed
+        response = self.anonymous_client.get(LIKERS_URL, data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 0)
+
+        page_size = EndlessPagination.page_size
+        users = []
+        for i in range(page_size * 2):
+            user, client = self.create_user_and_client('someone{}'.format(i))
+            client.post(LIKE_BASE_URL, data)
+            users.append(user)
+        users = users[::-1]
+
+        # pull the first page
+        response = self.anonymous_client.get(LIKERS_URL, data)
+        self.assertEqual(response.data['has_next_page'], True)
+        self.assertEqual(len(response.data['results']), page_size)
+        self.assertEqual(response.data['results'][0]['user']['id'], users[0].id)
+
+        # pull the second page
+        response = self.anonymous_client.get(LIKERS_URL, {
+            **data,
+            'created_at__lt': response.data['results'][-1]['created_at'],
+        })
+        self.assertEqual(response.data['has_next_page'], False)
+        self.assertEqual(len(response.data['results']), page_size)
+        self.assertEqual(response.data['results'][0]['user']['id'], users[page_size].id)
+        self.assertEqual(response.data['results'][-1]['user']['id'], users[-1].id)
+
+        # canceled like is removed from the likers
+        self.lisa_client.post(LIKE_BASE_URL, data)
+        response = self.anonymous_client.get(LIKERS_URL, data)
+        self.assertEqual(response.data['results'][0]['user']['id'], self.lisa.id)
+        self.lisa_client.post(LIKE_CANCEL_URL, data)
+        response = self.anonymous_client.get(LIKERS_URL, data)
+        self.assertEqual(response.data['results'][0]['user']['id'], users[0].id)
@@ -1,25 +1,28 @@
 from django.utils.decorators import method_decorator
-from ratelimit.decorators import ratelimit
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.request import Request
 from rest_framework.response import Response
 
-from inbox.services import NotificationService
 from likes.api.serializers import (
+    BaseLikeSerializerForCreateAndCancel,
     LikeSerializerForCreate,
     LikeSerializer,
     LikeSerializerForCancel,
 )
 from likes.models import Like
+from likes.services import LikeService
 from utils.decorators import required_params
+from utils.paginations import EndlessPagination
+from utils.ratelimit import ratelimit
 
 
 class LikeViewSet(viewsets.GenericViewSet):
     queryset = Like.objects.all()
     permission_classes = [IsAuthenticated]
     serializer_class = LikeSerializerForCreate
+    pagination_class = EndlessPagination
 
     @required_params(method='POST', params=['content_type', 'object_id'])
     @method_decorator(ratelimit(key='user', rate='10/s', method='POST', block=True))
@@ -39,11 +42,8 @@ class LikeViewSet(viewsets.GenericViewSet):
                 'errors': serializer.errors,
             }, status=status.HTTP_400_BAD_REQUEST)
 
-        like, created = serializer.get_or_create()
-
-        # send notification for newly created like
-        if created:
-            NotificationService.send_like_notification(like)
+        # 新创建的 like 的 notification 会在异步任务里发送
+        like, _ = serializer.get_or_create()
 
         return Response(
             data=LikeSerializer(instance=like).data,
@@ -74,3 +74,34 @@ class LikeViewSet(viewsets.GenericViewSet):
             'success': True,
             'deleted': deleted,
         }, status=status.HTTP_200_OK)
+
+    @action(methods=['GET'], detail=False, permission_classes=[AllowAny])
+    @required_params(method='GET', params=['content_type', 'object_id'])
+    @method_decorator(ratelimit(key='user_or_ip', rate='5/s', method='GET', block=True))
+    def likers(self, request: Request):
+        """
+        GET /api/likes/likers/?content_type=tweet&object_id=xxx
+        按照点赞时间倒序，分页列出谁点赞了这个 object (tweet / comment)
+        """
+        serializer = BaseLikeSerializerForCreateAndCancel(data=request.query_params)
+        if not serializer.is_valid():
+            return Response({
+                'message': 'Please check input',
+                'errors': serializer.errors,
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        model_class = serializer.get_model_class(serializer.validated_data)
+        object_id = serializer.validated_data['object_id']
+
+        # 先从 redis 里的 recent likers 中翻页，翻出 cache 的范围之后再去数据库里查询剩下的部分
+        cached_likes = LikeService.get_cached_recent_likes(model_class, object_id)
+        paginator = self.paginator
+        queryset = LikeService.get_likes_queryset(model_class, object_id)
+        page = paginator.paginate_cached_list(
+            cached_likes,
+            request,
+            paginator.queryset_loader(queryset),
+        )
+
+        serializer = LikeSerializer(instance=page, many=True)
+        return paginator.get_paginated_response(data=serializer.data)
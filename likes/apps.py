@@ -3,3 +3,19 @@ from django.apps import AppConfig
 
 class LikesConfig(AppConfig):
     name = 'likes'
+
+    def ready(self):
+        # import 写在里面，确保 model 都已经 load 完成
+        from django.db.models.signals import post_migrate
+
+        from comments.models import Comment
+        from tweets.models import Tweet
+        from utils.content_type_helper import ContentTypeHelper
+
+        # 可以被点赞的 model 都需要注册
+        ContentTypeHelper.register(Tweet, Comment)
+        post_migrate.connect(
+            ContentTypeHelper.clear,
+            weak=False,
+            dispatch_uid='content_type_helper_clear',
+        )
@@ -0,0 +1,76 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from likes.services import LikeService
+from tweets.models import Tweet
+
+
+class Command(BaseCommand):
+    """
+    并发压测点赞 / 取消点赞的写路径，统计每次操作的 db 查询数和延迟
+        python manage.py benchmark_likes --tweet-id=1 --users=200 --threads=16
+    会使用已有的前 --users 个 users 去点赞同一条 tweet，结束后全部取消，不会留下数据
+    异步任务（likes_count, notification）不计入统计，需要另外启动 celery worker 去消费
+    """
+    help = 'Benchmark db queries and latency of the like write path under concurrent load'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tweet-id', type=int, required=True)
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--threads', type=int, default=8)
+
+    def handle(self, *args, **options):
+        tweet_id = options['tweet_id']
+        if not Tweet.objects.filter(id=tweet_id).exists():
+            raise CommandError('tweet {} does not exist'.format(tweet_id))
+
+        user_ids = list(
+            User.objects.order_by('id').values_list('id', flat=True)[:options['users']]
+        )
+        if not user_ids:
+            raise CommandError('no users to benchmark with')
+
+        for action in ('like', 'cancel'):
+            with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+                results = list(executor.map(
+                    lambda user_id: self._run(action, user_id, tweet_id),
+                    # 每个 user 操作两次，第二次用来测重复点赞 / 重复取消的路径
+                    user_ids + user_ids,
+                ))
+            self._report(action, results)
+
+    def _run(self, action, user_id, tweet_id):
+        # django 的 db connection 是每个线程独立的
+        try:
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                if action == 'like':
+                    LikeService.like(user_id, Tweet, tweet_id)
+                else:
+                    LikeService.cancel_like(user_id, Tweet, tweet_id)
+                latency = time.perf_counter() - start
+            return len(context.captured_queries), latency
+        finally:
+            connection.close()
+
+    def _report(self, action, results):
+        queries = [num_queries for num_queries, _ in results]
+        latencies = sorted(latency * 1000 for _, latency in results)
+        self.stdout.write('{}: {} ops, avg {:.2f} queries/op, max {} queries/op'.format(
+            action,
+            len(results),
+            statistics.mean(queries),
+            max(queries),
+        ))
+        self.stdout.write('  latency ms: p50 {:.2f}, p95 {:.2f}, p99 {:.2f}, max {:.2f}'.format(
+            latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.95)],
+            latencies[int(len(latencies) * 0.99)],
+            latencies[-1],
+        ))
@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from likes.services import LikeService
+from tweets.models import Tweet
+from utils.time_helpers import utc_now
+
+
+class Command(BaseCommand):
+    """
+    定期 (比如 crontab 每小时) 重新 count 最近发布的 tweets 的 likes_count
+        python manage.py reconcile_likes_count --days=1
+    点赞的写路径上 likes_count 是 +1 / -1，写入 like 之后进程崩溃会让计数产生误差，
+    重新 count 是 O(likes) 的，不放在每次点赞的路径上
+    """
+    help = 'Recount likes_count of recently created tweets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        created_after = utc_now() - timedelta(days=options['days'])
+        last_id, reconciled = 0, 0
+        while True:
+            # keyset pagination，按照主键分批，每批一条 UPDATE
+            tweet_ids = list(
+                Tweet.objects.filter(id__gt=last_id, created_at__gte=created_after)
+                .order_by('id')
+                .values_list('id', flat=True)[:options['batch_size']]
+            )
+            if not tweet_ids:
+                break
+            reconciled += LikeService.reconcile_likes_count(tweet_ids)
+            last_id = tweet_ids[-1]
+        self.stdout.write('likes_count of {} tweets reconciled'.format(reconciled))
@@ -2,9 +2,6 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
-from django.db.models.signals import pre_delete, post_save
-
-from likes.listeners import decr_likes_count, incr_likes_count
 from utils.memcached_helper import MemcachedHelper
 
 
@@ -49,8 +46,8 @@ class Like(models.Model):
 
     @property
     def cached_user(self):
+        # 批量 load 过的 user 会放在 instance level 的 cache 里
+        if hasattr(self, '_cached_user'):
+            return self._cached_user
         return MemcachedHelper.get_object_through_cache(User, self.user_id)
 
-
-pre_delete.connect(decr_likes_count, sender=Like)
-post_save.connect(incr_likes_count, sender=Like)
@@ -1,7 +1,48 @@
 from django.contrib.auth.models import User
-from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
 from likes.models import Like
+from likes.tasks import like_canceled_task, like_created_task
+from twitter.cache import RECENT_LIKERS_PATTERN
+from utils.content_type_helper import ContentTypeHelper
+from utils.redis_helper import RedisHelper
+from utils.time_helpers import datetime_to_timestamp, timestamp_to_datetime
+
+
+def lazy_load_likers(content_type_id, object_id):
+    def _lazy_load(limit):
+        # 会用到 <content_type, object_id, created_at> 的联合索引
+        likes = Like.objects.filter(
+            content_type_id=content_type_id,
+            object_id=object_id,
+        ).order_by('-created_at', '-id').values_list('user_id', 'created_at')[:limit]
+        return [
+            (user_id, datetime_to_timestamp(created_at))
+            for user_id, created_at in likes
+            if user_id is not None
+        ]
+    return _lazy_load
+
+
+def _insert_like(like: Like):
+    """
+    一条 INSERT 完成 get_or_create，由 <user, content_type, object_id> 的 unique 索引判断是否是重复点赞
+    并发的重复点赞只有一个会插入成功，返回是否真的插入了数据
+    """
+    # 外层有 transaction 的时候用 savepoint，unique 冲突之后外层的 transaction 还可以继续使用
+    # autocommit 的时候不需要额外的 BEGIN / COMMIT
+    try:
+        if connection.in_atomic_block:
+            with transaction.atomic():
+                like.save(force_insert=True)
+        else:
+            like.save(force_insert=True)
+    except IntegrityError:
+        return False
+    return True
 
 
 class LikeService:
@@ -15,7 +56,196 @@ class LikeService:
             return False
 
         return Like.objects.filter(
-            content_type=ContentType.objects.get_for_model(target.__class__),
+            content_type_id=ContentTypeHelper.get_content_type_id(target.__class__),
             object_id=target.id,
             user=user,
         ).exists()
+
+    @classmethod
+    def like(cls, user_id, model_class, object_id):
+        """
+        点赞的写路径，返回 (like, created)
+        - 创建：一次 INSERT，是否创建成功由 INSERT 本身决定，而不是之前的 SELECT
+        - likes_count 只在真的插入了 like 的时候 +1，O(1) 的 UPDATE
+        - recent likers 和 notification 的更新放到异步任务里，参数只有 ids
+        - 重复点赞的时候才会多一次查询，把已有的 like 取出来
+        """
+        content_type_id = ContentTypeHelper.get_content_type_id(model_class)
+        like = Like(
+            user_id=user_id,
+            content_type_id=content_type_id,
+            object_id=object_id,
+            created_at=timezone.now(),
+        )
+        if not _insert_like(like):
+            existing = Like.objects.filter(
+                user_id=user_id,
+                content_type_id=content_type_id,
+                object_id=object_id,
+            ).first()
+            return existing or like, False
+
+        cls.incr_likes_count(content_type_id, object_id, 1)
+        like_created_task.delay(user_id, content_type_id, object_id)
+        return like, True
+
+    @classmethod
+    def cancel_like(cls, user_id, model_class, object_id):
+        """
+        取消点赞的写路径，返回删除了多少个 like
+        Like 上没有 signal receiver，queryset.delete() 不需要先 SELECT，只有一条 DELETE
+        只有真的删除了 like 的时候 likes_count 才 -1
+        """
+        content_type_id = ContentTypeHelper.get_content_type_id(model_class)
+        deleted, _ = Like.objects.filter(
+            user_id=user_id,
+            content_type_id=content_type_id,
+            object_id=object_id,
+        ).delete()
+        if deleted:
+            cls.incr_likes_count(content_type_id, object_id, -deleted)
+            like_canceled_task.delay(user_id, content_type_id, object_id)
+        return deleted
+
+    @classmethod
+    def sync_like(cls, user_id, content_type_id, object_id):
+        """
+        like / cancel 的异步任务不保证执行顺序，也可能重复执行
+        所以不按照任务的类型操作 cache，而是以数据库里 like 当前是否存在为准：
+        like 存在就放进 recent likers 的 cache，不存在就从 cache 里删掉
+        返回数据库里当前的 like，不存在的时候返回 None
+        """
+        like = Like.objects.filter(
+            user_id=user_id,
+            content_type_id=content_type_id,
+            object_id=object_id,
+        ).first()
+        if like is not None:
+            cls.push_liker_to_cache(like)
+        else:
+            cls.remove_liker_from_cache(Like(
+                user_id=user_id,
+                content_type_id=content_type_id,
+                object_id=object_id,
+            ))
+        return like
+
+    @classmethod
+    def incr_likes_count(cls, content_type_id, object_id, amount):
+        # import 写在里面避免循环依赖
+        from tweets.models import Tweet
+
+        # 只 denormalize 了 tweet 的 likes_count
+        if ContentTypeHelper.get_model_class(content_type_id) != Tweet:
+            return
+        Tweet.objects.filter(id=object_id).update(likes_count=F('likes_count') + amount)
+        # cache 里没有的时候不需要修改，下次读取时会从数据库 load
+        RedisHelper.incr_if_exists(RedisHelper.get_count_key(Tweet(id=object_id), 'likes_count'), amount)
+
+    @classmethod
+    def reconcile_likes_count(cls, tweet_ids):
+        """
+        写入 like 之后、修改 likes_count 之前出错会让计数产生误差，由定期执行的
+        reconcile_likes_count command 按照 <content_type, object_id, created_at> 的索引重新 count
+        UPDATE tweets_tweet SET likes_count = (SELECT COUNT(*) FROM likes_like WHERE ...) WHERE id IN (...)
+        """
+        # import 写在里面避免循环依赖
+        from tweets.models import Tweet
+
+        likes_count = Like.objects.filter(
+            content_type_id=ContentTypeHelper.get_content_type_id(Tweet),
+            object_id=OuterRef('id'),
+        ).order_by().values('object_id').annotate(count=Count('id')).values('count')
+        updated = Tweet.objects.filter(id__in=tweet_ids).update(
+            likes_count=Coalesce(Subquery(likes_count), 0),
+        )
+        # redis 里的计数直接失效，下次读取的时候从数据库 load
+        RedisHelper.invalidate_objects(*[
+            RedisHelper.get_count_key(Tweet(id=tweet_id), 'likes_count')
+            for tweet_id in tweet_ids
+        ])
+        return updated
+
+    @classmethod
+    def get_likes_queryset(cls, model_class, object_id):
+        return Like.objects.filter(
+            content_type_id=ContentTypeHelper.get_content_type_id(model_class),
+            object_id=object_id,
+        )
+
+    @classmethod
+    def get_liked_object_ids(cls, user: User, model_class, object_ids):
+        """
+        批量版本的 has_liked，一次查询返回 user 点赞过的 object ids
+        会用到 <user, content_type, object_id> 的 unique 索引
+        """
+        if user.is_anonymous or not object_ids:
+            return set()
+
+        return set(Like.objects.filter(
+            content_type_id=ContentTypeHelper.get_content_type_id(model_class),
+            object_id__in=object_ids,
+            user=user,
+        ).values_list('object_id', flat=True))
+
+    @classmethod
+    def get_likes_count_map(cls, model_class, object_ids):
+        """
+        一次 group by 查询返回 {object_id: likes_count}，没有被点赞过的 object 不在结果中
+        会用到 <content_type, object_id, created_at> 的联合索引
+        """
+        if not object_ids:
+            return {}
+
+        rows = Like.objects.filter(
+            content_type_id=ContentTypeHelper.get_content_type_id(model_class),
+            object_id__in=object_ids,
+        ).values('object_id').annotate(likes_count=Count('id'))
+        return {row['object_id']: row['likes_count'] for row in rows}
+
+    @classmethod
+    def get_recent_likers_key(cls, content_type_id, object_id):
+        return RECENT_LIKERS_PATTERN.format(
+            content_type_id=content_type_id,
+            object_id=object_id,
+        )
+
+    @classmethod
+    def get_cached_recent_likes(cls, model_class, object_id, limit=None):
+        """
+        从 redis 的 sorted set 里按照 created_at 倒序取出最近的 likes
+        cache 里只存 user_id 和 created_at，还原成不在数据库里查询的 Like 对象，
+        可以直接交给 LikeSerializer 和 EndlessPagination 使用
+        """
+        content_type_id = ContentTypeHelper.get_content_type_id(model_class)
+        key = cls.get_recent_likers_key(content_type_id, object_id)
+        members = RedisHelper.load_sorted_members(
+            key=key,
+            lazy_load_func=lazy_load_likers(content_type_id, object_id),
+            limit=limit,
+        )
+        return [
+            Like(
+                content_type_id=content_type_id,
+                object_id=object_id,
+                user_id=user_id,
+                created_at=timestamp_to_datetime(timestamp),
+            )
+            for user_id, timestamp in members
+        ]
+
+    @classmethod
+    def push_liker_to_cache(cls, like: Like):
+        if like.user_id is None:
+            return
+        key = cls.get_recent_likers_key(like.content_type_id, like.object_id)
+        RedisHelper.add_sorted_member(
+            key=key,
+            member=like.user_id,
+            score=datetime_to_timestamp(like.created_at),
+        )
+
+    @classmethod
+    def remove_liker_from_cache(cls, like: Like):
+        key = cls.get_recent_likers_key(like.content_type_id, like.object_id)
+        RedisHelper.remove_sorted_member(key=key, member=like.user_id)
@@ -0,0 +1,28 @@
+from celery import shared_task
+
+from utils.time_constants import ONE_HOUR
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def like_created_task(user_id, content_type_id, object_id):
+    # import 写在里面避免循环依赖
+    from inbox.services import NotificationService
+    from likes.services import LikeService
+
+    # 参数只有 ids，以数据库里当前的状态为准，如果已经被取消了就什么都不用通知
+    like = LikeService.sync_like(user_id, content_type_id, object_id)
+    if like is None:
+        return 'like {}:{} by {} was canceled'.format(content_type_id, object_id, user_id)
+
+    NotificationService.send_like_notification(like)
+    return 'like {}:{} by {} processed'.format(content_type_id, object_id, user_id)
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def like_canceled_task(user_id, content_type_id, object_id):
+    # import 写在里面避免循环依赖
+    from likes.services import LikeService
+
+    # 和 like_created_task 的先后顺序不确定，同样以数据库里当前的状态为准
+    LikeService.sync_like(user_id, content_type_id, object_id)
+    return 'like {}:{} by {} canceled'.format(content_type_id, object_id, user_id)
@@ -1,3 +1,95 @@
-from django.test import TestCase
+from likes.services import LikeService
+from likes.tasks import like_canceled_task, like_created_task
+from testing.testcases import TestCase
+from tweets.models import Tweet
+from utils.content_type_helper import ContentTypeHelper
+from utils.redis_helper import RedisHelper
+
 
 # Create your tests here.
+class LikeServiceTests(TestCase):
+
+    def setUp(self):
+        super(LikeServiceTests, self).setUp()
+        self.lisa = self.create_user('lisa')
+        self.emma = self.create_user('emma')
+        self.tweet = self.create_tweet(self.lisa)
+
+    def test_get_cached_recent_likes(self):
+        lisa_like = self.create_like(self.lisa, self.tweet)
+
+        # cache miss
+        likes = LikeService.get_cached_recent_likes(Tweet, self.tweet.id)
+        self.assertEqual([like.user_id for like in likes], [self.lisa.id])
+        self.assertEqual(likes[0].created_at, lisa_like.created_at)
+
+        # cache updated
+        emma_like = self.create_like(self.emma, self.tweet)
+        likes = LikeService.get_cached_recent_likes(Tweet, self.tweet.id)
+        self.assertEqual([like.user_id for like in likes], [self.emma.id, self.lisa.id])
+        self.assertEqual(likes[0].created_at, emma_like.created_at)
+
+        # limit
+        likes = LikeService.get_cached_recent_likes(Tweet, self.tweet.id, limit=1)
+        self.assertEqual([like.user_id for like in likes], [self.emma.id])
+
+        # removed from cache when canceled
+        LikeService.cancel_like(self.emma.id, Tweet, self.tweet.id)
+        likes = LikeService.get_cached_recent_likes(Tweet, self.tweet.id)
+        self.assertEqual([like.user_id for like in likes], [self.lisa.id])
+
+    def test_like_and_cancel_like(self):
+        like, created = LikeService.like(self.emma.id, Tweet, self.tweet.id)
+        self.assertEqual(created, True)
+        self.assertEqual(like.user_id, self.emma.id)
+        self.assertEqual(self.tweet.like_set.count(), 1)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+
+        # 重复点赞不会创建新的 like，返回已有的 like
+        duplicate, created = LikeService.like(self.emma.id, Tweet, self.tweet.id)
+        self.assertEqual(created, False)
+        self.assertEqual(duplicate.id, self.tweet.like_set.first().id)
+        self.assertEqual(self.tweet.like_set.count(), 1)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+
+        # 重复取消点赞不会重复减少 likes_count
+        self.assertEqual(LikeService.cancel_like(self.emma.id, Tweet, self.tweet.id), 1)
+        self.assertEqual(LikeService.cancel_like(self.emma.id, Tweet, self.tweet.id), 0)
+        self.assertEqual(self.tweet.like_set.count(), 0)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 0)
+
+    def test_like_tasks_out_of_order(self):
+        content_type_id = ContentTypeHelper.get_content_type_id(Tweet)
+        # 模拟 like 之后马上 cancel，cancel 的任务先于 like 的任务执行
+        LikeService.like(self.emma.id, Tweet, self.tweet.id)
+        LikeService.cancel_like(self.emma.id, Tweet, self.tweet.id)
+        like_canceled_task(self.emma.id, content_type_id, self.tweet.id)
+        like_created_task(self.emma.id, content_type_id, self.tweet.id)
+
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 0)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 0)
+        self.assertEqual(LikeService.get_cached_recent_likes(Tweet, self.tweet.id), [])
+
+        # 重复执行的任务也不会重复计数
+        LikeService.like(self.emma.id, Tweet, self.tweet.id)
+        like_created_task(self.emma.id, content_type_id, self.tweet.id)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 1)
+        likes = LikeService.get_cached_recent_likes(Tweet, self.tweet.id)
+        self.assertEqual([like.user_id for like in likes], [self.emma.id])
+
+    def test_reconcile_likes_count(self):
+        self.create_like(self.emma, self.tweet)
+        RedisHelper.get_count(self.tweet, 'likes_count')
+        # 计数产生了误差
+        Tweet.objects.filter(id=self.tweet.id).update(likes_count=5)
+
+        self.assertEqual(LikeService.reconcile_likes_count([self.tweet.id]), 1)
+        self.tweet.refresh_from_db()
+        self.assertEqual(self.tweet.likes_count, 1)
+        self.assertEqual(RedisHelper.get_count(self.tweet, 'likes_count'), 1)
@@ -209,3 +209,30 @@ class NewsFeedApiTests(TestCase):
         # cache expired
         self.clear_cache()
         _test_newsfeeds_after_new_feed_pushed()
+
+    def test_paginate_with_cursor(self):
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        page_size = EndlessPagination.page_size
+        newsfeeds = []
+        for i in range(list_limit + page_size):
+            tweet = self.create_tweet(user=self.emma, content='feed{}'.format(i))
+            newsfeeds.append(self.create_newsfeed(self.lisa, tweet))
+        newsfeeds = newsfeeds[::-1]
+
+        # 翻过 cache 的范围之后继续用 storage 里的数据翻页，不重复也不遗漏
+        response = self.lisa_client.get(NEWSFEEDS_URL)
+        results = response.data['results']
+        while response.data['has_next_page']:
+            self.assertIsNotNone(response.data['next_cursor'])
+            response = self.lisa_client.get(NEWSFEEDS_URL, {
+                'cursor': response.data['next_cursor'],
+            })
+            results.extend(response.data['results'])
+        self.assertIsNone(response.data['next_cursor'])
+        self.assertEqual(
+            [result['created_at'] for result in results],
+            [newsfeed.created_at for newsfeed in newsfeeds],
+        )
+
+        response = self.lisa_client.get(NEWSFEEDS_URL, {'cursor': 'not a cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
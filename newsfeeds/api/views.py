@@ -1,5 +1,4 @@
 from django.utils.decorators import method_decorator
-from ratelimit.decorators import ratelimit
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.request import Request
@@ -9,6 +8,7 @@ from newsfeeds.api.serializers import NewsFeedSerializer
 from newsfeeds.models import NewsFeed, HBaseNewsFeed
 from newsfeeds.services import NewsFeedService
 from utils.paginations import EndlessPagination
+from utils.ratelimit import ratelimit
 
 
 class NewsFeedViewSet(viewsets.GenericViewSet):
@@ -25,21 +25,28 @@ class NewsFeedViewSet(viewsets.GenericViewSet):
         """
         GET /api/newsfeeds/
         """
-        cached_newsfeeds = NewsFeedService.get_cached_newsfeeds(request.user.id)
-        # 用 EndlessPagination 的自己实现的 paginated_cached_list
         paginator = self.paginator
-        page = paginator.paginate_cached_list(cached_newsfeeds, request)
-        # page 是 None 说明我现在请求的数据可能不在 cache 里，需要直接去 db 获取
-        if page is None:
-            if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-                page = paginator.paginate_hbase(
-                    HBaseNewsFeed,
-                    (request.user.id,),
-                    request
-                )
-            else:
-                queryset = NewsFeed.objects.filter(user=request.user)
-                page = paginator.paginate_queryset(queryset=queryset, request=request)
+        # 第一页只需要最新的 page_size + 1 个，不需要把每个明星用户的 tweets cache 都 deserialize 出来
+        limit = paginator.page_size + 1 if not request.query_params else None
+        cached_newsfeeds, is_truncated = NewsFeedService.load_cached_newsfeeds(request.user.id, limit)
+        # 用 EndlessPagination 的自己实现的 paginated_cached_list
+        # 翻到 cache 的末尾的时候，只从存储层读取 cache 之后剩下的部分
+        # 存储层里只有 push 过来的 newsfeeds，明星用户的 tweets 不会出现在这里
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            load_remainder = paginator.hbase_loader(HBaseNewsFeed, (request.user.id,))
+        else:
+            queryset = NewsFeed.objects.filter(user=request.user)
+            load_remainder = paginator.queryset_loader(queryset)
+        # 合并了明星用户的 tweets 之后，cache 是否被截断不能用合并之后的长度来判断
+        page = paginator.paginate_cached_list(
+            cached_newsfeeds,
+            request,
+            load_remainder,
+            is_truncated=is_truncated,
+        )
+
+        # 被删除的 tweet 的 newsfeeds 在异步删除完成之前需要在这里过滤掉
+        page = NewsFeedService.filter_retracted_newsfeeds(page)
 
         serializer = NewsFeedSerializer(
             instance=page,
@@ -1,3 +1,19 @@
 from django.conf import settings
 
 FANOUT_BATCH_SIZE = 1000 if not settings.TESTING else 3
+
+# 粉丝数达到这个阈值的用户被标记为明星用户 (celebrity)
+# 明星用户发 tweet 时不做 fanout (push)，由粉丝在读取 newsfeeds 时去明星用户的 tweets 里 pull
+CELEBRITY_FOLLOWERS_THRESHOLD = 100000 if not settings.TESTING else 10
+
+# fanout 的 task 失败之后的重试次数，重试时从 checkpoint 继续
+FANOUT_MAX_RETRIES = 3
+
+# fanout 的 batch 按照优先级分到不同的 queue (lane) 里，避免大 V 的大量 batch 阻塞普通用户的 fanout
+# - 每条 tweet 的第一个 batch 进 high lane，保证所有人的 tweet 都能最快被一部分粉丝看到
+# - 粉丝数达到 FANOUT_LOW_PRIORITY_FOLLOWERS_THRESHOLD 的用户的其余 batch 进 low lane
+# - 其余的 batch 进 normal lane
+FANOUT_HIGH_PRIORITY_QUEUE = 'newsfeeds_high'
+FANOUT_NORMAL_PRIORITY_QUEUE = 'newsfeeds'
+FANOUT_LOW_PRIORITY_QUEUE = 'newsfeeds_low'
+FANOUT_LOW_PRIORITY_FOLLOWERS_THRESHOLD = 10000 if not settings.TESTING else 5
@@ -0,0 +1,139 @@
+from django.conf import settings
+
+from twitter.cache import (
+    FANOUT_JOB_BATCHES_PATTERN,
+    FANOUT_JOB_DONE_BATCHES_PATTERN,
+    FANOUT_JOB_PATTERN,
+)
+from utils.redis_client import RedisClient
+
+
+class FanoutJob:
+    """
+    记录一条 tweet 的 fanout 进度，用于 fanout 失败之后从 checkpoint 继续
+    - hash fanout_job:{tweet_id} 记录 status，main task 扫描到的 follower cursor (checkpoint)，
+      已经创建的 batch 个数，是否所有的 batch 都已经创建，以及每个 batch 的尝试次数
+    - set fanout_job:{tweet_id}:batches 记录已经创建的 batch keys
+    - set fanout_job:{tweet_id}:done_batches 记录已经完成的 batch keys
+    batch key 是这一页 followers 的 keyset 区间，follow / unfollow 之后也不会对应到别的 followers
+    """
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+
+    # 推给作者自己的 newsfeed 也当作一个 batch 来记录
+    AUTHOR_BATCH_KEY = 'author'
+
+    @classmethod
+    def _get_keys(cls, tweet_id):
+        return (
+            FANOUT_JOB_PATTERN.format(tweet_id=tweet_id),
+            FANOUT_JOB_BATCHES_PATTERN.format(tweet_id=tweet_id),
+            FANOUT_JOB_DONE_BATCHES_PATTERN.format(tweet_id=tweet_id),
+        )
+
+    @classmethod
+    def get_batch_key(cls, start_cursor, end_cursor):
+        # 第一页的 start_cursor 是 None
+        return '{}-{}'.format('' if start_cursor is None else start_cursor, end_cursor)
+
+    @classmethod
+    def get_status(cls, tweet_id):
+        conn = RedisClient.get_connection()
+        job_key, _, _ = cls._get_keys(tweet_id)
+        status = conn.hget(job_key, 'status')
+        return status.decode('utf-8') if status is not None else None
+
+    @classmethod
+    def is_done(cls, tweet_id):
+        return cls.get_status(tweet_id) == cls.STATUS_DONE
+
+    @classmethod
+    def start(cls, tweet_id):
+        conn = RedisClient.get_connection()
+        job_key, _, _ = cls._get_keys(tweet_id)
+        pipe = conn.pipeline()
+        pipe.hset(job_key, 'status', cls.STATUS_RUNNING)
+        pipe.expire(job_key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipe.execute()
+
+    @classmethod
+    def finish(cls, tweet_id):
+        conn = RedisClient.get_connection()
+        job_key, _, _ = cls._get_keys(tweet_id)
+        conn.hset(job_key, 'status', cls.STATUS_DONE)
+
+    @classmethod
+    def get_checkpoint(cls, tweet_id):
+        """
+        返回 (cursor, batches_count)，重试的时候从 cursor 之后继续扫描 followers
+        cursor 为 None 表示还没有创建过任何 batch
+        """
+        conn = RedisClient.get_connection()
+        job_key, _, _ = cls._get_keys(tweet_id)
+        cursor, batches_count = conn.hmget(job_key, ['cursor', 'batches_count'])
+        return (
+            int(cursor) if cursor is not None else None,
+            int(batches_count) if batches_count is not None else 0,
+        )
+
+    @classmethod
+    def save_checkpoint(cls, tweet_id, batch_key, cursor):
+        """
+        batch 创建之后再记录 checkpoint，挂在两者之间的时候重试会再创建一次这一页，
+        batch 的写入是幂等的，不会丢掉也不会重复 followers
+        """
+        conn = RedisClient.get_connection()
+        job_key, batches_key, _ = cls._get_keys(tweet_id)
+        pipe = conn.pipeline()
+        pipe.sadd(batches_key, batch_key)
+        pipe.expire(batches_key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipe.hset(job_key, 'cursor', cursor)
+        pipe.hincrby(job_key, 'batches_count', 1)
+        pipe.execute()
+
+    @classmethod
+    def finish_dispatching(cls, tweet_id):
+        # 所有的 batch 都创建完之后，所有的 batch 都完成了 job 才算完成
+        conn = RedisClient.get_connection()
+        job_key, _, _ = cls._get_keys(tweet_id)
+        conn.hset(job_key, 'dispatched', 1)
+        cls._finish_if_all_batches_done(tweet_id)
+
+    @classmethod
+    def is_batch_done(cls, tweet_id, batch_key):
+        conn = RedisClient.get_connection()
+        _, _, done_key = cls._get_keys(tweet_id)
+        return conn.sismember(done_key, batch_key)
+
+    @classmethod
+    def start_batch(cls, tweet_id, batch_key):
+        """
+        返回这个 batch 是第几次执行，大于 1 说明之前的执行可能写了一部分数据
+        """
+        conn = RedisClient.get_connection()
+        job_key, _, _ = cls._get_keys(tweet_id)
+        return conn.hincrby(job_key, 'attempts:{}'.format(batch_key), 1)
+
+    @classmethod
+    def finish_batch(cls, tweet_id, batch_key):
+        conn = RedisClient.get_connection()
+        _, _, done_key = cls._get_keys(tweet_id)
+        pipe = conn.pipeline()
+        pipe.sadd(done_key, batch_key)
+        pipe.expire(done_key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipe.execute()
+        cls._finish_if_all_batches_done(tweet_id)
+
+    @classmethod
+    def _finish_if_all_batches_done(cls, tweet_id):
+        conn = RedisClient.get_connection()
+        job_key, batches_key, done_key = cls._get_keys(tweet_id)
+        pipe = conn.pipeline()
+        pipe.hget(job_key, 'dispatched')
+        pipe.sdiff(batches_key, done_key)
+        dispatched, undone_batch_keys = pipe.execute()
+        # dispatched 在所有 batch 都创建完之后才会写入
+        if dispatched is None:
+            return
+        if not undone_batch_keys:
+            cls.finish(tweet_id)
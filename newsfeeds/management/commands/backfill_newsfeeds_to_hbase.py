@@ -0,0 +1,87 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from newsfeeds.models import HBaseNewsFeed, NewsFeed
+from utils.hbase_backfill import HBaseBackfill
+
+
+def newsfeed_to_rows(row):
+    _, user_id, tweet_id, tweet_created_at = row
+    # user 被删除之后外键会被 SET_NULL，这样的 newsfeed 不需要复制
+    # tweet 被删除之后 newsfeed 会被异步删除，还没删掉的 join 不到 tweet，也不需要复制
+    if user_id is None or tweet_id is None or tweet_created_at is None:
+        return []
+
+    return [(HBaseNewsFeed, {
+        'user_id': user_id,
+        'tweet_id': tweet_id,
+        # hbase 里 newsfeed 的 created_at 是 tweet 的创建时间，和 Tweet.timestamp 的算法保持一致
+        'created_at': int(tweet_created_at.timestamp() * 1000000),
+    })]
+
+
+class Command(BaseCommand):
+    """
+    把 mysql 里的 newsfeeds 复制到 hbase 的 newsfeeds 表里
+        python manage.py backfill_newsfeeds_to_hbase --workers=8 --rows-per-second=50000
+    中断之后重新执行会从 checkpoint 继续，--restart 从头开始
+    复制完成之后用 --verify 按照 user 区间比较 mysql 和 hbase 里的行数，
+    确认一致之后再打开 switch_newsfeed_to_hbase
+    """
+    help = 'Backfill newsfeeds from MySQL to HBase newsfeeds table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--rows-per-second', type=int, default=None)
+        parser.add_argument('--restart', action='store_true')
+        parser.add_argument('--verify', action='store_true')
+        parser.add_argument('--verify-only', action='store_true')
+        # 全量比较太慢的时候，只随机抽查一部分 users，比如 0.01
+        parser.add_argument('--verify-sample-rate', type=float, default=None)
+
+    def handle(self, *args, **options):
+        backfill = HBaseBackfill(
+            name='newsfeeds',
+            queryset=NewsFeed.objects.all(),
+            fields=('user_id', 'tweet_id', 'tweet__created_at'),
+            to_rows=newsfeed_to_rows,
+            page_size=options['page_size'],
+            workers=options['workers'],
+            rows_per_second=options['rows_per_second'],
+            log=self.stdout.write,
+        )
+        if not options['verify_only']:
+            if options['restart']:
+                backfill.reset_checkpoints()
+            backfill.run()
+
+        if options['verify'] or options['verify_only']:
+            self._verify(backfill, options['verify_sample_rate'])
+
+    def _verify(self, backfill, sample_rate):
+        mismatches = backfill.verify_counts(
+            User.objects.order_by('id').values_list('id', flat=True).iterator(),
+            get_mysql_counts=self._get_mysql_counts,
+            get_hbase_count=lambda conn, user_id: backfill.count_hbase_rows(
+                conn,
+                HBaseNewsFeed,
+                (user_id, None),
+            ),
+            sample_rate=sample_rate,
+        )
+        for user_id, mysql_count, hbase_count in mismatches:
+            self.stdout.write('user {}: mysql {} rows, hbase {} rows'.format(
+                user_id,
+                mysql_count,
+                hbase_count,
+            ))
+        self.stdout.write('{} mismatches found'.format(len(mismatches)))
+
+    def _get_mysql_counts(self, user_ids):
+        counts = NewsFeed.objects.filter(
+            user_id__in=user_ids,
+            tweet__created_at__isnull=False,
+        ).values('user_id').annotate(count=Count('id'))
+        return {item['user_id']: item['count'] for item in counts}
@@ -5,6 +5,7 @@ use newsfeeds.hbase_models.HBaseNewsFeed instead
 from django.contrib.auth.models import User
 from django.db import models
 from django.db.models.signals import post_save
+from django.utils import timezone
 
 from newsfeeds.listeners import push_newsfeed_to_cache
 from tweets.models import Tweet
@@ -21,12 +22,17 @@ class NewsFeed(models.Model):
         on_delete=models.SET_NULL,
         null=True,
     )
+    # 删除 tweet 的时候不在数据库层面处理 newsfeeds，否则大 V 的 tweet 会在一条语句里更新所有粉丝的 newsfeeds
+    # 由 retract_newsfeeds_main_task 按照 tweet 的索引分 batch 异步删除
     tweet = models.ForeignKey(
         Tweet,
-        on_delete=models.SET_NULL,
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
         null=True,
     )
-    created_at = models.DateTimeField(auto_now_add=True)
+    # 和 tweet 的 created_at 一致，不能用 auto_now_add，
+    # 否则 rebuild / merge 时写入的旧 tweets 会变成现在的时间，排到 newsfeeds 的最前面
+    created_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
         index_together = (('user', 'created_at'),)
@@ -1,10 +1,30 @@
+import heapq
+import logging
+import time
+from itertools import islice, takewhile
+
+from django.conf import settings
+
+from friendships.services import FriendshipService
 from gatekeeper.models import GateKeeper
+from newsfeeds.constants import CELEBRITY_FOLLOWERS_THRESHOLD
 from newsfeeds.models import NewsFeed, HBaseNewsFeed
-from newsfeeds.tasks import fanout_newsfeeds_main_task
+from newsfeeds.tasks import (
+    fanout_newsfeeds_main_task,
+    rebuild_newsfeeds_task,
+    retract_newsfeeds_main_task,
+    repair_newsfeeds_after_follow_task,
+    repair_newsfeeds_after_unfollow_task,
+)
 from tweets.models import Tweet
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from tweets.services import TweetService
+from twitter.cache import CELEBRITY_USER_IDS_KEY, FANOUT_QUEUE_LAG_KEY, USER_NEWSFEEDS_PATTERN
+from utils.redis_client import RedisClient
 from utils.redis_helper import RedisHelper
 from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer
+from utils.time_helpers import timestamp_to_datetime
+
+logger = logging.getLogger(__name__)
 
 
 def lazy_load_newsfeeds(user_id):
@@ -18,7 +38,7 @@ def lazy_load_newsfeeds(user_id):
             return HBaseNewsFeed.filter(prefix=(user_id, None), limit=limit, reverse=True)
         # queryset 是 lazy loading 模式，
         # 未真正访问 / 转换成 list 结果，就不会真正触发数据库的查询
-        return NewsFeed.objects.filter(user_id=user_id).order_by('-created_at')[:limit]
+        return NewsFeed.objects.filter(user_id=user_id).order_by('-created_at', '-id')[:limit]
     return _lazy_load
 
 
@@ -44,14 +64,221 @@ class NewsFeedService:
 
         # fanout_newsfeeds_task(tweet.id) # 同步任务
 
+    @classmethod
+    def retract_tweet(cls, tweet: Tweet):
+        """
+        删除 tweet，并异步地把 fanout 出去的 newsfeeds 都删掉
+        删除完成之前，读取 newsfeeds 的时候用 tombstone 过滤掉这条 tweet
+        """
+        TweetService.mark_retracted(tweet.id)
+        TweetService.remove_tweet_from_cache(tweet)
+
+        # mysql 里 newsfeed 的 tweet 外键是 DO_NOTHING，删除 tweet 不会同步地修改 newsfeeds
+        # newsfeeds 全部由 retract_newsfeeds_main_task 分 batch 删除
+        tweet.delete()
+        # 和 fanout 用同样的参数，hbase 的 cache 里需要按照 fanout 时 push 的内容删除
+        retract_newsfeeds_main_task.delay(tweet.id, tweet.timestamp, tweet.user_id)
+
+    @classmethod
+    def filter_retracted_newsfeeds(cls, newsfeeds):
+        retracted_tweet_ids = TweetService.get_retracted_tweet_ids(
+            [newsfeed.tweet_id for newsfeed in newsfeeds],
+        )
+        if not retracted_tweet_ids:
+            return newsfeeds
+        return [
+            newsfeed
+            for newsfeed in newsfeeds
+            if newsfeed.tweet_id not in retracted_tweet_ids
+        ]
+
+    @classmethod
+    def iterate_newsfeed_user_id_pages(cls, tweet_id, tweet_user_id, page_size):
+        """
+        分页地扫描收到过这条 tweet 的 user ids，每次 yield 一页
+        - hbase 没有 tweet_id 的索引，和 fanout 一样扫描作者和作者的 followers
+        - mysql 按照 tweet 外键的索引扫描 newsfeeds，已经 unfollow 了的用户也能扫描到
+        """
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            yield [tweet_user_id]
+            yield from FriendshipService.iterate_follower_id_pages(tweet_user_id, page_size)
+            return
+
+        # keyset pagination: batch 删除的同时扫描，不会因为 offset 跳过数据
+        last_id = 0
+        while True:
+            rows = list(
+                NewsFeed.objects.filter(tweet_id=tweet_id, id__gt=last_id)
+                .order_by('id')
+                .values_list('id', 'user_id')[:page_size]
+            )
+            if rows:
+                yield [user_id for _, user_id in rows]
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1][0]
+
+    @classmethod
+    def batch_delete(cls, tweet_id, created_at, user_ids):
+        """
+        删除一个 batch 的 users 的 newsfeeds 里的这条 tweet，并从 cache 里删掉
+        """
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            # hbase 的 row key 是 user_id + tweet 的 created_at，可以直接拼出来批量删除
+            HBaseNewsFeed.batch_delete([
+                {'user_id': user_id, 'created_at': created_at}
+                for user_id in user_ids
+            ])
+            newsfeeds = [
+                HBaseNewsFeed(user_id=user_id, created_at=created_at, tweet_id=tweet_id)
+                for user_id in user_ids
+            ]
+            # hbase 的 newsfeed 序列化之后和 fanout 时 push 进 cache 的内容一样，可以直接 LREM
+            RedisHelper.remove_objects_from_cached_keys([
+                (USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id), newsfeed)
+                for newsfeed in newsfeeds
+            ])
+            return len(newsfeeds)
+
+        deleted, _ = NewsFeed.objects.filter(user_id__in=user_ids, tweet_id=tweet_id).delete()
+        # mysql 的 cache 里，fanout push 的和 lazy load 的 newsfeeds 序列化之后不一样 (id, created_at)
+        # 没法按照内容 LREM，直接失效这些 users 的 cache，下次读取的时候重新 load
+        RedisHelper.invalidate_objects(*[
+            USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
+            for user_id in user_ids
+        ])
+        return deleted
+
     @classmethod
     def get_cached_newsfeeds(cls, user_id):
+        newsfeeds, _ = cls.load_cached_newsfeeds(user_id)
+        return newsfeeds
+
+    @classmethod
+    def load_cached_newsfeeds(cls, user_id, limit=None):
+        """
+        hybrid push / pull model:
+        - 普通用户的 tweets 通过 fanout push 到了 user 的 newsfeeds cache 里
+        - 明星用户的 tweets 没有 fanout，读取时从明星用户的 user_tweets cache 里 pull，
+          和 push 过来的 newsfeeds 做 k 路归并
+        返回 (newsfeeds, is_truncated)，is_truncated 表示存储层里是否还有 cache 之后的 newsfeeds
+        合并去重之后的长度可能小于 cache 的长度上限，不能用合并之后的长度来判断
+        limit: 只需要最新的 limit 个 newsfeeds 的时候 (比如第一页)，每个 list 都只 lrange 出 limit 个
+        """
         key = USER_NEWSFEEDS_PATTERN.format(user_id=user_id)
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
             serializer = HBaseModelSerializer
         else:
             serializer = DjangoModelSerializer
-        return RedisHelper.load_objects(key, lazy_load_newsfeeds(user_id), serializer=serializer)
+        limit = min(limit or settings.REDIS_LIST_LENGTH_LIMIT, settings.REDIS_LIST_LENGTH_LIMIT)
+        newsfeeds = RedisHelper.load_objects(
+            key,
+            lazy_load_newsfeeds(user_id),
+            serializer=serializer,
+            limit=limit,
+        )
+        # push 过来的 list 达到长度上限 (被 trim 过)，或者只取了一部分，后面都可能还有
+        is_truncated = len(newsfeeds) >= limit
+
+        celebrity_ids = cls.get_followed_celebrity_ids(user_id)
+        if not celebrity_ids:
+            return newsfeeds, is_truncated
+        merged, is_merge_truncated = cls.merge_celebrity_tweets(user_id, newsfeeds, celebrity_ids, limit)
+        return merged, is_truncated or is_merge_truncated
+
+    @classmethod
+    def record_fanout_queue_lag(cls, queue, lag):
+        """
+        记录每个 lane 最近一个 batch 在 queue 里等待的时间 (seconds)
+        """
+        logger.info('fanout batch waited %.3f s in queue %s', lag, queue)
+        conn = RedisClient.get_connection()
+        conn.hset(FANOUT_QUEUE_LAG_KEY, queue, lag)
+
+    @classmethod
+    def get_fanout_queue_lags(cls):
+        conn = RedisClient.get_connection()
+        return {
+            queue.decode('utf-8'): float(lag)
+            for queue, lag in conn.hgetall(FANOUT_QUEUE_LAG_KEY).items()
+        }
+
+    @classmethod
+    def get_celebrity_ids(cls):
+        conn = RedisClient.get_connection()
+        return set(int(user_id) for user_id in conn.smembers(CELEBRITY_USER_IDS_KEY))
+
+    @classmethod
+    def update_celebrity(cls, user_id, followers_count):
+        """
+        根据粉丝数更新 user 是否是明星用户，返回 user 是否是明星用户
+        """
+        conn = RedisClient.get_connection()
+        if followers_count >= CELEBRITY_FOLLOWERS_THRESHOLD:
+            if conn.sadd(CELEBRITY_USER_IDS_KEY, user_id):
+                logger.info('user %s marked as celebrity with %s followers', user_id, followers_count)
+            return True
+
+        if conn.srem(CELEBRITY_USER_IDS_KEY, user_id):
+            logger.info('user %s unmarked as celebrity with %s followers', user_id, followers_count)
+        return False
+
+    @classmethod
+    def get_followed_celebrity_ids(cls, user_id):
+        # 每次读取 newsfeeds 都会用到，在 redis 里求交集，不把明星用户和 followings 的 set 都取出来
+        return FriendshipService.get_followed_user_ids_in_set(user_id, CELEBRITY_USER_IDS_KEY)
+
+    @classmethod
+    def merge_celebrity_tweets(cls, user_id, newsfeeds, celebrity_ids, limit=None):
+        """
+        把每个明星用户的 tweets 转换成 user 的 newsfeeds（只在内存中，不写入存储）
+        所有的列表都已经按照 created_at 倒序排列，用 heapq.merge 做 k 路归并
+        成为明星用户之前 fanout 过的 tweets 会同时出现在两边，需要按照 tweet_id 去重
+        返回 (merged, is_truncated)，is_truncated 表示合并的结果是否因为长度上限被截断
+        合并的结果最多 limit 个，每个明星用户也只需要 lrange 出最新的 limit 个 tweets
+        """
+        start = time.perf_counter()
+        limit = limit or settings.REDIS_LIST_LENGTH_LIMIT
+        use_hbase = GateKeeper.is_switch_on('switch_newsfeed_to_hbase')
+        sorted_lists = [newsfeeds]
+        for celebrity_id in celebrity_ids:
+            tweets = TweetService.get_cached_tweets(celebrity_id, limit=limit)
+            sorted_lists.append([
+                cls._build_newsfeed_from_tweet(user_id, tweet, use_hbase)
+                for tweet in tweets
+            ])
+
+        merged = []
+        seen_tweet_ids = set()
+        is_truncated = False
+        for newsfeed in heapq.merge(
+            *sorted_lists,
+            key=lambda newsfeed: newsfeed.created_at,
+            reverse=True,
+        ):
+            if newsfeed.tweet_id in seen_tweet_ids:
+                continue
+            # 与 cache 的长度保持一致，超过的部分翻页时走存储层
+            if len(merged) >= limit:
+                is_truncated = True
+                break
+            seen_tweet_ids.add(newsfeed.tweet_id)
+            merged.append(newsfeed)
+
+        logger.info(
+            'merged %s celebrities into newsfeeds of user %s: %s items in %.2f ms',
+            len(celebrity_ids),
+            user_id,
+            sum(len(sorted_list) for sorted_list in sorted_lists),
+            (time.perf_counter() - start) * 1000,
+        )
+        return merged, is_truncated
+
+    @classmethod
+    def _build_newsfeed_from_tweet(cls, user_id, tweet, use_hbase):
+        if use_hbase:
+            return HBaseNewsFeed(user_id=user_id, created_at=tweet.timestamp, tweet_id=tweet.id)
+        return NewsFeed(user_id=user_id, tweet_id=tweet.id, created_at=tweet.created_at)
 
     @classmethod
     def push_newsfeed_to_cache(cls, newsfeed):
@@ -62,6 +289,20 @@ class NewsFeedService:
             lazy_load_func=lazy_load_newsfeeds(newsfeed.user_id)
         )
 
+    @classmethod
+    def push_newsfeeds_to_cache(cls, newsfeeds, dedup=False):
+        """
+        fanout 一个 batch 时批量 push 到每个 follower 的 cache 里
+        没有 cache 的 follower 直接跳过，下次读取的时候再 lazy load
+        """
+        return RedisHelper.push_objects_to_cached_keys(
+            [
+                (USER_NEWSFEEDS_PATTERN.format(user_id=newsfeed.user_id), newsfeed)
+                for newsfeed in newsfeeds
+            ],
+            dedup=dedup,
+        )
+
     @classmethod
     def create(cls, **kwargs):
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
@@ -69,23 +310,149 @@ class NewsFeedService:
             # 需要手动触发 cache 更改，因为没有 listener 监听 hbase create
             cls.push_newsfeed_to_cache(newsfeed)
         else:
-            newsfeed = NewsFeed.objects.create(**kwargs)
+            newsfeed = NewsFeed.objects.create(**cls._to_mysql_params(kwargs))
         return newsfeed
 
     @classmethod
-    def batch_create(cls, batch_params):
+    def _to_mysql_params(cls, params):
+        # fanout 传过来的 created_at 是 hbase 用的 micro seconds，mysql 需要转换成 datetime
+        created_at = params.get('created_at')
+        if isinstance(created_at, int):
+            params = {**params, 'created_at': timestamp_to_datetime(created_at)}
+        return params
+
+    @classmethod
+    def batch_create_in_storage(cls, batch_params, ignore_conflicts=False):
         if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
-            newsfeeds = HBaseNewsFeed.batch_create(batch_params)
-        else:
-            newsfeeds = [NewsFeed(**params) for params in batch_params]
-            NewsFeed.objects.bulk_create(newsfeeds)
+            # hbase 里相同 row key 的写入是覆盖，天然幂等
+            return HBaseNewsFeed.batch_create(batch_params)
+
+        newsfeeds = [NewsFeed(**cls._to_mysql_params(params)) for params in batch_params]
+        NewsFeed.objects.bulk_create(newsfeeds, ignore_conflicts=ignore_conflicts)
+        return newsfeeds
+
+    @classmethod
+    def batch_create(cls, batch_params, dedup=False):
+        """
+        fanout 的 batch 可能会被重试，写入需要是幂等的 (以 tweet_id + user_id 去重)
+        - mysql 有 (user, tweet) 的 unique_together，重复的写入直接忽略
+        - hbase 的 row key 是 user_id + tweet 的 created_at，重复的写入是覆盖
+        - redis 的 list 没法自动去重，dedup=True 的时候在 push 之前先删掉已有的
+        """
+        newsfeeds = cls.batch_create_in_storage(batch_params, ignore_conflicts=True)
 
         # batch_create 和 bulk_create 都不会触发 post_save 的 signal，
         # 所以需要手动 push 到 cache 里
-        for newsfeed in newsfeeds:
-            NewsFeedService.push_newsfeed_to_cache(newsfeed)
+        cls.push_newsfeeds_to_cache(newsfeeds, dedup=dedup)
         return newsfeeds
 
+    @classmethod
+    def rebuild_newsfeeds_for_dormant_user(cls, user_id, last_active_at):
+        """
+        只 fanout 给活跃用户时，不活跃的用户会错过这段时间里的 tweets
+        用户重新活跃的时候，异步地把错过的部分补回来
+        """
+        # 和 fanout 时一样按 user 灰度，没有被放进 gatekeeper 的用户不会错过 tweets
+        if not GateKeeper.in_gk('switch_fanout_to_active_users', user_id):
+            return
+        rebuild_newsfeeds_task.delay(user_id, last_active_at)
+
+    @classmethod
+    def rebuild_newsfeeds(cls, user_id, since=None):
+        """
+        用 user 所关注的人的 tweets cache 重建 user 的 newsfeeds
+        since 是 unix seconds，只补 since 之后发的 tweets，None 表示不限制
+        明星用户的 tweets 是在读取时 pull 的，不需要补
+        """
+        following_ids = FriendshipService.get_following_user_id_set(user_id)
+        following_ids -= cls.get_followed_celebrity_ids(user_id)
+
+        sorted_lists = []
+        # 每个 following 的 tweets 都是按需逐条读取的，heapq.merge 和 takewhile 停下之后
+        # 剩下的部分不会被读取和 deserialize，总共只会处理 REDIS_LIST_LENGTH_LIMIT + len(following_ids) 个
+        for following_id in following_ids:
+            tweets = TweetService.iterate_cached_tweets(following_id)
+            if since is not None:
+                # tweets 按照 created_at 倒序排列，遇到 since 之前的就可以停下
+                tweets = takewhile(lambda tweet: tweet.created_at.timestamp() > since, tweets)
+            sorted_lists.append(tweets)
+
+        tweets = list(islice(
+            heapq.merge(*sorted_lists, key=lambda tweet: tweet.created_at, reverse=True),
+            settings.REDIS_LIST_LENGTH_LIMIT,
+        ))
+        return cls._write_tweets_to_newsfeeds(user_id, tweets)
+
+    @classmethod
+    def _write_tweets_to_newsfeeds(cls, user_id, tweets):
+        if not tweets:
+            return 0
+
+        use_hbase = GateKeeper.is_switch_on('switch_newsfeed_to_hbase')
+        batch_params = [
+            {
+                'user_id': user_id,
+                'tweet_id': tweet.id,
+                'created_at': tweet.timestamp if use_hbase else tweet.created_at,
+            }
+            for tweet in tweets
+        ]
+        # 之前已经 fanout 过的 newsfeeds 可能会重复写入，需要忽略冲突
+        cls.batch_create_in_storage(batch_params, ignore_conflicts=True)
+
+        # 直接删掉 cache，下次读取的时候从存储里重新 load
+        # 逐条 push 到 cache 里会在 lazy load 之后造成重复
+        RedisHelper.invalidate_objects(USER_NEWSFEEDS_PATTERN.format(user_id=user_id))
+        return len(tweets)
+
+    @classmethod
+    def repair_newsfeeds_after_follow(cls, from_user_id, to_user_id):
+        if not GateKeeper.is_switch_on('switch_repair_newsfeeds_on_follow'):
+            return
+        repair_newsfeeds_after_follow_task.delay(from_user_id, to_user_id)
+
+    @classmethod
+    def repair_newsfeeds_after_unfollow(cls, from_user_id, to_user_id):
+        if not GateKeeper.is_switch_on('switch_repair_newsfeeds_on_follow'):
+            return
+        repair_newsfeeds_after_unfollow_task.delay(from_user_id, to_user_id)
+
+    @classmethod
+    def merge_tweets_into_newsfeeds(cls, user_id, tweet_user_id):
+        """
+        follow 之后把被关注的人最近的 tweets 合并到 user 的 newsfeeds 里
+        明星用户的 tweets 是在读取时 pull 的，不需要合并
+        """
+        if tweet_user_id in cls.get_celebrity_ids():
+            return 0
+        tweets = TweetService.get_cached_tweets(tweet_user_id)
+        return cls._write_tweets_to_newsfeeds(user_id, tweets[:settings.REDIS_LIST_LENGTH_LIMIT])
+
+    @classmethod
+    def remove_tweets_from_newsfeeds(cls, user_id, tweet_user_id):
+        """
+        unfollow 之后把被取关的人最近的 tweets 从 user 的 newsfeeds 里删掉
+        更早的 tweets 已经在 newsfeeds 里很靠后的位置，不再处理
+        """
+        tweets = TweetService.get_cached_tweets(tweet_user_id)[:settings.REDIS_LIST_LENGTH_LIMIT]
+        if not tweets:
+            return 0
+
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            # hbase 的 row key 是 user_id + tweet 的 created_at，可以直接拼出来批量删除
+            HBaseNewsFeed.batch_delete([
+                {'user_id': user_id, 'created_at': tweet.timestamp}
+                for tweet in tweets
+            ])
+        else:
+            NewsFeed.objects.filter(
+                user_id=user_id,
+                tweet_id__in=[tweet.id for tweet in tweets],
+            ).delete()
+
+        RedisHelper.invalidate_objects(USER_NEWSFEEDS_PATTERN.format(user_id=user_id))
+        return len(tweets)
+
     @classmethod
     def count(cls, user_id=None):
         # for test only
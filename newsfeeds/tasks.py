@@ -1,22 +1,85 @@
+import time
+
 from celery import shared_task
 
+from accounts.services import UserService
 from friendships.services import FriendshipService
-from newsfeeds.constants import FANOUT_BATCH_SIZE
+from gatekeeper.models import GateKeeper
+from newsfeeds.constants import (
+    FANOUT_BATCH_SIZE,
+    FANOUT_HIGH_PRIORITY_QUEUE,
+    FANOUT_LOW_PRIORITY_FOLLOWERS_THRESHOLD,
+    FANOUT_LOW_PRIORITY_QUEUE,
+    FANOUT_MAX_RETRIES,
+    FANOUT_NORMAL_PRIORITY_QUEUE,
+)
+from newsfeeds.fanout_job import FanoutJob
 from utils.time_constants import ONE_HOUR
 
 
-@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
-def fanout_newsfeeds_batch_task(tweet_id, created_at, follower_ids):
+def get_fanout_queue(followers_count, batch_index):
+    # 每条 tweet 的第一个 batch 都是最高优先级
+    if batch_index == 0:
+        return FANOUT_HIGH_PRIORITY_QUEUE
+    if followers_count >= FANOUT_LOW_PRIORITY_FOLLOWERS_THRESHOLD:
+        return FANOUT_LOW_PRIORITY_QUEUE
+    return FANOUT_NORMAL_PRIORITY_QUEUE
+
+
+@shared_task(
+    routing_key='newsfeeds',
+    time_limit=ONE_HOUR,
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    max_retries=FANOUT_MAX_RETRIES,
+)
+def fanout_newsfeeds_batch_task(
+    tweet_id,
+    created_at,
+    follower_ids,
+    batch_key=None,
+    queue=None,
+    enqueued_at=None,
+):
     # import 写在里面避免循环依赖
     from newsfeeds.services import NewsFeedService
 
+    # 记录 batch 在 queue 里等待的时间，用于监控每个 lane 的积压情况
+    if queue is not None and enqueued_at is not None:
+        NewsFeedService.record_fanout_queue_lag(queue, time.time() - enqueued_at)
+
+    # batch_key 为 None 的 batch 没有 checkpoint，按重试处理
+    if batch_key is None:
+        attempts = None
+    elif FanoutJob.is_batch_done(tweet_id, batch_key):
+        return 'batch {} of tweet {} is already done.'.format(batch_key, tweet_id)
+    else:
+        attempts = FanoutJob.start_batch(tweet_id, batch_key)
+
+    # 不活跃的用户不做 fanout，重新活跃的时候再重建 newsfeeds
+    # 见 UserActivityMiddleware 和 rebuild_newsfeeds_task
+    # 按 follower 灰度，只有被放进 gatekeeper 的 followers 才会因为不活跃被跳过
+    gk_follower_ids = GateKeeper.in_gk_many('switch_fanout_to_active_users', follower_ids)
+    if gk_follower_ids:
+        skipped_ids = set(gk_follower_ids) - set(UserService.filter_active_user_ids(gk_follower_ids))
+        follower_ids = [
+            follower_id
+            for follower_id in follower_ids
+            if follower_id not in skipped_ids
+        ]
+
     batch_params = [
         {'user_id': follower_id, 'created_at': created_at, 'tweet_id': tweet_id}
         for follower_id in follower_ids
     ]
 
-    # 一次性写入
-    newsfeeds = NewsFeedService.batch_create(batch_params)
+    # 一次性写入，重试的时候需要对 cache 去重
+    newsfeeds = NewsFeedService.batch_create(
+        batch_params,
+        dedup=attempts is None or attempts > 1,
+    )
+    if batch_key is not None:
+        FanoutJob.finish_batch(tweet_id, batch_key)
     return '{} newsfeeds created'.format(len(newsfeeds))
 
     # 其实若是一个 1kw 粉丝的博主发了一个 144字节的 tweet，
@@ -27,32 +90,141 @@ def fanout_newsfeeds_batch_task(tweet_id, created_at, follower_ids):
     # 只有 user_id，tweet_id，和 created_at，并没有整条 tweet
 
     # 本质优化方法：对于明星用户，不要用 push model，而要用 pull model
+    # 见 fanout_newsfeeds_main_task 和 NewsFeedService.get_cached_newsfeeds
 
 
-@shared_task(routing_key='default', time_limit=ONE_HOUR)
+@shared_task(
+    routing_key='default',
+    time_limit=ONE_HOUR,
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    max_retries=FANOUT_MAX_RETRIES,
+)
 def fanout_newsfeeds_main_task(tweet_id, created_at, tweet_user_id):
     # import 写在里面避免循环依赖
     from newsfeeds.services import NewsFeedService
 
+    # 重试的时候从 checkpoint 继续，已经创建的 batch 不再重复创建
+    if FanoutJob.is_done(tweet_id):
+        return 'fanout of tweet {} is already done.'.format(tweet_id)
+    FanoutJob.start(tweet_id)
+
     # 将推给自己的 Newsfeed 率先创建，确保自己能最快看到
-    NewsFeedService.create(
-        user_id=tweet_user_id,
-        tweet_id=tweet_id,
-        created_at=created_at,
-    )
+    if not FanoutJob.is_batch_done(tweet_id, FanoutJob.AUTHOR_BATCH_KEY):
+        NewsFeedService.create(
+            user_id=tweet_user_id,
+            tweet_id=tweet_id,
+            created_at=created_at,
+        )
+        FanoutJob.finish_batch(tweet_id, FanoutJob.AUTHOR_BATCH_KEY)
 
-    # 在具体的 async task 中进行拆分，拆成一个个小的 async task
+    # 明星用户不做 fanout，粉丝读取 newsfeeds 的时候再去 pull
+    # 粉丝数用 redis 里缓存的计数，不需要每条 tweet 都去存储层 count 或者 scan 一遍
+    followers_count = FriendshipService.get_cached_follower_count(tweet_user_id)
+    if NewsFeedService.update_celebrity(tweet_user_id, followers_count):
+        FanoutJob.finish(tweet_id)
+        return '{} followers of celebrity {} will pull the tweet.'.format(
+            followers_count,
+            tweet_user_id,
+        )
 
-    # 获得所有的 follower ids，按照 batch size 拆分开
-    follower_ids = FriendshipService.get_follower_ids(tweet_user_id)
-    index = 0
-    while index < len(follower_ids):
-        batch_ids = follower_ids[index: index + FANOUT_BATCH_SIZE]
-        # 拆成小的async task
-        fanout_newsfeeds_batch_task.delay(tweet_id, created_at, batch_ids)
-        index += FANOUT_BATCH_SIZE
+    # 在具体的 async task 中进行拆分，拆成一个个小的 async task
+    # follower ids 按照 batch size 分页地扫描出来，每扫到一页就创建一个 batch task
+    # 不需要把所有的 follower ids 都 load 进内存，第一个 batch 也可以马上开始
+    # checkpoint 是扫描 followers 的 keyset cursor，重试的时候从上次创建的最后一页之后继续
+    # 两次尝试之间的 follow / unfollow 不会让已经创建的页对应到别的 followers
+    cursor, batch_index = FanoutJob.get_checkpoint(tweet_id)
+    fanout_count, batches_count = 0, 0
+    pages = FriendshipService.iterate_follower_id_pages_with_cursor(
+        tweet_user_id,
+        FANOUT_BATCH_SIZE,
+        cursor,
+    )
+    for batch_ids, next_cursor in pages:
+        batch_key = FanoutJob.get_batch_key(cursor, next_cursor)
+        # 粉丝数决定了 batch 进哪个优先级的 lane
+        queue = get_fanout_queue(followers_count, batch_index)
+        fanout_newsfeeds_batch_task.apply_async(
+            args=(tweet_id, created_at, batch_ids, batch_key),
+            kwargs={'queue': queue, 'enqueued_at': time.time()},
+            queue=queue,
+            routing_key=queue,
+        )
+        FanoutJob.save_checkpoint(tweet_id, batch_key, next_cursor)
+        cursor = next_cursor
+        batch_index += 1
+        fanout_count += len(batch_ids)
+        batches_count += 1
 
+    # 所有的 batch 都创建完之后，所有的 batch 都完成之后 job 才算完成
+    FanoutJob.finish_dispatching(tweet_id)
     return '{} newsfeeds going to fanout, {} batches created.'.format(
-        len(follower_ids),
-        (len(follower_ids) - 1) // FANOUT_BATCH_SIZE + 1,
+        fanout_count,
+        batches_count,
+    )
+
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def rebuild_newsfeeds_task(user_id, since=None):
+    # import 写在里面避免循环依赖
+    from newsfeeds.services import NewsFeedService
+
+    rebuilt_count = NewsFeedService.rebuild_newsfeeds(user_id, since)
+    return '{} newsfeeds rebuilt for user {}.'.format(rebuilt_count, user_id)
+
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def repair_newsfeeds_after_follow_task(from_user_id, to_user_id):
+    # import 写在里面避免循环依赖
+    from newsfeeds.services import NewsFeedService
+
+    merged_count = NewsFeedService.merge_tweets_into_newsfeeds(from_user_id, to_user_id)
+    return '{} tweets of user {} merged into newsfeeds of user {}.'.format(
+        merged_count,
+        to_user_id,
+        from_user_id,
+    )
+
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def repair_newsfeeds_after_unfollow_task(from_user_id, to_user_id):
+    # import 写在里面避免循环依赖
+    from newsfeeds.services import NewsFeedService
+
+    removed_count = NewsFeedService.remove_tweets_from_newsfeeds(from_user_id, to_user_id)
+    return '{} tweets of user {} removed from newsfeeds of user {}.'.format(
+        removed_count,
+        to_user_id,
+        from_user_id,
+    )
+
+
+@shared_task(routing_key='newsfeeds', time_limit=ONE_HOUR)
+def retract_newsfeeds_batch_task(tweet_id, created_at, user_ids):
+    # import 写在里面避免循环依赖
+    from newsfeeds.services import NewsFeedService
+
+    deleted_count = NewsFeedService.batch_delete(tweet_id, created_at, user_ids)
+    return '{} newsfeeds deleted'.format(deleted_count)
+
+
+@shared_task(routing_key='default', time_limit=ONE_HOUR)
+def retract_newsfeeds_main_task(tweet_id, created_at, tweet_user_id):
+    """
+    tweet 被删除之后，按照和 fanout 一样的方式拆成 batch 去删除 newsfeeds
+    明星用户的粉丝也要处理，成为明星用户之前 fanout 出去的 newsfeeds 也需要删除
+    """
+    # import 写在里面避免循环依赖
+    from newsfeeds.services import NewsFeedService
+
+    users_count, batches_count = 0, 0
+    pages = NewsFeedService.iterate_newsfeed_user_id_pages(tweet_id, tweet_user_id, FANOUT_BATCH_SIZE)
+    for batch_ids in pages:
+        retract_newsfeeds_batch_task.delay(tweet_id, created_at, batch_ids)
+        users_count += len(batch_ids)
+        batches_count += 1
+
+    return '{} newsfeeds going to retract, {} batches created.'.format(
+        users_count,
+        batches_count,
     )
@@ -1,9 +1,32 @@
+import time
+
+from django.conf import settings
+
+from accounts.constants import USER_ACTIVE_WINDOW
+from accounts.services import UserService
+from friendships.services import FriendshipService
 from gatekeeper.models import GateKeeper
+from newsfeeds.constants import (
+    CELEBRITY_FOLLOWERS_THRESHOLD,
+    FANOUT_BATCH_SIZE,
+    FANOUT_HIGH_PRIORITY_QUEUE,
+    FANOUT_LOW_PRIORITY_FOLLOWERS_THRESHOLD,
+    FANOUT_LOW_PRIORITY_QUEUE,
+    FANOUT_NORMAL_PRIORITY_QUEUE,
+)
+from newsfeeds.fanout_job import FanoutJob
+from newsfeeds.models import NewsFeed
 from newsfeeds.services import NewsFeedService
-from newsfeeds.tasks import fanout_newsfeeds_main_task
+from newsfeeds.tasks import (
+    fanout_newsfeeds_batch_task,
+    fanout_newsfeeds_main_task,
+    get_fanout_queue,
+    rebuild_newsfeeds_task,
+)
 from testing.testcases import TestCase
+from tweets.services import TweetService
 
-from twitter.cache import USER_NEWSFEEDS_PATTERN
+from twitter.cache import USER_LAST_ACTIVE_KEY, USER_NEWSFEEDS_PATTERN
 from utils.redis_client import RedisClient
 
 
@@ -52,6 +75,42 @@ class NewsFeedServiceTests(TestCase):
         feeds = NewsFeedService.get_cached_newsfeeds(self.lisa.id)
         self.assertEqual([f.created_at for f in feeds], [feed2.created_at, feed1.created_at])
 
+    def test_batch_create_pushes_to_cached_keys_only(self):
+        # lisa 的 cache 已经存在，emma 的 cache 不存在
+        self.create_newsfeed(self.lisa, self.create_tweet(self.lisa))
+        NewsFeedService.get_cached_newsfeeds(self.lisa.id)
+        tweet = self.create_tweet(self.emma)
+        conn = RedisClient.get_connection()
+        lisa_key = USER_NEWSFEEDS_PATTERN.format(user_id=self.lisa.id)
+        emma_key = USER_NEWSFEEDS_PATTERN.format(user_id=self.emma.id)
+        conn.delete(emma_key)
+
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            created_at = tweet.timestamp
+        else:
+            created_at = tweet.created_at
+        NewsFeedService.batch_create([
+            {'user_id': user.id, 'created_at': created_at, 'tweet_id': tweet.id}
+            for user in [self.lisa, self.emma]
+        ])
+        self.assertEqual(conn.llen(lisa_key), 2)
+        self.assertEqual(conn.exists(emma_key), False)
+
+        # cold key 在读取的时候从存储里 load
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.emma.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id])
+
+    def test_filter_retracted_newsfeeds(self):
+        tweets = [self.create_tweet(self.emma) for _ in range(2)]
+        newsfeeds = [self.create_newsfeed(self.lisa, tweet) for tweet in tweets]
+        self.assertEqual(NewsFeedService.filter_retracted_newsfeeds(newsfeeds), newsfeeds)
+
+        TweetService.mark_retracted(tweets[0].id)
+        self.assertEqual(
+            [f.tweet_id for f in NewsFeedService.filter_retracted_newsfeeds(newsfeeds)],
+            [tweets[1].id],
+        )
+
 
 class NewsFeedTaskTests(TestCase):
 
@@ -104,3 +163,271 @@ class NewsFeedTaskTests(TestCase):
         self.assertEqual(len(cached_list), 3)
         cached_list = NewsFeedService.get_cached_newsfeeds(self.emma.id)
         self.assertEqual(len(cached_list), 3)
+
+    def test_fanout_main_task_for_celebrity(self):
+        for i in range(CELEBRITY_FOLLOWERS_THRESHOLD - 1):
+            user = self.create_user('follower{}'.format(i))
+            self.create_friendship(user, self.lisa)
+        self.create_friendship(self.emma, self.lisa)
+
+        tweet = self.create_tweet(self.lisa, 'celebrity tweet')
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            created_at = tweet.timestamp
+        else:
+            created_at = tweet.created_at
+        msg = fanout_newsfeeds_main_task(tweet.id, created_at, self.lisa.id)
+        self.assertEqual(msg, '{} followers of celebrity {} will pull the tweet.'.format(
+            CELEBRITY_FOLLOWERS_THRESHOLD,
+            self.lisa.id,
+        ))
+        self.assertEqual(NewsFeedService.get_celebrity_ids(), {self.lisa.id})
+        # 只 push 给了自己
+        self.assertEqual(NewsFeedService.count(self.lisa.id), 1)
+        self.assertEqual(NewsFeedService.count(self.emma.id), 0)
+
+        # 粉丝读取时 pull 明星用户的 tweets，并与 push 过来的 newsfeeds 合并
+        other_tweet = self.create_tweet(self.emma, 'normal tweet')
+        self.create_newsfeed(self.emma, other_tweet)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.emma.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [other_tweet.id, tweet.id])
+
+        # 掉粉到阈值以下之后恢复 push
+        FriendshipService.unfollow(self.emma.id, self.lisa.id)
+        # 缓存的粉丝数随着 unfollow 增量更新，不需要重新 count
+        self.assertEqual(
+            FriendshipService.get_cached_follower_count(self.lisa.id),
+            CELEBRITY_FOLLOWERS_THRESHOLD - 1,
+        )
+        tweet = self.create_tweet(self.lisa, 'normal tweet again')
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            created_at = tweet.timestamp
+        else:
+            created_at = tweet.created_at
+        fanout_newsfeeds_main_task(tweet.id, created_at, self.lisa.id)
+        self.assertEqual(NewsFeedService.get_celebrity_ids(), set())
+
+    def test_load_cached_newsfeeds_is_truncated(self):
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+        self.create_friendship(self.emma, self.lisa)
+        NewsFeedService.update_celebrity(self.lisa.id, CELEBRITY_FOLLOWERS_THRESHOLD)
+        for i in range(list_limit - 1):
+            tweet = self.create_tweet(self.lisa, 'tweet{}'.format(i))
+            newsfeed = self.create_newsfeed(self.emma, tweet)
+        # 重复 push 的 newsfeed 让 cache 达到了长度上限，合并去重之后又不足长度上限
+        NewsFeedService.push_newsfeed_to_cache(newsfeed)
+
+        newsfeeds, is_truncated = NewsFeedService.load_cached_newsfeeds(self.emma.id)
+        self.assertEqual(len(newsfeeds), list_limit - 1)
+        self.assertEqual(is_truncated, True)
+
+        # 第一页只从每个 list 里取出 limit 个
+        first_page, is_truncated = NewsFeedService.load_cached_newsfeeds(self.emma.id, limit=3)
+        self.assertEqual([f.tweet_id for f in first_page], [f.tweet_id for f in newsfeeds[:3]])
+        self.assertEqual(is_truncated, True)
+        self.assertEqual(NewsFeedService.get_followed_celebrity_ids(self.emma.id), {self.lisa.id})
+        self.assertEqual(NewsFeedService.get_followed_celebrity_ids(self.lisa.id), set())
+
+        # 没有明星用户的时候，按照 cache 的长度判断
+        newsfeeds, is_truncated = NewsFeedService.load_cached_newsfeeds(self.lisa.id)
+        self.assertEqual(is_truncated, False)
+
+    def test_fanout_to_active_users(self):
+        GateKeeper.turn_on('switch_fanout_to_active_users')
+        self.create_friendship(self.emma, self.lisa)
+        dormant = self.create_user('dormant')
+        self.create_friendship(dormant, self.lisa)
+        # 从来没有被记录过的 user 当作活跃的，打开 switch 之后也不会被跳过
+        untracked = self.create_user('untracked')
+        self.create_friendship(untracked, self.lisa)
+        UserService.mark_active(self.emma.id)
+        conn = RedisClient.get_connection()
+        conn.zadd(USER_LAST_ACTIVE_KEY, {dormant.id: time.time() - USER_ACTIVE_WINDOW - 1})
+
+        tweet = self.create_tweet(self.lisa, 'tweet 1')
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            created_at = tweet.timestamp
+        else:
+            created_at = tweet.created_at
+        fanout_newsfeeds_main_task(tweet.id, created_at, self.lisa.id)
+        self.assertEqual(NewsFeedService.count(self.emma.id), 1)
+        self.assertEqual(NewsFeedService.count(untracked.id), 1)
+        self.assertEqual(NewsFeedService.count(dormant.id), 0)
+
+        # 不活跃的用户重新活跃之后，把错过的 tweets 补回来
+        msg = rebuild_newsfeeds_task(dormant.id)
+        self.assertEqual(msg, '1 newsfeeds rebuilt for user {}.'.format(dormant.id))
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(dormant.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id])
+
+        # 重复重建不会产生重复的 newsfeeds
+        rebuild_newsfeeds_task(dormant.id)
+        self.assertEqual(NewsFeedService.count(dormant.id), 1)
+
+    def test_fanout_to_active_users_by_percent(self):
+        GateKeeper.set_kv('switch_fanout_to_active_users', 'percent', 50)
+        conn = RedisClient.get_connection()
+        # 找到被放进 gatekeeper 和没有被放进 gatekeeper 的两个不活跃的 followers
+        dormant_users = {}
+        for i in range(100):
+            user = self.create_user('dormant{}'.format(i))
+            in_gk = GateKeeper.in_gk('switch_fanout_to_active_users', user.id)
+            if in_gk in dormant_users:
+                continue
+            self.create_friendship(user, self.lisa)
+            conn.zadd(USER_LAST_ACTIVE_KEY, {user.id: time.time() - USER_ACTIVE_WINDOW - 1})
+            dormant_users[in_gk] = user
+            if len(dormant_users) == 2:
+                break
+
+        tweet = self.create_tweet(self.lisa, 'tweet 1')
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            created_at = tweet.timestamp
+        else:
+            created_at = tweet.created_at
+        fanout_newsfeeds_main_task(tweet.id, created_at, self.lisa.id)
+        # 只有被放进 gatekeeper 的不活跃用户被跳过
+        self.assertEqual(NewsFeedService.count(dormant_users[True].id), 0)
+        self.assertEqual(NewsFeedService.count(dormant_users[False].id), 1)
+
+    def test_fanout_resume_from_checkpoint(self):
+        followers = []
+        for i in range(4):
+            user = self.create_user('follower{}'.format(i))
+            self.create_friendship(user, self.lisa)
+            followers.append(user)
+        # 预热 cache，检查重试之后 cache 里没有重复的 newsfeeds
+        for user in followers:
+            self.create_newsfeed(user, self.create_tweet(self.emma))
+            NewsFeedService.get_cached_newsfeeds(user.id)
+
+        tweet = self.create_tweet(self.lisa, 'tweet')
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            created_at = tweet.timestamp
+        else:
+            created_at = tweet.created_at
+
+        # 模拟第一次 fanout 只创建并完成了第一个 batch 就挂掉了
+        first_page, cursor = next(FriendshipService.iterate_follower_id_pages_with_cursor(
+            self.lisa.id,
+            3,
+        ))
+        batch_key = FanoutJob.get_batch_key(None, cursor)
+        fanout_newsfeeds_batch_task(tweet.id, created_at, first_page, batch_key)
+        FanoutJob.save_checkpoint(tweet.id, batch_key, cursor)
+        self.assertEqual(FanoutJob.is_done(tweet.id), False)
+        msg = fanout_newsfeeds_batch_task(tweet.id, created_at, first_page, batch_key)
+        self.assertEqual(msg, 'batch {} of tweet {} is already done.'.format(batch_key, tweet.id))
+
+        # 两次尝试之间有 unfollow 和 follow，不会影响已经完成的页
+        FriendshipService.unfollow(followers[0].id, self.lisa.id)
+        new_follower = self.create_user('new_follower')
+        self.create_friendship(new_follower, self.lisa)
+
+        # 重试的时候从 checkpoint 的 cursor 之后继续
+        msg = fanout_newsfeeds_main_task(tweet.id, created_at, self.lisa.id)
+        self.assertEqual(msg, '2 newsfeeds going to fanout, 1 batches created.')
+        self.assertEqual(FanoutJob.is_done(tweet.id), True)
+        for user in followers:
+            self.assertEqual(NewsFeedService.count(user.id), 2)
+            newsfeeds = NewsFeedService.get_cached_newsfeeds(user.id)
+            self.assertEqual([f.tweet_id for f in newsfeeds].count(tweet.id), 1)
+        self.assertEqual(NewsFeedService.count(new_follower.id), 1)
+        self.assertEqual(NewsFeedService.count(self.lisa.id), 1)
+
+        # fanout 完成之后再重试不会有任何效果
+        msg = fanout_newsfeeds_main_task(tweet.id, created_at, self.lisa.id)
+        self.assertEqual(msg, 'fanout of tweet {} is already done.'.format(tweet.id))
+
+        # 没有 checkpoint 的 batch 重复执行也不会产生重复的数据
+        fanout_newsfeeds_batch_task(tweet.id, created_at, [followers[0].id])
+        self.assertEqual(NewsFeedService.count(followers[0].id), 2)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(followers[0].id)
+        self.assertEqual([f.tweet_id for f in newsfeeds].count(tweet.id), 1)
+
+    def test_fanout_priority_lanes(self):
+        threshold = FANOUT_LOW_PRIORITY_FOLLOWERS_THRESHOLD
+        self.assertEqual(get_fanout_queue(1, 0), FANOUT_HIGH_PRIORITY_QUEUE)
+        self.assertEqual(get_fanout_queue(threshold, 0), FANOUT_HIGH_PRIORITY_QUEUE)
+        self.assertEqual(get_fanout_queue(threshold - 1, 1), FANOUT_NORMAL_PRIORITY_QUEUE)
+        self.assertEqual(get_fanout_queue(threshold, 1), FANOUT_LOW_PRIORITY_QUEUE)
+
+        for i in range(threshold):
+            user = self.create_user('follower{}'.format(i))
+            self.create_friendship(user, self.lisa)
+        tweet = self.create_tweet(self.lisa)
+        if GateKeeper.is_switch_on('switch_newsfeed_to_hbase'):
+            created_at = tweet.timestamp
+        else:
+            created_at = tweet.created_at
+        fanout_newsfeeds_main_task(tweet.id, created_at, self.lisa.id)
+
+        # 记录了每个 lane 的等待时间
+        lags = NewsFeedService.get_fanout_queue_lags()
+        self.assertEqual(set(lags.keys()), {FANOUT_HIGH_PRIORITY_QUEUE, FANOUT_LOW_PRIORITY_QUEUE})
+
+    def test_merge_tweets_into_mysql_newsfeeds(self):
+        GateKeeper.set_kv('switch_newsfeed_to_hbase', 'percent', 0)
+        lisa_tweet = self.create_tweet(self.lisa)
+        emma_tweet = self.create_tweet(self.emma)
+        self.create_newsfeed(self.emma, emma_tweet)
+
+        # 合并进来的旧 tweet 保持 tweet 的时间，不会排到 newsfeeds 的最前面
+        NewsFeedService.merge_tweets_into_newsfeeds(self.emma.id, self.lisa.id)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.emma.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [emma_tweet.id, lisa_tweet.id])
+        self.assertEqual(newsfeeds[1].created_at, lisa_tweet.created_at)
+
+    def test_fanout_to_mysql_newsfeeds(self):
+        GateKeeper.set_kv('switch_newsfeed_to_hbase', 'percent', 0)
+        followers = [self.create_user('follower{}'.format(i)) for i in range(FANOUT_BATCH_SIZE + 1)]
+        for follower in followers:
+            self.create_friendship(follower, self.lisa)
+        tweet = self.create_tweet(self.lisa)
+
+        # fanout 传的是 micro seconds 的 timestamp，写入 mysql 之前要转换成 datetime
+        fanout_newsfeeds_main_task(tweet.id, tweet.timestamp, self.lisa.id)
+        self.assertTrue(FanoutJob.is_done(tweet.id))
+        for user in [self.lisa] + followers:
+            newsfeed = NewsFeed.objects.get(user=user, tweet=tweet)
+            self.assertEqual(newsfeed.created_at, tweet.created_at)
+            newsfeeds = NewsFeedService.get_cached_newsfeeds(user.id)
+            self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id])
+
+    def test_retract_tweet_from_mysql_newsfeeds(self):
+        GateKeeper.set_kv('switch_newsfeed_to_hbase', 'percent', 0)
+        self.create_friendship(self.emma, self.lisa)
+        tweet = self.create_tweet(self.lisa)
+        fanout_newsfeeds_main_task(tweet.id, tweet.timestamp, self.lisa.id)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.emma.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [tweet.id])
+
+        # 按照 tweet 的索引扫描 newsfeeds，unfollow 之后的用户也会被删除
+        FriendshipService.unfollow(self.emma.id, self.lisa.id)
+        NewsFeedService.retract_tweet(tweet)
+        self.assertEqual(NewsFeedService.count(self.emma.id), 0)
+        self.assertEqual(NewsFeedService.count(self.lisa.id), 0)
+        # cache 被直接失效，而不是留着被删除的 tweet
+        conn = RedisClient.get_connection()
+        self.assertEqual(conn.exists(USER_NEWSFEEDS_PATTERN.format(user_id=self.emma.id)), 0)
+        self.assertEqual(NewsFeedService.get_cached_newsfeeds(self.emma.id), [])
+
+    def test_repair_newsfeeds_on_follow_and_unfollow(self):
+        GateKeeper.turn_on('switch_repair_newsfeeds_on_follow')
+        lisa_tweets = [self.create_tweet(self.lisa) for _ in range(2)]
+        emma_tweet = self.create_tweet(self.emma)
+        self.create_newsfeed(self.emma, emma_tweet)
+        NewsFeedService.get_cached_newsfeeds(self.emma.id)
+
+        # follow 之后被关注的人最近的 tweets 合并进 newsfeeds
+        self.create_friendship(self.emma, self.lisa)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.emma.id)
+        self.assertEqual(
+            [f.tweet_id for f in newsfeeds],
+            [emma_tweet.id, lisa_tweets[1].id, lisa_tweets[0].id],
+        )
+
+        # unfollow 之后被取关的人的 tweets 从 newsfeeds 里删掉
+        FriendshipService.unfollow(self.emma.id, self.lisa.id)
+        newsfeeds = NewsFeedService.get_cached_newsfeeds(self.emma.id)
+        self.assertEqual([f.tweet_id for f in newsfeeds], [emma_tweet.id])
+        self.assertEqual(NewsFeedService.count(self.emma.id), 1)
@@ -9,6 +9,7 @@ from django_hbase.models import HBaseModel
 from friendships.services import FriendshipService
 from gatekeeper.models import GateKeeper
 from likes.models import Like
+from likes.services import LikeService
 from newsfeeds.services import NewsFeedService
 from tweets.models import Tweet
 from utils.redis_client import RedisClient
@@ -35,6 +36,7 @@ class TestCase(DjangoTestCase):
 
     def clear_cache(self):
         RedisClient.clear()
+        GateKeeper.clear_local_cache()
         caches['testing'].clear()
         # open the switch for hbase
         # 测试时手动 comment / uncomment
@@ -83,13 +85,17 @@ class TestCase(DjangoTestCase):
         return Comment.objects.create(user=user, tweet=tweet, content=content)
 
     def create_like(self, user, target):
-        instance, _ = Like.objects.get_or_create(  # 只能点一次赞
+        instance, created = Like.objects.get_or_create(  # 只能点一次赞
             # target can be comment or tweet
             # 通过 model 的名字，找到 model 对应的 ContentType 的 object
             content_type=ContentType.objects.get_for_model(target.__class__),
             object_id=target.id,
             user=user,
         )
+        # Like 上没有 signal receiver，likes_count 和 recent likers 的 cache 需要手动同步
+        if created:
+            LikeService.incr_likes_count(instance.content_type_id, instance.object_id, 1)
+        LikeService.sync_like(instance.user_id, instance.content_type_id, instance.object_id)
         return instance
 
     def create_user_and_client(self, *args, **kwargs):
@@ -3,11 +3,13 @@ from rest_framework.exceptions import ValidationError
 
 from accounts.api.serializers import UserSerializerForTweet, UserSerializer
 from comments.api.serializers import CommentSerializer
+from comments.services import CommentService
 from likes.api.serializers import LikeSerializer
 from likes.services import LikeService
-from tweets.constants import TWEET_PHOTOS_UPLOAD_LIMIT
+from tweets.constants import TWEET_DETAIL_PREVIEW_SIZE, TWEET_PHOTOS_UPLOAD_LIMIT
 from tweets.models import Tweet
 from tweets.services import TweetService
+from utils.paginations import encode_cursor
 from utils.redis_helper import RedisHelper
 
 
@@ -108,28 +110,75 @@ class TweetSerializerForCreate(serializers.ModelSerializer):
 
 
 class TweetSerializerForDetail(TweetSerializer):
+    """
+    热门 tweet 可能有上万条 comments 和 likes，详情页中只展示最新的 TWEET_DETAIL_PREVIEW_SIZE 条
+    如果还有更多，返回 *_next_cursor，前端原样作为 cursor 参数去对应的 list api 翻页
+    例如 GET /api/comments/?tweet_id=xxx&cursor=<comments_next_cursor>
+    """
     user = UserSerializer()
-    comments = CommentSerializer(source='comment_set', many=True)
-    likes = LikeSerializer(source='like_set', many=True)
-
-    # # 使用 serializers.SerializerMethodField 实现 comments
-    # comments = serializers.SerializerMethodField()
-    #
-    # def get_comments(self, obj):
-    #     return CommentSerializer(obj.comment_set.all(), many=True).data
+    comments = serializers.SerializerMethodField()
+    likes = serializers.SerializerMethodField()
+    comments_next_cursor = serializers.SerializerMethodField()
+    likes_next_cursor = serializers.SerializerMethodField()
 
     class Meta:
         model = Tweet
         fields = (
             'id',
             'user',
-            'comments',
             'created_at',
             'content',
             'likes',
             'comments',
+            'likes_next_cursor',
+            'comments_next_cursor',
             'likes_count',
             'comments_count',
             'has_liked',
             'photo_urls',
         )
+
+    def _get_preview(self, obj: Tweet, attr, load_func):
+        """
+        多取一个用来判断是否还有下一页
+        结果存在 tweet object 上，避免 get_xxx 和 get_xxx_next_cursor 重复访问
+        不能存在 serializer 上，many=True 的时候同一个 serializer 会处理多个 tweets
+        """
+        cache_attr = '_cached_{}_preview'.format(attr)
+        if not hasattr(obj, cache_attr):
+            objects = list(load_func(TWEET_DETAIL_PREVIEW_SIZE + 1))
+            setattr(obj, cache_attr, objects)
+        return getattr(obj, cache_attr)
+
+    def _get_next_cursor(self, objects):
+        if len(objects) <= TWEET_DETAIL_PREVIEW_SIZE:
+            return None
+        return encode_cursor(objects[TWEET_DETAIL_PREVIEW_SIZE - 1])
+
+    def _get_preview_comments(self, obj: Tweet):
+        return self._get_preview(
+            obj,
+            'comments',
+            lambda limit: CommentService.get_cached_comments(obj.id, limit=limit),
+        )
+
+    def _get_preview_likes(self, obj: Tweet):
+        return self._get_preview(
+            obj,
+            'likes',
+            lambda limit: LikeService.get_cached_recent_likes(Tweet, obj.id, limit=limit),
+        )
+
+    def get_comments(self, obj: Tweet):
+        comments = self._get_preview_comments(obj)[:TWEET_DETAIL_PREVIEW_SIZE]
+        return CommentSerializer(comments, many=True, context=self.context).data
+
+    def get_likes(self, obj: Tweet):
+        likes = self._get_preview_likes(obj)[:TWEET_DETAIL_PREVIEW_SIZE]
+        return LikeSerializer(likes, many=True, context=self.context).data
+
+    def get_comments_next_cursor(self, obj: Tweet):
+        return self._get_next_cursor(self._get_preview_comments(obj))
+
+    def get_likes_next_cursor(self, obj: Tweet):
+        return self._get_next_cursor(self._get_preview_likes(obj))
@@ -1,16 +1,21 @@
 from django.core.files.uploadedfile import SimpleUploadedFile
 from rest_framework import status
-from rest_framework.test import APIClient
+from rest_framework.test import APIClient, APIRequestFactory
 from testing.testcases import TestCase
 
 
 # 注意要加 '/' 结尾，要不然会产生 301 redirect
+from newsfeeds.services import NewsFeedService
+from tweets.constants import TWEET_DETAIL_PREVIEW_SIZE
+from tweets.api.serializers import TweetSerializerForDetail
 from tweets.models import Tweet, TweetPhoto
-from utils.paginations import EndlessPagination
+from utils.paginations import EndlessPagination, decode_cursor, encode_cursor, get_timestamp
 
 TWEET_LIST_API = '/api/tweets/'
 TWEET_CREATE_API = '/api/tweets/'
 TWEET_RETRIEVE_API = '/api/tweets/{}/'
+TWEET_DESTROY_API = '/api/tweets/{}/'
+NEWSFEED_LIST_API = '/api/newsfeeds/'
 
 
 class TweetApiTests(TestCase):
@@ -171,6 +176,53 @@ class TweetApiTests(TestCase):
 
         response = self.anonymous_client.get(url)
         self.assertEqual(len(response.data['comments']), 2)
+        self.assertEqual(response.data['comments_next_cursor'], None)
+
+    def test_retrieve_preview(self):
+        tweet = self.create_tweet(self.user1)
+        comments, likes = [], []
+        for i in range(TWEET_DETAIL_PREVIEW_SIZE + 1):
+            user = self.create_user('someone{}'.format(i))
+            comments.append(self.create_comment(user, tweet, 'comment{}'.format(i)))
+            likes.append(self.create_like(user, tweet))
+        comments, likes = comments[::-1], likes[::-1]
+
+        # 只展示最新的 TWEET_DETAIL_PREVIEW_SIZE 条 comments 和 likes
+        url = TWEET_RETRIEVE_API.format(tweet.id)
+        response = self.anonymous_client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['comments']), TWEET_DETAIL_PREVIEW_SIZE)
+        self.assertEqual(len(response.data['likes']), TWEET_DETAIL_PREVIEW_SIZE)
+        self.assertEqual(response.data['comments'][0]['id'], comments[0].id)
+        self.assertEqual(response.data['likes'][0]['user']['id'], likes[0].user_id)
+        self.assertEqual(
+            response.data['comments_next_cursor'],
+            encode_cursor(comments[TWEET_DETAIL_PREVIEW_SIZE - 1]),
+        )
+        # cache 里的 likes 没有 id，cursor 里只有时间戳
+        self.assertEqual(
+            decode_cursor(response.data['likes_next_cursor']),
+            (get_timestamp(likes[TWEET_DETAIL_PREVIEW_SIZE - 1]), None),
+        )
+
+        # 用 cursor 翻页取剩下的 comments
+        response = self.anonymous_client.get('/api/comments/', {
+            'tweet_id': tweet.id,
+            'cursor': response.data['comments_next_cursor'],
+        })
+        self.assertEqual(len(response.data['comments']), 1)
+        self.assertEqual(response.data['comments'][0]['id'], comments[-1].id)
+
+    def test_detail_serializer_with_many_tweets(self):
+        tweets = [self.create_tweet(self.user1), self.create_tweet(self.user2)]
+        comments = [self.create_comment(self.user2, tweet) for tweet in tweets]
+
+        # 每条 tweet 的 preview 是各自的，不会复用第一条 tweet 的
+        request = APIRequestFactory().get(TWEET_RETRIEVE_API.format(tweets[0].id))
+        request.user = self.user1
+        data = TweetSerializerForDetail(tweets, many=True, context={'request': request}).data
+        self.assertEqual([item['comments'][0]['id'] for item in data], [c.id for c in comments])
+        self.assertEqual([item['comments_next_cursor'] for item in data], [None, None])
 
     def test_pagination(self):
         page_size = EndlessPagination.page_size
@@ -219,3 +271,31 @@ class TweetApiTests(TestCase):
         self.assertEqual(response.data['has_next_page'], False)
         self.assertEqual(len(response.data['results']), 1)
         self.assertEqual(response.data['results'][0]['id'], new_tweet.id)
+
+    def test_destroy(self):
+        self.create_friendship(self.user2, self.user1)
+        user2_client = APIClient()
+        user2_client.force_authenticate(self.user2)
+        response = self.user1_client.post(TWEET_CREATE_API, {'content': 'to be deleted'})
+        tweet_id = response.data['id']
+        url = TWEET_DESTROY_API.format(tweet_id)
+        response = user2_client.get(NEWSFEED_LIST_API)
+        self.assertEqual(response.data['results'][0]['tweet']['id'], tweet_id)
+
+        # 验证匿名和非本人不能删除
+        response = self.anonymous_client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = user2_client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        # 验证本人可以删除，fanout 出去的 newsfeeds 也被删除
+        response = self.user1_client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Tweet.objects.filter(id=tweet_id).exists(), False)
+        self.assertEqual(NewsFeedService.count(self.user1.id), 0)
+        self.assertEqual(NewsFeedService.count(self.user2.id), 0)
+        for client in [self.user1_client, user2_client]:
+            response = client.get(NEWSFEED_LIST_API)
+            self.assertEqual(len(response.data['results']), 0)
+        response = self.anonymous_client.get(TWEET_LIST_API, {'user_id': self.user1.id})
+        self.assertEqual(len(response.data['results']), 3)
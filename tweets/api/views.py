@@ -1,5 +1,4 @@
 from django.utils.decorators import method_decorator
-from ratelimit.decorators import ratelimit
 from rest_framework import viewsets, status
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.request import Request
@@ -14,6 +13,8 @@ from tweets.models import Tweet
 from tweets.services import TweetService
 from utils.decorators import required_params
 from utils.paginations import EndlessPagination
+from utils.permissions import IsObjectOwner
+from utils.ratelimit import ratelimit
 
 
 class TweetViewSet(viewsets.GenericViewSet):
@@ -28,6 +29,8 @@ class TweetViewSet(viewsets.GenericViewSet):
         # self.action对应具体的带request的方法
         if self.action in ['list', 'retrieve']:
             return [AllowAny()]
+        if self.action == 'destroy':
+            return [IsAuthenticated(), IsObjectOwner()]
         return [IsAuthenticated()]
 
     @required_params(method='GET', params=['user_id'])
@@ -49,16 +52,18 @@ class TweetViewSet(viewsets.GenericViewSet):
         user_id = request.query_params['user_id']
         # tweets = Tweet.objects.filter(user_id=user_id).prefetch_related('user')
         cached_tweets = TweetService.get_cached_tweets(user_id)
-        page = self.paginator.paginate_cached_list(cached_tweets, request)
-        if page is None:
-            # 这句查询会被翻译为
-            # select * from twitter_tweets
-            # where user_id = xxx
-            # order by created_at desc
-            # 这句 SQL 查询会用到 user 和 created_at 的联合索引
-            # 单纯的 user 索引是不够的
-            queryset = Tweet.objects.filter(user_id=user_id).order_by('-created_at')
-            page = self.paginate_queryset(queryset)
+        # 翻出 cache 的范围之后，这句查询会被翻译为
+        # select * from twitter_tweets
+        # where user_id = xxx and (created_at, id) < cursor
+        # order by created_at desc, id desc
+        # 这句 SQL 查询会用到 user 和 created_at 的联合索引
+        # 单纯的 user 索引是不够的
+        queryset = Tweet.objects.filter(user_id=user_id)
+        page = self.paginator.paginate_cached_list(
+            cached_tweets,
+            request,
+            self.paginator.queryset_loader(queryset),
+        )
         serializer = TweetSerializer(
             instance=page,
             context={'request': request},
@@ -83,8 +88,8 @@ class TweetViewSet(viewsets.GenericViewSet):
             status=status.HTTP_200_OK,
         )
 
-    @method_decorator(ratelimit(key='user', rate='1/s', method='POST', block=True))
-    @method_decorator(ratelimit(key='user', rate='5/m', method='POST', block=True))
+    # 两个 limits 在一次 redis 调用里一起判断
+    @method_decorator(ratelimit(key='user', rate=('1/s', '5/m'), method='POST', block=True))
     def create(self, request: Request):
         """
         POST /api/tweets/
@@ -118,3 +123,15 @@ class TweetViewSet(viewsets.GenericViewSet):
             serializer.data,
             status=status.HTTP_201_CREATED,
         )
+
+    @method_decorator(ratelimit(key='user', rate='5/s', method='DELETE', block=True))
+    def destroy(self, request: Request, *args, **kwargs):
+        """
+        DELETE /api/tweets/<pk>/
+        fanout 出去的 newsfeeds 会被异步地删除
+        """
+        tweet = self.get_object()
+        NewsFeedService.retract_tweet(tweet)
+        return Response({
+            'success': True,
+        }, status=status.HTTP_200_OK)
@@ -1,3 +1,6 @@
+from django.conf import settings
+
+
 class TweetPhotoStatus:
     PENDING = 0
     APPROVED = 1
@@ -11,3 +14,6 @@ TWEET_PHOTO_STATUS_CHOICES = (
 )
 
 TWEET_PHOTOS_UPLOAD_LIMIT = 9
+
+# tweet 详情页中最多展示多少条最新的 comments 和 likes，其余的通过翻页获取
+TWEET_DETAIL_PREVIEW_SIZE = 20 if not settings.TESTING else 3
@@ -1,10 +1,10 @@
 from django.contrib.auth.models import User
-from django.contrib.contenttypes.models import ContentType
 from django.db import models
 from django.db.models.signals import post_save, pre_delete
 
 from likes.models import Like
 from tweets.listeners import push_tweet_to_cache
+from utils.content_type_helper import ContentTypeHelper
 from utils.listeners import invalidate_object_cache
 from utils.memcached_helper import MemcachedHelper
 from utils.time_helpers import utc_now
@@ -53,9 +53,9 @@ class Tweet(models.Model):
 
         # 只与当前 model 有关，不传入参数的，需在 tweet.py 中定义
         return Like.objects.filter(
-            content_type=ContentType.objects.get_for_model(Tweet),
+            content_type_id=ContentTypeHelper.get_content_type_id(Tweet),
             object_id=self.id,
-        ).order_by('-created_at')
+        ).order_by('-created_at', '-id')
 
     @property
     def cached_user(self):
@@ -1,11 +1,16 @@
+import time
+
+from django.conf import settings
+
 from tweets.models import TweetPhoto, Tweet
-from twitter.cache import USER_TWEETS_PATTERN
+from twitter.cache import RETRACTED_TWEET_IDS_KEY, USER_TWEETS_PATTERN
+from utils.redis_client import RedisClient
 from utils.redis_helper import RedisHelper
 
 
 def lazy_load_tweets(user_id):
     def _lazy_load(limit):
-        return Tweet.objects.filter(user_id=user_id).order_by('-created_at')[:limit]
+        return Tweet.objects.filter(user_id=user_id).order_by('-created_at', '-id')[:limit]
     return _lazy_load
 
 
@@ -26,15 +31,22 @@ class TweetService:
         TweetPhoto.objects.bulk_create(photos)
 
     @classmethod
-    def get_cached_tweets(cls, user_id):
+    def get_cached_tweets(cls, user_id, limit=None):
         # queryset 是 lazy loading 模式，
         # 未真正访问 / 转换成 list 结果，就不会真正触发数据库的查询
         key = USER_TWEETS_PATTERN.format(user_id=user_id)
         return RedisHelper.load_objects(
             key=key,
-            lazy_load_func=lazy_load_tweets(user_id)
+            lazy_load_func=lazy_load_tweets(user_id),
+            limit=limit,
         )
 
+    @classmethod
+    def iterate_cached_tweets(cls, user_id):
+        # 按照 created_at 倒序逐条返回，只会读取和 deserialize 被用到的部分
+        key = USER_TWEETS_PATTERN.format(user_id=user_id)
+        return RedisHelper.iterate_objects(key=key, lazy_load_func=lazy_load_tweets(user_id))
+
     @classmethod
     def push_tweet_to_cache(cls, tweet):
         key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
@@ -43,3 +55,41 @@ class TweetService:
             obj=tweet,
             lazy_load_func=lazy_load_tweets(tweet.user_id)
         )
+
+    @classmethod
+    def remove_tweet_from_cache(cls, tweet):
+        key = USER_TWEETS_PATTERN.format(user_id=tweet.user_id)
+        RedisHelper.remove_object(key, tweet)
+
+    @classmethod
+    def mark_retracted(cls, tweet_id):
+        """
+        tweet 被删除之后，fanout 出去的 newsfeeds 需要一段时间才能全部删除
+        在这段时间里用 tombstone 在读取的时候过滤掉这些 newsfeeds
+        tombstone 保留的时间和 cache 的过期时间一样，保证没删干净的 cache 也能被过滤掉
+        """
+        conn = RedisClient.get_connection()
+        now = time.time()
+        pipe = conn.pipeline()
+        pipe.zadd(RETRACTED_TWEET_IDS_KEY, {tweet_id: now})
+        pipe.zremrangebyscore(RETRACTED_TWEET_IDS_KEY, 0, now - settings.REDIS_KEY_EXPIRE_TIME)
+        pipe.execute()
+
+    @classmethod
+    def get_retracted_tweet_ids(cls, tweet_ids):
+        """
+        返回 tweet_ids 里已经被删除的 tweet ids，用 pipeline 一次查询
+        """
+        if not tweet_ids:
+            return set()
+
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline(transaction=False)
+        for tweet_id in tweet_ids:
+            pipe.zscore(RETRACTED_TWEET_IDS_KEY, tweet_id)
+        scores = pipe.execute()
+        return set(
+            tweet_id
+            for tweet_id, score in zip(tweet_ids, scores)
+            if score is not None
+        )
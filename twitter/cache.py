@@ -1,8 +1,30 @@
 # memcached
-FOLLOWINGS_PATTERN = 'followings:{user_id}'
 # 通常会把 user_id 作为外键放在很多表单中，而不会把 user profile id 作为外键
 USER_PROFILE_PATTERN = 'userprofile:{user_id}'
 
 # redis
 USER_TWEETS_PATTERN = 'user_tweets:{user_id}'
 USER_NEWSFEEDS_PATTERN = 'user_newsfeeds:{user_id}'
+USER_FOLLOWINGS_PATTERN = 'user_followings:{user_id}'
+CELEBRITY_USER_IDS_KEY = 'celebrity_user_ids'
+USER_LAST_ACTIVE_KEY = 'user_last_active'
+FANOUT_JOB_PATTERN = 'fanout_job:{tweet_id}'
+FANOUT_JOB_BATCHES_PATTERN = 'fanout_job:{tweet_id}:batches'
+FANOUT_JOB_DONE_BATCHES_PATTERN = 'fanout_job:{tweet_id}:done_batches'
+FANOUT_QUEUE_LAG_KEY = 'fanout_queue_lag'
+RETRACTED_TWEET_IDS_KEY = 'retracted_tweet_ids'
+TWEET_COMMENTS_PATTERN = 'tweet_comments:{tweet_id}'
+RECENT_LIKERS_PATTERN = 'recent_likers:{content_type_id}:{object_id}'
+RATELIMIT_PATTERN = 'ratelimit:{group}:{identity}:{rate}'
+USER_UNREAD_NOTIFICATIONS_COUNT_PATTERN = 'user_unread_notifications_count:{user_id}'
+PENDING_NOTIFICATIONS_KEY = 'pending_notifications'
+PENDING_NOTIFICATIONS_FLUSH_KEY = 'pending_notifications:flush_scheduled'
+PENDING_NOTIFICATIONS_PROCESSING_KEY = 'pending_notifications:processing'
+PENDING_NOTIFICATIONS_PROCESSING_META_KEY = 'pending_notifications:processing_meta'
+PENDING_NOTIFICATIONS_DEAD_LETTER_KEY = 'pending_notifications:dead_letter'
+PENDING_NOTIFICATIONS_FLUSH_LOCK_KEY = 'pending_notifications:flush_lock'
+USER_NOTIFICATIONS_FIRST_PAGE_PATTERN = 'user_notifications_first_page:{user_id}'
+USER_NOTIFICATIONS_VERSION_PATTERN = 'user_notifications_version:{user_id}'
+USER_FOLLOWERS_COUNT_PATTERN = 'user_followers_count:{user_id}'
+USER_FOLLOWERS_COUNT_FRESH_PATTERN = 'user_followers_count:{user_id}:fresh'
+USER_FOLLOWERS_COUNT_LOCK_PATTERN = 'user_followers_count:{user_id}:lock'
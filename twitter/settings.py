@@ -56,6 +56,7 @@ INSTALLED_APPS = [
     'newsfeeds',
     'comments',
     'likes',
+    'inbox',
 ]
 
 REST_FRAMEWORK = {
@@ -74,6 +75,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'accounts.middlewares.UserActivityMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -197,12 +199,6 @@ CACHES = {
         'TIMEOUT': 86400,
         'KEY_PREFIX': 'testing',
     },
-    'ratelimit': {
-        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
-        'LOCATION': '127.0.0.1:11211',
-        'TIMEOUT': 86400 * 7,
-        'KEY_PREFIX': 'rl',
-    },
 }
 
 # Redis
@@ -217,18 +213,25 @@ REDIS_LIST_LENGTH_LIMIT = 1000 if not TESTING else 20
 # Celery Configuration Options
 # 使用如下命令把 worker 进程（只执行异步任务的进程，可以在不同的机器上）单独跑起来
 #   celery -A twitter worker -l INFO
+# fanout 的 batch 分了三个优先级的 lane，每个 lane 用单独的 worker 来限制并发数，
+# 大 V 的 fanout 最多只能占用 low lane 的 worker，不会影响其他 lane:
+#   celery -A twitter worker -l INFO -Q default -c 4
+#   celery -A twitter worker -l INFO -Q newsfeeds_high -c 8
+#   celery -A twitter worker -l INFO -Q newsfeeds -c 4
+#   celery -A twitter worker -l INFO -Q newsfeeds_low -c 2
 CELERY_BROKER_URL = 'redis://127.0.0.1:6379/2' if not TESTING \
     else 'redis://127.0.0.1:6379/0'
 CELERY_TIMEZONE = "UTC"
 CELERY_TASK_ALWAYS_EAGER = TESTING
 CELERY_QUEUES = (
     Queue('default', routing_key='default'),
+    Queue('newsfeeds_high', routing_key='newsfeeds_high'),
     Queue('newsfeeds', routing_key='newsfeeds'),
+    Queue('newsfeeds_low', routing_key='newsfeeds_low'),
 )
 
 # Rate Limiter
-RATELIMIT_USE_CACHE = 'ratelimit'
-RATELIMIT_CACHE_PREFIX = 'rl:'   # 避免和其他的 key 冲突
+# utils.ratelimit 用 redis 计数，一个 request 的所有 limits 只需要一次 redis 调用
 RATELIMIT_ENABLE = not TESTING  # 在某些环境下，比如内部测试等环境下，一般也会关掉
 
 
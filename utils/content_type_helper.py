@@ -0,0 +1,64 @@
+from django.contrib.contenttypes.models import ContentType
+
+
+class ContentTypeHelper:
+    """
+    进程级别的 content type 注册表，维护 model <-> content_type_id 的双向映射
+
+    likes / comments / inbox 的热路径上需要频繁地把 model 转换成 content_type_id，
+    或者把 like.content_type_id 转换回 model。
+    - ContentType.objects.get_for_model 每次都要走一遍 manager 的 cache 逻辑
+    - like.content_type.model_class() 在 content_type 没有被缓存时会产生一次 FK 的查询
+    注册表在 app ready 的时候注册需要的 model，在第一次使用时用一次查询全部 load 进内存，
+    之后所有的查找都只是 dict 的读取
+    """
+    model_classes = []
+    model_to_id = None
+    id_to_model = None
+
+    @classmethod
+    def register(cls, *model_classes):
+        for model_class in model_classes:
+            if model_class not in cls.model_classes:
+                cls.model_classes.append(model_class)
+        cls.clear()
+
+    @classmethod
+    def clear(cls, **kwargs):
+        # 可以作为 post_migrate 的 listener 使用，
+        # 比如测试时会重新建表，content_type_id 可能会发生变化
+        cls.model_to_id = None
+        cls.id_to_model = None
+
+    @classmethod
+    def load(cls):
+        if cls.model_to_id is not None:
+            return
+
+        # get_for_models 对于所有 model 只需要一次查询
+        content_types = ContentType.objects.get_for_models(*cls.model_classes)
+        cls.model_to_id = {
+            model_class: content_type.id
+            for model_class, content_type in content_types.items()
+        }
+        cls.id_to_model = {
+            content_type.id: model_class
+            for model_class, content_type in content_types.items()
+        }
+
+    @classmethod
+    def get_content_type_id(cls, model_class):
+        cls.load()
+        content_type_id = cls.model_to_id.get(model_class)
+        if content_type_id is not None:
+            return content_type_id
+        # 没有注册过的 model，退回到 django 自带的 ContentType cache
+        return ContentType.objects.get_for_model(model_class).id
+
+    @classmethod
+    def get_model_class(cls, content_type_id):
+        cls.load()
+        model_class = cls.id_to_model.get(content_type_id)
+        if model_class is not None:
+            return model_class
+        return ContentType.objects.get_for_id(content_type_id).model_class()
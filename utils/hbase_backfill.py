@@ -0,0 +1,242 @@
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import happybase
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max, Min
+
+from utils.redis_client import RedisClient
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    所有 worker 线程共享的限速器，控制每秒最多写入多少行
+    """
+
+    def __init__(self, rows_per_second):
+        self.rows_per_second = rows_per_second
+        self.lock = threading.Lock()
+        self.next_available_at = time.monotonic()
+
+    def acquire(self, rows):
+        if not self.rows_per_second:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_available_at - now
+            self.next_available_at = max(self.next_available_at, now) + rows / self.rows_per_second
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HBaseBackfill:
+    """
+    把一张 mysql 的表批量复制到 hbase 里，用于 GateKeeper 切换存储之前的数据迁移
+    - 按照 id 把整张表切成若干个区间，由线程池里的 worker 并发处理
+    - 每个 worker 在自己的区间里用 keyset pagination (id > last_id) 读取 mysql，
+      每次只取一页，不会因为 offset 越翻越慢，也不会把整张表 load 进内存
+    - 每一页转换成 hbase 的 rows 之后，通过 happybase 的 batch 缓冲批量写入
+    - 每写完一页，在 redis 里记录这个区间的 checkpoint，中断之后重新执行会从 checkpoint 继续
+    - 区间的划分在第一次执行时记录在 checkpoint 里，之后的执行沿用同样的区间，
+      不受表的增长和 workers 个数的影响，新写入的数据追加成新的区间
+    - 所有 worker 共享一个限速器，避免把 mysql 和 hbase 打满影响线上服务
+
+    to_rows(row) 把 queryset.values_list('id', *fields) 的一行转换成
+    [(hbase_model_class, data), ...]，返回空列表表示跳过这一行
+    """
+    RANGES_FIELD = 'ranges'
+
+    def __init__(
+        self,
+        name,
+        queryset,
+        fields,
+        to_rows,
+        page_size=1000,
+        workers=4,
+        rows_per_second=None,
+        log=None,
+    ):
+        self.name = name
+        self.queryset = queryset
+        self.fields = fields
+        self.to_rows = to_rows
+        self.page_size = page_size
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rows_per_second)
+        self.log = log or logger.info
+        self.checkpoint_key = 'hbase_backfill:{}'.format(name)
+
+    def run(self):
+        ranges = self._get_ranges()
+        if not ranges:
+            self.log('{}: nothing to backfill'.format(self.name))
+            return 0
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            copied_counts = list(executor.map(self._backfill_range, ranges))
+
+        copied_count = sum(copied_counts)
+        elapsed = time.perf_counter() - start
+        self.log('{}: {} rows copied in {:.1f}s ({:.0f} rows/s)'.format(
+            self.name,
+            copied_count,
+            elapsed,
+            copied_count / elapsed if elapsed else 0,
+        ))
+        return copied_count
+
+    def reset_checkpoints(self):
+        RedisClient.get_connection().delete(self.checkpoint_key)
+
+    def _get_ranges(self):
+        """
+        第一次执行时按照当前的 id 范围和 workers 个数划分区间，并记录在 checkpoint 里
+        之后的执行沿用记录的区间，每个区间的 checkpoint 才能对应上
+        """
+        bounds = self.queryset.aggregate(min_id=Min('id'), max_id=Max('id'))
+        redis_conn = RedisClient.get_connection()
+        saved_ranges = redis_conn.hget(self.checkpoint_key, self.RANGES_FIELD)
+        if saved_ranges is None:
+            if bounds['min_id'] is None:
+                return []
+            ranges = self._split_ranges(bounds['min_id'], bounds['max_id'])
+        else:
+            ranges = [tuple(id_range) for id_range in json.loads(saved_ranges)]
+            # 第一次执行之后新写入的数据，在最后追加新的区间
+            last_end = ranges[-1][1]
+            if bounds['max_id'] is not None and bounds['max_id'] > last_end:
+                ranges += self._split_ranges(last_end + 1, bounds['max_id'])
+
+        redis_conn.hset(self.checkpoint_key, self.RANGES_FIELD, json.dumps(ranges))
+        return ranges
+
+    def _split_ranges(self, min_id, max_id):
+        # 区间是左闭右闭的 [start, end]
+        range_size = (max_id - min_id) // self.workers + 1
+        return [
+            (start, min(start + range_size - 1, max_id))
+            for start in range(min_id, max_id + 1, range_size)
+        ]
+
+    def _backfill_range(self, id_range):
+        start, end = id_range
+        field = '{}-{}'.format(start, end)
+        redis_conn = RedisClient.get_connection()
+        checkpoint = redis_conn.hget(self.checkpoint_key, field)
+        last_id = int(checkpoint) if checkpoint is not None else start - 1
+        if last_id >= end:
+            return 0
+
+        # happybase 的 connection 不是线程安全的，每个 worker 用自己的 connection
+        hbase_conn = happybase.Connection(settings.HBASE_HOST)
+        batches = {}
+        copied_count = 0
+        try:
+            while True:
+                rows = list(
+                    self.queryset
+                    .filter(id__gt=last_id, id__lte=end)
+                    .order_by('id')
+                    .values_list('id', *self.fields)[:self.page_size]
+                )
+                if not rows:
+                    break
+
+                self.rate_limiter.acquire(len(rows))
+                for row in rows:
+                    for model_class, data in self.to_rows(row):
+                        if model_class not in batches:
+                            table = hbase_conn.table(model_class.get_table_name())
+                            # 超过 batch_size 个 mutations 的时候 happybase 会自动发送
+                            batches[model_class] = table.batch(batch_size=self.page_size)
+                        model_class(**data).save(batch=batches[model_class])
+
+                # 确保这一页都写进 hbase 之后才能记录 checkpoint
+                for batch in batches.values():
+                    batch.send()
+                last_id = rows[-1][0]
+                redis_conn.hset(self.checkpoint_key, field, last_id)
+                copied_count += len(rows)
+
+                if len(rows) < self.page_size:
+                    break
+        finally:
+            hbase_conn.close()
+            # django 的 db connection 是每个线程独立的，用完需要关掉
+            connection.close()
+
+        self.log('{}: range {} done, {} rows copied'.format(self.name, field, copied_count))
+        return copied_count
+
+    @classmethod
+    def count_hbase_rows(cls, hbase_conn, model_class, prefix):
+        # 只取 row key，不需要把每一行的数据传回来再 deserialize
+        table = hbase_conn.table(model_class.get_table_name())
+        rows = table.scan(
+            row_prefix=model_class.serialize_row_key_from_tuple(prefix),
+            filter=b'FirstKeyOnlyFilter() AND KeyOnlyFilter()',
+        )
+        return sum(1 for _ in rows)
+
+    def verify_counts(
+        self,
+        user_ids,
+        get_mysql_counts,
+        get_hbase_count,
+        range_size=1000,
+        sample_rate=None,
+    ):
+        """
+        按照 user 的区间比较 mysql 和 hbase 里每个 user 的行数
+        get_mysql_counts(user_ids) 返回 {user_id: count}，一个区间只需要一次 group by 查询
+        get_hbase_count(hbase_conn, user_id) 返回 hbase 里这个 user 的行数，
+        每个 user 都是一次 prefix scan，所以区间由线程池里的 workers 并发处理
+        sample_rate: 只随机抽查这个比例的 users，全量比较太慢的时候使用
+        返回所有不一致的 [(user_id, mysql_count, hbase_count), ...]
+        """
+        user_ids = list(user_ids)
+        if sample_rate is not None:
+            user_ids = [user_id for user_id in user_ids if random.random() < sample_rate]
+        user_id_ranges = [
+            user_ids[index: index + range_size]
+            for index in range(0, len(user_ids), range_size)
+        ]
+
+        def verify_range(range_user_ids):
+            return self._verify_range(range_user_ids, get_mysql_counts, get_hbase_count)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            range_mismatches = list(executor.map(verify_range, user_id_ranges))
+        return sum(range_mismatches, [])
+
+    def _verify_range(self, range_user_ids, get_mysql_counts, get_hbase_count):
+        # 和 backfill 一样，每个 worker 用自己的 hbase connection
+        hbase_conn = happybase.Connection(settings.HBASE_HOST)
+        try:
+            mysql_counts = get_mysql_counts(range_user_ids)
+            mismatches = []
+            for user_id in range_user_ids:
+                mysql_count = mysql_counts.get(user_id, 0)
+                hbase_count = get_hbase_count(hbase_conn, user_id)
+                if mysql_count != hbase_count:
+                    mismatches.append((user_id, mysql_count, hbase_count))
+        finally:
+            hbase_conn.close()
+            connection.close()
+
+        self.log('{}: users {}-{} verified, {} mismatches'.format(
+            self.name,
+            range_user_ids[0],
+            range_user_ids[-1],
+            len(mismatches),
+        ))
+        return mismatches
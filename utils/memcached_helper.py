@@ -21,6 +21,35 @@ class MemcachedHelper:
         cache.set(key, obj)
         return obj
 
+    @classmethod
+    def get_objects_through_cache(cls, model_class, object_ids):
+        """
+        批量版本的 get_object_through_cache，返回 {object_id: object}
+        一次 get_many 取出所有 cache hit 的 objects，
+        cache miss 的部分用一次 id__in 的查询从 db 中取出并回填
+        """
+        object_ids = set(object_id for object_id in object_ids if object_id is not None)
+        if not object_ids:
+            return {}
+
+        keys = {cls.get_key(model_class, object_id): object_id for object_id in object_ids}
+        cached = cache.get_many(list(keys.keys()))
+        objects = {keys[key]: obj for key, obj in cached.items() if obj}
+
+        missing_ids = [object_id for object_id in object_ids if object_id not in objects]
+        if not missing_ids:
+            return objects
+
+        # cache miss, read from db
+        missing_objects = model_class.objects.filter(id__in=missing_ids)
+        for obj in missing_objects:
+            objects[obj.id] = obj
+        cache.set_many({
+            cls.get_key(model_class, obj.id): obj
+            for obj in missing_objects
+        })
+        return objects
+
     @classmethod
     def invalidate_cached_object(cls, model_class, object_id):
         key = cls.get_key(model_class, object_id)
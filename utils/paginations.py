@@ -1,156 +1,257 @@
+import base64
+import bisect
+
+import pytz
 from dateutil import parser
 from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
 from rest_framework.pagination import BasePagination
 from rest_framework.request import Request
 from rest_framework.response import Response
 
 from django_hbase.models import HBaseModel
 from utils.time_constants import MAX_TIMESTAMP
+from utils.time_helpers import datetime_to_timestamp, timestamp_to_datetime
+
+
+def get_timestamp(obj):
+    # mysql 的 model 的 created_at 是 datetime，hbase 的 model 的 created_at 是 micro seconds 的 int
+    if isinstance(obj.created_at, int):
+        return obj.created_at
+    return datetime_to_timestamp(obj.created_at)
+
+
+def encode_cursor(obj):
+    """
+    把 object 的 (created_at, id) 编码成一个不透明的 cursor，前端原样传回 cursor 参数翻页
+    hbase 的 objects 没有 id，row key 里的 created_at 已经可以唯一确定位置
+    """
+    value = '{}:{}'.format(get_timestamp(obj), getattr(obj, 'id', None) or '')
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('utf-8').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    返回 (timestamp, id)，id 可能是 None
+    """
+    try:
+        value = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, object_id = value.split(':')
+        return int(timestamp), int(object_id) if object_id else None
+    except ValueError:
+        raise ValidationError({'cursor': 'Invalid cursor.'})
+
+
+class ReversedTimestampKeys:
+    """
+    把按照 created_at 倒序排列的 list 包装成一个升序的 key 序列给 bisect 使用
+    key 是 created_at 的 micro seconds 取负数，只在二分查找访问到的时候才计算
+    """
+
+    def __init__(self, reverse_ordered_list):
+        self.reverse_ordered_list = reverse_ordered_list
+
+    def __len__(self):
+        return len(self.reverse_ordered_list)
+
+    def __getitem__(self, index):
+        return -get_timestamp(self.reverse_ordered_list[index])
 
 
 class EndlessPagination(BasePagination):
+    """
+    按照 created_at 倒序翻页，支持三种参数:
+    - cursor: 上一页返回的 next_cursor，加载下一页
+    - created_at__lt: 兼容旧的参数，和 cursor 的作用一样，但是相同时间戳的 objects 可能会被跳过
+    - created_at__gt: 下拉刷新的时候加载比 created_at__gt 更新的所有 objects
+    """
     page_size = 20 if not settings.TESTING else 10
 
     def __init__(self):
         super(EndlessPagination, self).__init__()
         self.has_next_page = False  # 自定义一个field
+        self.next_cursor = None
 
     def to_html(self):
         pass
 
+    def _set_page(self, page, has_next_page):
+        self.has_next_page = has_next_page
+        self.next_cursor = encode_cursor(page[-1]) if has_next_page else None
+        return page
+
     def paginate_ordered_list(self, reverse_ordered_list, request):
-        if 'created_at__gt' in request.query_params:
-            # 兼容 iso 格式和 int 格式的时间戳
-
-            try:
-                created_at__gt = parser.isoparse(request.query_params['created_at__gt'])
-            except ValueError:
-                created_at__gt = int(request.query_params['created_at__gt'])
-
-            objects = []
-            for obj in reverse_ordered_list:
-                if obj.created_at > created_at__gt:
-                    objects.append(obj)
-                else:
-                    break
-            self.has_next_page = False
-            return objects
+        # reverse_ordered_list 按照 created_at 倒序排列，用二分查找定位翻页的位置
+        # cache 里最多有 REDIS_LIST_LENGTH_LIMIT 个 objects，不需要每次都线性扫描一遍
+        keys = ReversedTimestampKeys(reverse_ordered_list)
+
+        created_at__gt = self.parse_timestamp_param(request, 'created_at__gt')
+        if created_at__gt is not None:
+            # 所有 created_at > created_at__gt 的 objects 都在 list 的最前面
+            index = bisect.bisect_left(keys, -created_at__gt)
+            return self._set_page(reverse_ordered_list[:index], False)
 
         index = 0
-        if 'created_at__lt' in request.query_params:
-            # 兼容 iso 格式和 int 格式的时间戳
-            # 存储层最好不要管显示层的东西，最好能做到统一化(e.g. 时间不要有不同的写法)
-            # iso format: 2021-11-11 11:11:11.000000
-
-            try:
-                created_at__lt = parser.isoparse(request.query_params['created_at__lt'])
-            except ValueError:
-                created_at__lt = int(request.query_params['created_at__lt'])
-
-            for index, obj in enumerate(reverse_ordered_list):
-                if obj.created_at < created_at__lt:
-                    break
-            else:
-                # 没找到任何满足条件的 objects, 返回空数组
-                # 注意这个 else 对应的是 for，参见 python 的 for else 语法
-                reverse_ordered_list = []
-        self.has_next_page = len(reverse_ordered_list) > index + self.page_size
-        return reverse_ordered_list[index: index + self.page_size]
+        cursor = self.parse_cursor(request)
+        if cursor is not None:
+            timestamp, object_id = cursor
+            # 找到第一个 created_at < timestamp 的 object
+            # 没找到任何满足条件的 objects 的时候 index 是 len，返回空数组
+            index = bisect.bisect_right(keys, -timestamp)
+            if object_id is not None:
+                # 时间戳相同的 objects 按照 id 倒序排列，只跳过 id >= object_id 的
+                # 没有 id 的 objects (比如从 cache 里还原的，或者 bulk_create 的) 没法比较，只按照时间戳跳过
+                for tie_index in range(bisect.bisect_left(keys, -timestamp), index):
+                    tie_id = getattr(reverse_ordered_list[tie_index], 'id', None)
+                    if tie_id is not None and tie_id < object_id:
+                        index = tie_index
+                        break
+        return self._set_page(
+            reverse_ordered_list[index: index + self.page_size],
+            len(reverse_ordered_list) > index + self.page_size,
+        )
+
+    @classmethod
+    def parse_timestamp_param(cls, request, name):
+        """
+        兼容 iso 格式和 int 格式的时间戳，统一转换成 micro seconds 的 int
+        存储层最好不要管显示层的东西，最好能做到统一化(e.g. 时间不要有不同的写法)
+        iso format: 2021-11-11 11:11:11.000000
+        """
+        if name not in request.query_params:
+            return None
+        value = request.query_params[name]
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            dt = parser.isoparse(value)
+        except ValueError:
+            raise ValidationError({name: 'Invalid timestamp.'})
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=pytz.utc)
+        return datetime_to_timestamp(dt)
+
+    @classmethod
+    def parse_cursor(cls, request):
+        """
+        返回下一页的起点 (timestamp, id)，下一页里的 objects 都严格小于这个起点
+        没有翻页参数的时候返回 None
+        """
+        if 'cursor' in request.query_params:
+            return decode_cursor(request.query_params['cursor'])
+        created_at__lt = cls.parse_timestamp_param(request, 'created_at__lt')
+        if created_at__lt is not None:
+            return created_at__lt, None
+        return None
 
     def paginate_queryset(self, queryset, request: Request, view=None):
         # 获得更新内容
-        if 'created_at__gt' in request.query_params:
+        created_at__gt = self.parse_timestamp_param(request, 'created_at__gt')
+        if created_at__gt is not None:
             # created_at__gt 用于下拉刷新的时候加载最新的内容进来
             # 为了简便起见，下拉刷新不做翻页机制(has_next_page=False)，直接加载所有更新的数据
             # 因为如果数据很久没有更新的话，不会采用下拉刷新的方式进行更新，而是重新加载最新的数据
-            created_at__gt = request.query_params['created_at__gt']
-            queryset = queryset.filter(created_at__gt=created_at__gt)
+            queryset = queryset.filter(created_at__gt=timestamp_to_datetime(created_at__gt))
             self.has_next_page = False
-            return queryset.order_by('-created_at')
+            self.next_cursor = None
+            return queryset.order_by('-created_at', '-id')
 
         # 加载下一页数据
-        if 'created_at__lt' in request.query_params:
-            # created_at__lt 用于向上滚屏（往下翻页）的时候加载下一页的数据
-            # 寻找 created_at < created_at__lt 的 objects 里
-            # 按照 created_at 倒序的前 page_size + 1 个 objects
-            # 比如目前的 created_at 列表是 [10, 9, 8, 7 .. 1] 如果 created_at__lt=10
+        objects = self._load_queryset_page(queryset, self.parse_cursor(request), self.page_size + 1)
+        # 返回前端的还是 page_size 个
+        return self._set_page(objects[:self.page_size], len(objects) > self.page_size)
+
+    @classmethod
+    def _load_queryset_page(cls, queryset, cursor, limit):
+        if cursor is not None:
+            # 用于向上滚屏（往下翻页）的时候加载下一页的数据
+            # 寻找 (created_at, id) < cursor 的 objects 里
+            # 按照 (created_at, id) 倒序的前 page_size + 1 个 objects
+            # 比如目前的 created_at 列表是 [10, 9, 8, 7 .. 1] 如果 cursor 是 10
             # page_size = 2 则应该返回 [9, 8, 7]，
             # 多返回一个 object 的原因是为了判断是否还有下一页从而减少一次空加载。
-            created_at__lt = request.query_params['created_at__lt']
-            queryset = queryset.filter(created_at__lt=created_at__lt)
+            # 相同 created_at 的 objects 再按照 id 区分，不会因为时间戳相同而漏掉
+            timestamp, object_id = cursor
+            created_at = timestamp_to_datetime(timestamp)
+            if object_id is None:
+                queryset = queryset.filter(created_at__lt=created_at)
+            else:
+                queryset = queryset.filter(
+                    Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=object_id)
+                )
 
-        queryset = queryset.order_by('-created_at')[:self.page_size + 1]
-        self.has_next_page = len(queryset) > self.page_size
-        return queryset[:self.page_size]  # 返回前端的还是 page_size 个
+        # (created_at, id) 的排序可以用上 created_at 的联合索引，innodb 的二级索引里本身就带着主键
+        return list(queryset.order_by('-created_at', '-id')[:limit])
 
     def paginate_hbase(self, hb_model: HBaseModel, row_key_prefix, request):
         # row_key_prefix: tuple
-        if 'created_at__gt' in request.query_params:
+        # hbase 的 row key 里已经有 created_at，同一个 prefix 下 created_at 是唯一的
+        # 所以 cursor 只需要 created_at，开区间转换成闭区间之后可以从准确的位置开始 scan
+        created_at__gt = self.parse_timestamp_param(request, 'created_at__gt')
+        if created_at__gt is not None:
             # created_at__gt 用于下拉刷新的时候加载最新的内容进来
             # 为了简便起见，下拉刷新不做翻页机制，直接加载所有更新的数据
             # 因为如果数据很久没有更新的话，不会采用下拉刷新的方式进行更新，而是重新加载最新的数据
-            created_at__gt = request.query_params['created_at__gt']
-            start = (*row_key_prefix, created_at__gt)
+            # created_at > created_at__gt 等价于 created_at >= created_at__gt + 1
+            start = (*row_key_prefix, created_at__gt + 1)
             stop = (*row_key_prefix, MAX_TIMESTAMP)  # stop 需大于 start
             objects = hb_model.filter(start=start, stop=stop)
-
-            # created_at__gt 是开区间，取不到
-            if len(objects) and objects[0].created_at == int(created_at__gt):
-                # [1,2,3,4] => [4,3,2]
-                objects = objects[:0:-1]  # 去掉第一个后反转
-            else:
-                objects = objects[::-1]  # 反转
             self.has_next_page = False
-            return objects
-
-        if 'created_at__lt' in request.query_params:
-            # created_at__lt 用于向上滚屏（往下翻页）的时候加载下一页的数据
-            # 寻找 timestamp < created_at__lt 的 objects 里
-            # 按照 timestamp 倒序的前 page_size + 1 个 objects
-            # 比如目前的 timestamp 列表是 [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
-            # 如果 created_at__lt=5, page_size = 2，则应该返回 [4, 3, 2]，
-            # 多返回一个 object 的原因是为了判断是否还有下一页从而减少一次空加载。
-            # 由于 hbase 只支持 <= 的查询而不支持 <,
-            # 因此我们还需要再多取一个 item 保证 < 的 item 有 page_size + 1 个
-            # 故 limit=page_size + 2
-            created_at__lt = request.query_params['created_at__lt']
-            start = (*row_key_prefix, created_at__lt)
-            # reverse=True:
-            # This means that row_start must be lexicographically after row_stop.
-            stop = (*row_key_prefix, None)
-            objects = hb_model.filter(
-                start=start,
-                stop=stop,
-                limit=self.page_size + 2,
-                reverse=True
-            )
-
-            # created_at__lt 是开区间，取不到
-            if len(objects) and objects[0].created_at == int(created_at__lt):
-                objects = objects[1:]
-
-            if len(objects) > self.page_size:
-                self.has_next_page = True
-                objects = objects[:-1]
-            else:
-                self.has_next_page = False
-            return objects
-
-        # 没有任何参数，默认加载最新的一页
-        prefix = (*row_key_prefix, None)
-        objects = hb_model.filter(
-            prefix=prefix,
-            limit=self.page_size + 1,
-            reverse=True
+            self.next_cursor = None
+            return objects[::-1]  # 反转
+
+        objects = self._load_hbase_page(
+            hb_model,
+            row_key_prefix,
+            self.parse_cursor(request),
+            self.page_size + 1,
         )
-        if len(objects) > self.page_size:
-            self.has_next_page = True
-            objects = objects[:-1]
-        else:
-            self.has_next_page = False
-        return objects
+        return self._set_page(objects[:self.page_size], len(objects) > self.page_size)
+
+    @classmethod
+    def _load_hbase_page(cls, hb_model: HBaseModel, row_key_prefix, cursor, limit):
+        if cursor is None:
+            # 没有任何参数，默认加载最新的一页
+            prefix = (*row_key_prefix, None)
+            return hb_model.filter(prefix=prefix, limit=limit, reverse=True)
+
+        # 用于向上滚屏（往下翻页）的时候加载下一页的数据
+        # 寻找 timestamp < cursor 的 objects 里
+        # 按照 timestamp 倒序的前 page_size + 1 个 objects
+        # 比如目前的 timestamp 列表是 [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+        # 如果 cursor 是 5, page_size = 2，则应该返回 [4, 3, 2]，
+        # 多返回一个 object 的原因是为了判断是否还有下一页从而减少一次空加载。
+        # hbase 只支持 <= 的查询而不支持 <，created_at < cursor 等价于 created_at <= cursor - 1
+        timestamp, _ = cursor
+        start = (*row_key_prefix, timestamp - 1)
+        # reverse=True:
+        # This means that row_start must be lexicographically after row_stop.
+        stop = (*row_key_prefix, None)
+        return hb_model.filter(start=start, stop=stop, limit=limit, reverse=True)
+
+    @classmethod
+    def queryset_loader(cls, queryset):
+        """
+        给 paginate_cached_list 用的 load_remainder，从 mysql 里接着 cache 往后读
+        """
+        return lambda cursor, limit: cls._load_queryset_page(queryset, cursor, limit)
 
-    def paginate_cached_list(self, cached_list, request):
+    @classmethod
+    def hbase_loader(cls, hb_model: HBaseModel, row_key_prefix):
+        """
+        给 paginate_cached_list 用的 load_remainder，从 hbase 里接着 cache 往后读
+        """
+        return lambda cursor, limit: cls._load_hbase_page(hb_model, row_key_prefix, cursor, limit)
+
+    def paginate_cached_list(self, cached_list, request, load_remainder=None, is_truncated=None):
+        """
+        load_remainder(cursor, limit): 翻到 cache 的末尾的时候，从存储层读取 cursor 之后的 limit 个 objects
+        不传的时候，翻出 cache 的范围就返回 None，由调用者自己去存储层重新查询一整页
+        is_truncated: 存储层里是否还有 cached_list 之后的数据，不传的时候根据 cached_list 的长度判断
+        """
         paginated_list = self.paginate_ordered_list(cached_list, request)
         # 如果是上翻页，paginated_list 里是所有的最新的数据，直接返回
         if 'created_at__gt' in request.query_params:
@@ -161,13 +262,30 @@ class EndlessPagination(BasePagination):
             return paginated_list
         # 没有下一页了
         # 如果 cached_list 的长度不足最大限制，说明 cached_list 里已经是所有数据了
-        if len(cached_list) < settings.REDIS_LIST_LENGTH_LIMIT:
+        if is_truncated is None:
+            is_truncated = len(cached_list) >= settings.REDIS_LIST_LENGTH_LIMIT
+        if not is_truncated:
             return paginated_list
-        # 如果进入这里，说明可能存在在数据库里没有 load 在 cache 里的数据，需要直接去数据库查询
-        return None
+        # 如果进入这里，说明可能存在在数据库里没有 load 在 cache 里的数据，需要去数据库查询
+        if load_remainder is None:
+            return None
+
+        # cache 里已经取到的部分直接用，只从存储层读取剩下的部分，从 cache 里最后一个 object 之后开始
+        if paginated_list:
+            last_object = paginated_list[-1]
+            cursor = (get_timestamp(last_object), getattr(last_object, 'id', None))
+        else:
+            cursor = self.parse_cursor(request)
+        remainder_size = self.page_size - len(paginated_list)
+        remainder = list(load_remainder(cursor, remainder_size + 1))
+        return self._set_page(
+            paginated_list + remainder[:remainder_size],
+            len(remainder) > remainder_size,
+        )
 
     def get_paginated_response(self, data):
         return Response({
             'has_next_page': self.has_next_page,
+            'next_cursor': self.next_cursor,
             'results': data,
         })
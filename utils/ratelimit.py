@@ -1,7 +1,137 @@
+import functools
+import math
+import re
+import time
+
+from django.conf import settings
 from ratelimit.exceptions import Ratelimited
 from rest_framework import status
 from rest_framework.views import exception_handler as drf_exception_handler
 
+from twitter.cache import RATELIMIT_PATTERN
+from utils.redis_client import RedisClient
+
+# GCRA (generic cell rate algorithm)，每个 limit 只需要在 redis 里存一个 TAT (theoretical arrival time)
+# 一个 request 的所有 limits 在一次 lua 调用里判断，任何一个 limit 超了就都不计数，并返回需要等待的时间
+# KEYS[i]: 第 i 个 limit 的 key
+# ARGV[1]: 当前时间 (ms)，ARGV[2i], ARGV[2i + 1]: 第 i 个 limit 的 emission interval 和 period (ms)
+GCRA_SCRIPT = """
+local now = tonumber(ARGV[1])
+local retry_after = 0
+local new_tats = {}
+for i, key in ipairs(KEYS) do
+    local emission_interval = tonumber(ARGV[i * 2])
+    local period = tonumber(ARGV[i * 2 + 1])
+    local tat = math.max(tonumber(redis.call('GET', key) or now), now)
+    local new_tat = tat + emission_interval
+    retry_after = math.max(retry_after, new_tat - period - now)
+    new_tats[i] = new_tat
+end
+if retry_after > 0 then
+    return math.ceil(retry_after)
+end
+for i, key in ipairs(KEYS) do
+    redis.call('SET', key, new_tats[i], 'PX', math.ceil(new_tats[i] - now))
+end
+return 0
+"""
+
+RATE_PERIODS = {
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+}
+
+ALL_METHODS = None
+
+KEY_FUNCTIONS = {
+    'ip': lambda request: request.META['REMOTE_ADDR'],
+    'user': lambda request: str(request.user.pk),
+    'user_or_ip': lambda request: (
+        str(request.user.pk)
+        if request.user.is_authenticated
+        else request.META['REMOTE_ADDR']
+    ),
+}
+
+
+class RateLimited(Ratelimited):
+    """
+    继承 django-ratelimit 的 Ratelimited，exception_handler 可以统一处理
+    retry_after: 需要等待的秒数
+    """
+
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__()
+        self.retry_after = retry_after
+
+
+def parse_rate(rate):
+    """
+    '5/s' => (5, 1000), '5/m' => (5, 60000), '100/10m' => (100, 600000)
+    返回 (count, period in ms)
+    """
+    match = re.fullmatch(r'(\d+)/(\d*)([smhd])', rate)
+    if match is None:
+        raise ValueError('Invalid rate: {}'.format(rate))
+    count, multiplier, unit = match.groups()
+    return int(count), int(multiplier or 1) * RATE_PERIODS[unit] * 1000
+
+
+def get_retry_after(group, identity, rates):
+    """
+    给 identity 在 group 里的每个 rate 计数一次，返回需要等待的秒数，没有超过限制的时候返回 0
+    所有 rates 只需要一次 redis 的调用
+    """
+    keys = []
+    args = [int(time.time() * 1000)]
+    for rate in rates:
+        count, period = parse_rate(rate)
+        keys.append(RATELIMIT_PATTERN.format(group=group, identity=identity, rate=rate))
+        args.extend([period / count, period])
+
+    conn = RedisClient.get_connection()
+    retry_after = conn.eval(GCRA_SCRIPT, len(keys), *keys, *args)
+    return retry_after / 1000
+
+
+def get_group(func):
+    # method_decorator 传进来的是绑定了 self 的 functools.partial，需要取到原来的方法
+    while isinstance(func, functools.partial):
+        func = func.func
+    return '{}.{}'.format(func.__module__, func.__qualname__)
+
+
+def ratelimit(key, rate, method=ALL_METHODS, block=True):
+    """
+    和 django-ratelimit 的 ratelimit 用法一样，用 method_decorator 装饰 view 的方法
+    rate 可以是一个 rate，也可以是一组 rates，比如 rate=('1/s', '5/m')，在一次 redis 调用里全部判断
+    block=False 的时候不 raise exception，只设置 request.limited
+    """
+    rates = (rate,) if isinstance(rate, str) else tuple(rate)
+    methods = (method,) if isinstance(method, str) else method
+
+    def decorator(func):
+        group = get_group(func)
+
+        @functools.wraps(func)
+        def wrapper(request, *args, **kwargs):
+            request.limited = getattr(request, 'limited', False)
+            if not settings.RATELIMIT_ENABLE:
+                return func(request, *args, **kwargs)
+            if methods is not ALL_METHODS and request.method not in methods:
+                return func(request, *args, **kwargs)
+
+            retry_after = get_retry_after(group, KEY_FUNCTIONS[key](request), rates)
+            if retry_after > 0:
+                request.limited = True
+                if block:
+                    raise RateLimited(retry_after)
+            return func(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
 
 def exception_handler(exc, context):
     # Call REST framework's default exception handler first,
@@ -12,5 +142,7 @@ def exception_handler(exc, context):
     if isinstance(exc, Ratelimited):
         response.data['detail'] = 'Too many requests, try again later.'
         response.status_code = status.HTTP_429_TOO_MANY_REQUESTS
+        if isinstance(exc, RateLimited):
+            response['Retry-After'] = str(math.ceil(exc.retry_after))
 
     return response
@@ -5,6 +5,47 @@ from utils.redis_client import RedisClient
 from utils.redis_serializers import DjangoModelSerializer, HBaseModelSerializer
 
 
+# 和 remove_object 的逻辑一样，list 已经达到长度上限的时候直接删掉整个 key
+# 用 lua 脚本保证判断和删除是原子的，并且可以放在 pipeline 里批量执行
+REMOVE_OBJECT_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[2]) then
+    return redis.call('DEL', KEYS[1])
+end
+return redis.call('LREM', KEYS[1], 0, ARGV[1])
+"""
+
+# key 存在的时候才修改 set，否则 cache 里只有部分数据
+ADD_SET_MEMBER_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('SADD', KEYS[1], ARGV[1])
+end
+return 0
+"""
+REMOVE_SET_MEMBER_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('SREM', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+# key 存在的时候才修改计数，否则等下次读取时从数据库 load，计数不会小于 0
+INCR_IF_EXISTS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local count = redis.call('INCRBY', KEYS[1], ARGV[1])
+if count < 0 then
+    redis.call('SET', KEYS[1], 0, 'KEEPTTL')
+    return 0
+end
+return count
+"""
+
+# 空的 set 在 redis 里是不存在的，无法区分 "cache 里是空的" 和 "没有 cache"
+# 所以在 set 里额外放一个不会出现的 member 占位
+SET_PLACEHOLDER = ''
+
+
 class RedisHelper:
 
     @classmethod
@@ -21,13 +62,18 @@ class RedisHelper:
             conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
 
     @classmethod
-    def load_objects(cls, key, lazy_load_func, serializer=DjangoModelSerializer):
+    def load_objects(cls, key, lazy_load_func, serializer=DjangoModelSerializer, limit=None):
+        """
+        limit: 只需要最前面的 limit 个 objects 的时候，cache hit 时只 lrange 出 limit 个
+        避免把整个 list 都取出来并 deserialize
+        """
         conn = RedisClient.get_connection()
 
         # 如果在 cache 里存在，则直接拿出来，然后返回
         # cache hit
         if conn.exists(key):
-            serialized_list = conn.lrange(key, 0, -1)
+            end = -1 if limit is None else limit - 1
+            serialized_list = conn.lrange(key, 0, end)
             objects = []
             for serialized_data in serialized_list:
                 deserialized_obj = serializer.deserialize(serialized_data)
@@ -43,15 +89,52 @@ class RedisHelper:
         cls._load_objects_to_cache(key, objects, serializer)
         # 转换为 list 的原因是保持返回类型的统一，因为存在 redis 里的数据是 list 的形式
         # 此时真正访问 queryset，产生数据库查询
-        return list(objects)
+        objects = list(objects)
+        if limit is not None:
+            return objects[:limit]
+        return objects
 
     @classmethod
-    def push_object(cls, key, obj, lazy_load_func):
+    def iterate_objects(cls, key, lazy_load_func, serializer=DjangoModelSerializer, batch_size=100):
+        """
+        按顺序逐个返回 cache 里的 objects，每次只 lrange 出 batch_size 个，用到的时候才 deserialize
+        调用者提前停下的时候 (比如 k 路归并只需要最前面的一部分)，后面的部分不会被读取和 deserialize
+        """
+        conn = RedisClient.get_connection()
+        if not conn.exists(key):
+            yield from cls.load_objects(key, lazy_load_func, serializer=serializer)
+            return
+
+        start = 0
+        while True:
+            serialized_list = conn.lrange(key, start, start + batch_size - 1)
+            for serialized_data in serialized_list:
+                yield serializer.deserialize(serialized_data)
+            if len(serialized_list) < batch_size:
+                return
+            start += batch_size
+
+    @classmethod
+    def intersect_set_members(cls, key, other_key, lazy_load_func):
+        """
+        返回 key 的 set 和 other_key 的 set 的交集，key 的 set 没有 cache 的时候用 lazy_load_func 加载
+        SINTER 在 redis 里遍历较小的那个 set，不需要把两个 set 都取出来
+        """
+        conn = RedisClient.get_connection()
+        if not conn.exists(key):
+            cls._load_set_members_to_cache(key, lazy_load_func)
+        members = conn.sinter(key, other_key)
+        return set(int(member) for member in members if member != SET_PLACEHOLDER.encode())
+
+    @classmethod
+    def get_serializer(cls, obj):
         if isinstance(obj, HBaseModel):
-            serializer = HBaseModelSerializer
-        else:
-            serializer = DjangoModelSerializer
+            return HBaseModelSerializer
+        return DjangoModelSerializer
 
+    @classmethod
+    def push_object(cls, key, obj, lazy_load_func):
+        serializer = cls.get_serializer(obj)
         conn = RedisClient.get_connection()
 
         if not conn.exists(key):
@@ -65,6 +148,193 @@ class RedisHelper:
         conn.lpush(key, serialized_data)
         conn.ltrim(name=key, start=0, end=settings.REDIS_LIST_LENGTH_LIMIT - 1)
 
+    @classmethod
+    def push_objects_to_cached_keys(cls, key_object_pairs, dedup=False):
+        """
+        push_object 的批量版本，适用于 fanout 这种一次要 push 到很多个 key 的场景
+        - 所有的 push 放在同一个 pipeline 里，只需要一次 round trip
+        - 用 lpushx 代替 exists + lpush，key 不存在的时候直接跳过而不是 lazy load，
+          cold key 等到下次读取的时候再从数据库里 load，避免在 fanout 的时候做大量的数据库扫描
+        dedup: 重试的时候 obj 可能已经 push 过了，先 lrem 再 push，
+          并用事务保证并发的重试不会交错执行
+        返回真正 push 进 cache 的个数
+        """
+        if not key_object_pairs:
+            return 0
+
+        conn = RedisClient.get_connection()
+        # 不需要去重的时候不需要事务，只需要 pipeline 来减少 round trip
+        pipe = conn.pipeline(transaction=dedup)
+        for key, obj in key_object_pairs:
+            serialized_data = cls.get_serializer(obj).serialize(obj)
+            if dedup:
+                pipe.lrem(key, 0, serialized_data)
+            pipe.lpushx(key, serialized_data)
+            pipe.ltrim(name=key, start=0, end=settings.REDIS_LIST_LENGTH_LIMIT - 1)
+        results = pipe.execute()
+        # lpushx 的返回值是 push 之后 list 的长度，key 不存在时为 0
+        step = 3 if dedup else 2
+        offset = 1 if dedup else 0
+        return sum(1 for length in results[offset::step] if length)
+
+    @classmethod
+    def remove_object(cls, key, obj):
+        serializer = cls.get_serializer(obj)
+        conn = RedisClient.get_connection()
+        if not conn.exists(key):
+            return
+
+        if conn.llen(key) >= settings.REDIS_LIST_LENGTH_LIMIT:
+            # list 已经被 trim 过，删除之后会被误认为 cache 里已经是全部的数据
+            # 直接失效整个 key，下次访问的时候会重新从数据库里 load
+            conn.delete(key)
+            return
+
+        serialized_data = serializer.serialize(obj)
+        removed = conn.lrem(key, 0, serialized_data)
+        if not removed:
+            # cache 里的数据和 obj 不一致（比如 obj 在 push 之后被修改过）
+            # 直接失效整个 key，下次访问的时候会重新从数据库里 load
+            conn.delete(key)
+
+    @classmethod
+    def remove_objects_from_cached_keys(cls, key_object_pairs):
+        """
+        remove_object 的批量版本，所有的删除在一个 pipeline 里完成
+        """
+        if not key_object_pairs:
+            return
+
+        conn = RedisClient.get_connection()
+        remove_object_script = conn.register_script(REMOVE_OBJECT_SCRIPT)
+        pipe = conn.pipeline(transaction=False)
+        for key, obj in key_object_pairs:
+            remove_object_script(
+                keys=[key],
+                args=[cls.get_serializer(obj).serialize(obj), settings.REDIS_LIST_LENGTH_LIMIT],
+                client=pipe,
+            )
+        pipe.execute()
+
+    @classmethod
+    def invalidate_objects(cls, *keys):
+        if not keys:
+            return
+        conn = RedisClient.get_connection()
+        conn.delete(*keys)
+
+    @classmethod
+    def load_sorted_members(cls, key, lazy_load_func, limit=None):
+        """
+        sorted set 版本的 load_objects，只存 (member, score)，按照 score 倒序返回
+        适用于只需要存 id + timestamp，并且需要按 member 精确删除的场景
+        lazy_load_func(limit) 需要返回按照 score 倒序的 [(member, score), ...]
+        """
+        conn = RedisClient.get_connection()
+
+        # cache hit
+        if conn.exists(key):
+            end = -1 if limit is None else limit - 1
+            members = conn.zrevrange(key, 0, end, withscores=True)
+            return [(int(member), int(score)) for member, score in members]
+
+        # cache miss
+        members = list(lazy_load_func(settings.REDIS_LIST_LENGTH_LIMIT))
+        if members:
+            conn.zadd(key, {member: score for member, score in members})
+            conn.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        if limit is not None:
+            return members[:limit]
+        return members
+
+    @classmethod
+    def add_sorted_member(cls, key, member, score):
+        conn = RedisClient.get_connection()
+        # key 不存在的时候不做处理，否则 cache 里只有部分数据，下次访问时会 lazy load
+        if not conn.exists(key):
+            return
+
+        pipe = conn.pipeline()
+        pipe.zadd(key, {member: score})
+        # 只保留 score 最大的 REDIS_LIST_LENGTH_LIMIT 个
+        pipe.zremrangebyrank(key, 0, -settings.REDIS_LIST_LENGTH_LIMIT - 1)
+        pipe.execute()
+
+    @classmethod
+    def remove_sorted_member(cls, key, member):
+        conn = RedisClient.get_connection()
+        if conn.zcard(key) >= settings.REDIS_LIST_LENGTH_LIMIT:
+            # 原因同 remove_object
+            conn.delete(key)
+            return
+        conn.zrem(key, member)
+
+    @classmethod
+    def _load_set_members_to_cache(cls, key, lazy_load_func):
+        members = set(lazy_load_func())
+        conn = RedisClient.get_connection()
+        pipe = conn.pipeline()
+        pipe.delete(key)
+        pipe.sadd(key, SET_PLACEHOLDER, *members)
+        pipe.expire(key, settings.REDIS_KEY_EXPIRE_TIME)
+        pipe.execute()
+        return members
+
+    @classmethod
+    def load_set_members(cls, key, lazy_load_func):
+        """
+        set 版本的 load_objects，只存 int 类型的 member (比如 user id)
+        lazy_load_func() 返回所有的 members，不做长度限制
+        """
+        conn = RedisClient.get_connection()
+        members = conn.smembers(key)
+        if not members:
+            return cls._load_set_members_to_cache(key, lazy_load_func)
+        return set(int(member) for member in members if member != SET_PLACEHOLDER.encode())
+
+    @classmethod
+    def get_set_size(cls, key, lazy_load_func):
+        conn = RedisClient.get_connection()
+        size = conn.scard(key)
+        if not size:
+            return len(cls._load_set_members_to_cache(key, lazy_load_func))
+        # 去掉占位的 member
+        return size - 1
+
+    @classmethod
+    def filter_set_members(cls, key, members, lazy_load_func):
+        """
+        返回 members 里在 set 中的那些，保持原有的顺序
+        用 SMISMEMBER 一次查询一页的 members，不用把整个 set 都取出来
+        """
+        members = list(members)
+        if not members:
+            return []
+
+        conn = RedisClient.get_connection()
+        if not conn.exists(key):
+            cached_members = cls._load_set_members_to_cache(key, lazy_load_func)
+            return [member for member in members if member in cached_members]
+
+        # redis-py 3.5 还没有封装 SMISMEMBER (redis 6.2+)，直接发送命令
+        flags = conn.execute_command('SMISMEMBER', key, *members)
+        return [member for member, flag in zip(members, flags) if flag]
+
+    @classmethod
+    def add_set_member(cls, key, member):
+        conn = RedisClient.get_connection()
+        conn.register_script(ADD_SET_MEMBER_SCRIPT)(keys=[key], args=[member])
+
+    @classmethod
+    def remove_set_member(cls, key, member):
+        conn = RedisClient.get_connection()
+        conn.register_script(REMOVE_SET_MEMBER_SCRIPT)(keys=[key], args=[member])
+
+    @classmethod
+    def incr_if_exists(cls, key, amount=1):
+        conn = RedisClient.get_connection()
+        return conn.register_script(INCR_IF_EXISTS_SCRIPT)(keys=[key], args=[amount])
+
     @classmethod
     def get_count_key(cls, obj, attr):
         return '{}.{}:{}'.format(obj.__class__.__name__, attr, obj.id)
@@ -1,5 +1,20 @@
+from collections import namedtuple
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from rest_framework.exceptions import ValidationError
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from comments.models import Comment
 from testing.testcases import TestCase
+from tweets.models import Tweet
+from utils.content_type_helper import ContentTypeHelper
+from utils.hbase_backfill import HBaseBackfill
+from utils.paginations import EndlessPagination, decode_cursor, encode_cursor
+from utils.ratelimit import RateLimited, exception_handler, get_retry_after, parse_rate
 from utils.redis_client import RedisClient
+from utils.time_helpers import timestamp_to_datetime
 
 
 class UtilsTests(TestCase):
@@ -18,3 +33,212 @@ class UtilsTests(TestCase):
         RedisClient.clear()
         cached_list = conn.lrange('redis_key', 0, -1)
         self.assertEqual(cached_list, [])
+
+    def test_content_type_helper(self):
+        ContentTypeHelper.clear()
+        tweet_content_type = ContentType.objects.get_for_model(Tweet)
+        comment_content_type = ContentType.objects.get_for_model(Comment)
+
+        self.assertEqual(
+            ContentTypeHelper.get_content_type_id(Tweet),
+            tweet_content_type.id,
+        )
+        self.assertEqual(
+            ContentTypeHelper.get_content_type_id(Comment),
+            comment_content_type.id,
+        )
+        self.assertEqual(ContentTypeHelper.get_model_class(tweet_content_type.id), Tweet)
+        self.assertEqual(ContentTypeHelper.get_model_class(comment_content_type.id), Comment)
+
+        # 注册表 load 之后，不会再产生数据库查询
+        with self.assertNumQueries(0):
+            ContentTypeHelper.get_content_type_id(Tweet)
+            ContentTypeHelper.get_model_class(comment_content_type.id)
+
+    def test_hbase_backfill_ranges_and_verify(self):
+        def create_backfill(workers):
+            return HBaseBackfill(
+                name='test',
+                queryset=Tweet.objects.all(),
+                fields=('user_id',),
+                to_rows=lambda row: [],
+                workers=workers,
+                log=lambda message: None,
+            )
+
+        backfill = create_backfill(workers=3)
+        # 区间左闭右闭，覆盖 [min_id, max_id] 并且互不重叠
+        self.assertEqual(backfill._split_ranges(1, 10), [(1, 4), (5, 8), (9, 10)])
+        self.assertEqual(backfill._split_ranges(5, 5), [(5, 5)])
+
+        # 区间在第一次执行时记录下来，表增长或者 workers 个数变化之后沿用原来的区间
+        user = self.create_user('user')
+        tweets = [self.create_tweet(user) for _ in range(6)]
+        self.assertEqual(backfill._get_ranges(), backfill._split_ranges(tweets[0].id, tweets[-1].id))
+        ranges = backfill._get_ranges()
+        new_tweet = self.create_tweet(user)
+        self.assertEqual(
+            create_backfill(workers=1)._get_ranges(),
+            ranges + [(tweets[-1].id + 1, new_tweet.id)],
+        )
+        # --restart 之后重新划分
+        backfill.reset_checkpoints()
+        self.assertEqual(create_backfill(workers=1)._get_ranges(), [(tweets[0].id, new_tweet.id)])
+
+        mismatches = backfill.verify_counts(
+            [1, 2, 3],
+            get_mysql_counts=lambda user_ids: {1: 2, 3: 1},
+            get_hbase_count=lambda hbase_conn, user_id: {1: 2, 2: 0, 3: 0}[user_id],
+            range_size=2,
+        )
+        self.assertEqual(mismatches, [(3, 1, 0)])
+
+    def test_paginate_ordered_list(self):
+        Item = namedtuple('Item', ['created_at'])
+        factory = APIRequestFactory()
+        page_size = EndlessPagination.page_size
+
+        def paginate(reverse_ordered_list, **params):
+            paginator = EndlessPagination()
+            request = Request(factory.get('/', params))
+            return paginator.paginate_ordered_list(reverse_ordered_list, request), paginator
+
+        # hbase 的 objects 的 created_at 是 int，相同的时间戳也可以正确翻页
+        timestamps = [100] + [90] * 3 + list(range(80, 80 - page_size * 2, -1))
+        items = [Item(created_at=timestamp) for timestamp in timestamps]
+
+        page, paginator = paginate(items)
+        self.assertEqual(page, items[:page_size])
+        self.assertEqual(paginator.has_next_page, True)
+
+        page, paginator = paginate(items, created_at__lt=90)
+        self.assertEqual(page, items[4: 4 + page_size])
+        self.assertEqual(paginator.has_next_page, True)
+
+        page, paginator = paginate(items, created_at__lt=80 - page_size + 1)
+        self.assertEqual(page, items[4 + page_size:])
+        self.assertEqual(paginator.has_next_page, False)
+
+        page, paginator = paginate(items, created_at__lt=0)
+        self.assertEqual(page, [])
+        self.assertEqual(paginator.has_next_page, False)
+
+        page, paginator = paginate(items, created_at__gt=89)
+        self.assertEqual(page, items[:4])
+        self.assertEqual(paginator.has_next_page, False)
+
+        # mysql 的 objects 的 created_at 是 datetime，iso 格式和 int 格式的 cursor 结果一样
+        items = [Item(created_at=timestamp_to_datetime(timestamp)) for timestamp in timestamps]
+        for cursor in [90, items[1].created_at.isoformat()]:
+            page, _ = paginate(items, created_at__lt=cursor)
+            self.assertEqual(page, items[4: 4 + page_size])
+            page, _ = paginate(items, created_at__gt=cursor)
+            self.assertEqual(page, items[:1])
+
+    def test_paginate_ordered_list_with_cursor(self):
+        Item = namedtuple('Item', ['id', 'created_at'])
+        factory = APIRequestFactory()
+        page_size = EndlessPagination.page_size
+
+        # 相同的 created_at 按照 id 倒序排列，跨页的时候不会漏掉也不会重复
+        items = [
+            Item(id=index, created_at=timestamp_to_datetime(index // 3))
+            for index in range(page_size * 3, 0, -1)
+        ]
+        results = []
+        cursor = None
+        while True:
+            paginator = EndlessPagination()
+            params = {'cursor': cursor} if cursor else {}
+            request = Request(factory.get('/', params))
+            results.extend(paginator.paginate_ordered_list(items, request))
+            if not paginator.has_next_page:
+                break
+            cursor = paginator.next_cursor
+        self.assertEqual(results, items)
+        self.assertIsNone(paginator.next_cursor)
+
+        self.assertEqual(decode_cursor(encode_cursor(items[0])), (page_size, page_size * 3))
+
+        # 没有 id 的 objects 时间戳相同的时候没法比较 id，只按照时间戳跳过
+        items = [
+            Item(id=None, created_at=timestamp_to_datetime(timestamp))
+            for timestamp in [3, 2, 2, 1]
+        ]
+        cursor = encode_cursor(Item(id=5, created_at=timestamp_to_datetime(2)))
+        paginator = EndlessPagination()
+        request = Request(factory.get('/', {'cursor': cursor}))
+        self.assertEqual(paginator.paginate_ordered_list(items, request), items[3:])
+
+        # 不合法的时间戳是 400 而不是 500
+        request = Request(factory.get('/', {'created_at__lt': 'not a timestamp'}))
+        with self.assertRaises(ValidationError):
+            EndlessPagination().paginate_ordered_list(items, request)
+
+    def test_paginate_cached_list_with_load_remainder(self):
+        Item = namedtuple('Item', ['id', 'created_at'])
+        factory = APIRequestFactory()
+        page_size = EndlessPagination.page_size
+        list_limit = settings.REDIS_LIST_LENGTH_LIMIT
+
+        # 存储层里的数据比 cache 里多两页
+        stored_items = [
+            Item(id=index, created_at=timestamp_to_datetime(index))
+            for index in range(list_limit + page_size * 2, 0, -1)
+        ]
+        cached_items = stored_items[:list_limit]
+        load_calls = []
+
+        def load_remainder(cursor, limit):
+            load_calls.append((cursor, limit))
+            timestamp, object_id = cursor
+            return [item for item in stored_items if item.id < object_id][:limit]
+
+        # 这一页横跨 cache 的末尾，cache 里的部分直接用，只从存储层读取剩下的部分
+        offset = list_limit - page_size // 2
+        paginator = EndlessPagination()
+        request = Request(factory.get('/', {'cursor': encode_cursor(cached_items[offset - 1])}))
+        page = paginator.paginate_cached_list(cached_items, request, load_remainder)
+        self.assertEqual(page, stored_items[offset: offset + page_size])
+        self.assertEqual(paginator.has_next_page, True)
+        # created_at 的 micro seconds 和 id 相同
+        last_id = cached_items[-1].id
+        self.assertEqual(load_calls, [((last_id, last_id), page_size - page_size // 2 + 1)])
+
+        # 完全在 cache 之外的一页，从请求的 cursor 开始读取一整页
+        request = Request(factory.get('/', {'cursor': paginator.next_cursor}))
+        paginator = EndlessPagination()
+        page = paginator.paginate_cached_list(cached_items, request, load_remainder)
+        self.assertEqual(page, stored_items[offset + page_size:])
+        self.assertEqual(paginator.has_next_page, False)
+
+        # 不传 load_remainder 的时候保持原来的行为
+        paginator = EndlessPagination()
+        self.assertIsNone(paginator.paginate_cached_list(cached_items, request))
+
+    def test_ratelimit(self):
+        self.assertEqual(parse_rate('5/s'), (5, 1000))
+        self.assertEqual(parse_rate('5/m'), (5, 60 * 1000))
+        self.assertEqual(parse_rate('100/10m'), (100, 600 * 1000))
+
+        # 1/s 和 3/m 在一次调用里一起判断，超过任何一个都要等待
+        rates = ('1/s', '3/m')
+        self.assertEqual(get_retry_after('group', 'user1', rates), 0)
+        retry_after = get_retry_after('group', 'user1', rates)
+        self.assertTrue(0 < retry_after <= 1)
+        # 不同的 identity 和 group 分别计数
+        self.assertEqual(get_retry_after('group', 'user2', rates), 0)
+        self.assertEqual(get_retry_after('another group', 'user1', rates), 0)
+
+        # 被限制的 request 不计数，1/s 的限制过去之后可以继续，第 4 次超过了 3/m
+        conn = RedisClient.get_connection()
+        for _ in range(2):
+            conn.delete('ratelimit:group:user1:1/s')
+            self.assertEqual(get_retry_after('group', 'user1', rates), 0)
+        conn.delete('ratelimit:group:user1:1/s')
+        retry_after = get_retry_after('group', 'user1', rates)
+        self.assertTrue(1 < retry_after <= 60)
+
+        response = exception_handler(RateLimited(retry_after=1.5), {})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '2')
@@ -1,7 +1,18 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import pytz
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
 
 def utc_now():
     return datetime.now().replace(tzinfo=pytz.utc)
+
+
+def datetime_to_timestamp(dt):
+    # 用整数运算转换成 micro seconds，避免 float 精度丢失
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+def timestamp_to_datetime(timestamp):
+    return EPOCH + timedelta(microseconds=int(timestamp))